@@ -7,6 +7,15 @@ import sys
 import json
 import time
 import os
+import threading
+import select
+import atexit
+import errno
+import ssl
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 try:
     from kodi_six import xbmc, xbmcplugin, xbmcgui, xbmcaddon, xbmcvfs
 except ImportError:
@@ -16,6 +25,11 @@ except ImportError:
     import xbmcaddon
     import xbmcvfs
 PY2 = sys.version_info[0] == 2
+QTYPE_A = 1
+QTYPE_CNAME = 5
+QTYPE_AAAA = 28
+# connect_ex() de um socket não bloqueante ainda em andamento (10035 = WSAEWOULDBLOCK no Windows)
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY, 10035)
 ADDON_ = xbmcaddon.Addon()
 TRANSLATE_ = xbmc.translatePath if PY2 else xbmcvfs.translatePath
 profile = TRANSLATE_(ADDON_.getAddonInfo('profile'))
@@ -25,25 +39,314 @@ CACHE_FILE = os.path.join(profile, 'dns_cache.json')
 
 logging.basicConfig(level=logging.DEBUG)
 
+# Servidores padrão de cada backend: "ip[:porta]", "ip[:porta]#nome-do-certificado" (tls) ou URL (https)
+DNS_SERVERS = {
+    'udp': [
+        '208.67.222.222',# OpenDNS
+        '208.67.220.220',# OpenDNS
+        '1.1.1.1',       # Cloudflare
+        '8.8.8.8'        # Google DNS
+    ],
+    'tcp': ['208.67.222.222', '208.67.220.220', '1.1.1.1', '8.8.8.8'],
+    'tls': ['1.1.1.1#cloudflare-dns.com', '8.8.8.8#dns.google', '9.9.9.9#dns.quad9.net'],
+    'https': ['https://1.1.1.1/dns-query', 'https://8.8.8.8/dns-query', 'https://9.9.9.9/dns-query'],
+}
+
+def split_server(server, default_port=53):
+    """"ip", "ip:porta", "[ipv6]:porta" com "#nome" opcional -> (host, porta, nome)"""
+    server, _, hostname = server.partition('#')
+    if server.startswith('['):
+        host, _, port = server[1:].partition(']')
+        port = port.lstrip(':')
+    elif server.count(':') == 1:
+        host, port = server.split(':')
+    else:
+        host, port = server, ''
+    return host, int(port) if port else default_port, hostname or host
+
+
+class TcpBackend(object):
+    """DNS sobre TCP (RFC 7766): uma conexão persistente por servidor, com as
+    consultas enviadas em pipeline e as respostas casadas pelo transaction id."""
+    default_port = 53
+
+    def __init__(self, server, resolver):
+        self.server = server
+        self.resolver = resolver
+        self.host, self.port, self.hostname = split_server(server, self.default_port)
+        self.sock = None
+        self.buffer = b''
+        self.lock = threading.Lock()
+
+    def _open(self, timeout):
+        # Resolve pelo getaddrinfo original para não entrar no próprio resolver
+        getaddrinfo = self.resolver.original_getaddrinfo or socket.getaddrinfo
+        family, socktype, proto, _, sockaddr = getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, socktype, proto)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(sockaddr)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return self._wrap(sock)
+        except Exception:
+            sock.close()
+            raise
+
+    def _wrap(self, sock):
+        return sock
+
+    def _recv_exact(self, size):
+        while len(self.buffer) < size:
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error("conexão fechada pelo servidor")
+            self.buffer += data
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def _send_queries(self, queries):
+        self.sock.sendall(b''.join(struct.pack('>H', len(query)) + query for query in queries))
+
+    def _read_answer(self):
+        size = struct.unpack('>H', self._recv_exact(2))[0]
+        return self._recv_exact(size)
+
+    def exchange(self, queries, timeout):
+        """Envia as consultas e devolve {transaction id: resposta}"""
+        with self.lock:
+            while True:
+                reused = self.sock is not None
+                if not reused:
+                    self.sock = self._open(timeout)
+                try:
+                    self.sock.settimeout(timeout)
+                    self._send_queries(queries)
+                    answers = {}
+                    while len(answers) < len(queries):
+                        data = self._read_answer()
+                        answers[data[:2]] = data
+                    return answers
+                except socket.timeout:
+                    self.close()
+                    raise
+                except socket.error:
+                    self.close()
+                    if not reused:
+                        raise
+                    # O servidor fechou a conexão ociosa: abre outra e repete uma vez
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self.buffer = b''
+
+
+class TlsBackend(TcpBackend):
+    """DNS sobre TLS (RFC 7858), "ip[:porta]#nome" com o nome do certificado."""
+    default_port = 853
+
+    def _wrap(self, sock):
+        context = ssl.create_default_context(cafile=self.resolver.tls_cafile)
+        return context.wrap_socket(sock, server_hostname=self.hostname)
+
+
+class HttpsBackend(TlsBackend):
+    """DNS sobre HTTPS (RFC 8484): POST application/dns-message em HTTP/1.1
+    keep-alive, com as requisições em pipeline na mesma conexão TLS."""
+    default_port = 443
+
+    def __init__(self, server, resolver):
+        url = urlparse(server)
+        netloc = url.netloc if url.port else '{}:{}'.format(url.netloc, self.default_port)
+        super(HttpsBackend, self).__init__(netloc, resolver)
+        self.hostname = url.hostname
+        self.server = server
+        self.path = url.path or '/dns-query'
+        self.close_after = False
+
+    def _send_queries(self, queries):
+        requests = []
+        for query in queries:
+            headers = ("POST {} HTTP/1.1\r\nHost: {}\r\nContent-Type: application/dns-message\r\n"
+                       "Accept: application/dns-message\r\nContent-Length: {}\r\n\r\n").format(
+                           self.path, self.hostname, len(query))
+            requests.append(headers.encode('ascii') + query)
+        self.sock.sendall(b''.join(requests))
 
+    def _read_line(self):
+        while b'\r\n' not in self.buffer:
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error("conexão fechada pelo servidor")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line.decode('latin-1')
+
+    def _read_answer(self):
+        status = self._read_line().split(' ', 2)
+        headers = {}
+        while True:
+            line = self._read_line()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = b''
+            while True:
+                size = int(self._read_line().split(';')[0], 16)
+                if not size:
+                    self._read_line()
+                    break
+                body += self._recv_exact(size)
+                self._recv_exact(2)
+        else:
+            body = self._recv_exact(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            self.close_after = True
+        if len(status) < 2 or status[1] != '200':
+            raise socket.error("DoH respondeu HTTP {}".format(' '.join(status[1:])))
+        return body
+
+    def exchange(self, queries, timeout):
+        try:
+            return super(HttpsBackend, self).exchange(queries, timeout)
+        finally:
+            if self.close_after:
+                with self.lock:
+                    self.close()
+                self.close_after = False
+
+
+BACKENDS = {'tcp': TcpBackend, 'tls': TlsBackend, 'https': HttpsBackend}
+
+
+
+class customdns(object):
+    """Resolver DNS do processo (singleton).
+
+    customdns() pode ser chamado quantas vezes for preciso: sempre devolve a
+    mesma instância, com um único cache em memória, e instala o resolver em
+    socket.getaddrinfo só uma vez. uninstall() restaura o getaddrinfo original.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        with cls._instance_lock:
+            if cls._instance is None:
+                instance = super(customdns, cls).__new__(cls)
+                instance._initialized = False
+                cls._instance = instance
+            return cls._instance
 
-class customdns:
     def __init__(self, cache_file=CACHE_FILE, cache_ttl=3600):
-        self.dns_server = [
-            '208.67.222.222',# OpenDNS
-            '208.67.220.220',# OpenDNS
-            '1.1.1.1',       # Cloudflare
-            '8.8.8.8'        # Google DNS
-        ]
-        self.original_getaddrinfo = socket.getaddrinfo
+        with self._instance_lock:
+            if not self._initialized:
+                self._setup(cache_file, cache_ttl)
+                self._initialized = True
+        self.install()
+
+    def _setup(self, cache_file, cache_ttl):
+        self.backend = 'udp'  # udp, tcp, tls (DNS over TLS) ou https (DNS over HTTPS); veja set_backend()
+        self.dns_server = list(DNS_SERVERS[self.backend])
+        self.backends = {}
+        self.tls_cafile = None  # CA extra para tls/https (servidor de testes com certificado próprio)
+        self.original_getaddrinfo = None
         self.cache_file = cache_file
-        self.cache_ttl = cache_ttl  # Tempo de expiração em segundos
+        self.cache_ttl = cache_ttl  # TTL máximo em segundos (o TTL da resposta é limitado a este valor)
+        self.min_ttl = 60  # TTL mínimo, evita reconsultar CDNs com TTL muito curto
+        self.negative_ttl = 30  # NXDOMAIN ou domínio sem registro A
+        self.failure_ttl = 10  # Nenhum servidor respondeu: vai direto para o getaddrinfo do sistema
+        self.stale_ttl = 300  # Domínios "quentes" vencidos ainda são servidos enquanto atualizam
+        self.hot_hits = 2
+        self.flush_delay = 2  # Gravação em disco agrupada (write-behind)
+        self.flush_batch = 20
         self.cache = self._load_cache()
+        self.cache_lock = threading.RLock()
+        self._save_timer = None
+        self._dirty = 0
+        self.refreshing = set()
+        atexit.register(self.flush)
+        # Warm-up: hosts conhecidos são resolvidos antes de serem usados e renovados antes de vencer.
+        # Vêm das listas configuradas (passadas a warm_up) e ficam marcados como 'warm' no cache em disco
+        self.known_hosts = set(domain for domain, data in self.cache.items() if data.get('warm'))
+        self.refresh_ahead = 0.2  # Renova quem está na última fração do TTL (ou a menos de refresh_interval do fim)
+        self.refresh_interval = 30  # Nem renova de novo quem foi resolvido há menos que isso
+        self.warmup_workers = 8
+        self.warm_stop = threading.Event()
+        self._refresher = None
         self.debug_mode = False
         self.mode_logger = True
+        self.race_mode = True  # Consulta todos os servidores ao mesmo tempo e usa a primeira resposta
+        self.query_timeout = 3
+        self.ipv6 = True  # Pergunta também pelos registros AAAA
+        self.resolution_delay = 0.05  # Espera pela outra família depois da primeira resposta (RFC 8305)
+        self.connect_stagger = 0.25  # Intervalo entre tentativas de conexão paralelas
+        self.original_create_connection = None
+        self.server_stats = dict((server, {'latency': None, 'ok': 0, 'fail': 0}) for server in self.dns_server)
+        self.stats_lock = threading.Lock()
+
+    def set_backend(self, backend, servers=None):
+        """Troca o transporte (udp, tcp, tls, https) e, opcionalmente, os servidores"""
+        if backend != 'udp' and backend not in BACKENDS:
+            raise ValueError("backend DNS desconhecido: {}".format(backend))
+        with self.stats_lock:
+            for connection in self.backends.values():
+                connection.close()
+            self.backends = {}
+            self.backend = backend
+            self.dns_server = list(servers or DNS_SERVERS[backend])
+            self.server_stats = dict((server, {'latency': None, 'ok': 0, 'fail': 0}) for server in self.dns_server)
+
+    def _backend_for(self, server):
+        with self.stats_lock:
+            connection = self.backends.get(server)
+            if connection is None:
+                connection = self.backends[server] = BACKENDS[self.backend](server, self)
+            return connection
+
+    @property
+    def installed(self):
+        return self.original_getaddrinfo is not None and socket.getaddrinfo == self._resolver
+
+    def install(self):
+        """Override DNS: coloca o resolver em socket.getaddrinfo (idempotente)"""
+        with self._instance_lock:
+            if self.installed:
+                return
+            self.original_getaddrinfo = socket.getaddrinfo
+            socket.getaddrinfo = self._resolver
+            try:
+                from urllib3.util import connection
+            except ImportError:
+                try:
+                    from requests.packages.urllib3.util import connection
+                except ImportError:
+                    connection = None
+            if connection is not None and connection.create_connection != self.connect_racing:
+                self.original_create_connection = connection.create_connection
+                connection.create_connection = self.connect_racing
 
-        # Override DNS
-        socket.getaddrinfo = self._resolver
+    def uninstall(self):
+        """Restaura o socket.getaddrinfo original"""
+        with self._instance_lock:
+            if self.installed:
+                socket.getaddrinfo = self.original_getaddrinfo
+            self.original_getaddrinfo = None
+            if self.original_create_connection is not None:
+                sys.modules[self.original_create_connection.__module__].create_connection = \
+                    self.original_create_connection
+                self.original_create_connection = None
+            for connection in self.backends.values():
+                connection.close()
+            self.warm_stop.set()
+            self._refresher = None
+        self.flush()
 
     def _load_cache(self):
         """Carrega o cache do arquivo JSON, se existir"""
@@ -51,24 +354,69 @@ class customdns:
             if os.path.exists(self.cache_file):
                 with open(self.cache_file, 'r') as f:
                     cache = json.load(f)
-                    # Remove entradas expiradas
-                    current_time = time.time()
+                    # Remove entradas vencidas há mais tempo que a janela de stale
+                    oldest = time.time() - self.stale_ttl
+                    for data in cache.values():
+                        if 'ip' in data:  # Formato antigo, um único IPv4
+                            data['ips'] = [data.pop('ip')] if data['ip'] else []
+                    # Hosts do warm-up ficam mesmo vencidos: são renovados logo na abertura
                     return {
                         domain: data for domain, data in cache.items()
-                        if data['expires'] > current_time
+                        if data.get('ips') and (data['expires'] > oldest or data.get('warm'))
                     }
             return {}
         except Exception as e:
             logging.error("Erro ao carregar cache: {}".format(e))
             return {}
 
-    def _save_cache(self):
-        """Salva o cache no arquivo JSON"""
+    def _schedule_save(self):
+        """Marca o cache como alterado; a gravação acontece depois, em lote"""
+        with self.cache_lock:
+            self._dirty += 1
+            if self._dirty >= self.flush_batch:
+                flush_now = True
+            else:
+                flush_now = False
+                if self._save_timer is None:
+                    self._save_timer = threading.Timer(self.flush_delay, self.flush)
+                    self._save_timer.daemon = True
+                    self._save_timer.start()
+        if flush_now:
+            self.flush()
+
+    def flush(self):
+        """Grava o cache pendente no arquivo JSON"""
+        with self.cache_lock:
+            if self._save_timer is not None:
+                self._save_timer.cancel()
+                self._save_timer = None
+            if not self._dirty:
+                return
+            pending = self._dirty
+            # Cópia das entradas: _cached continua alterando as originais enquanto o JSON é gravado.
+            # Entradas negativas ficam só na memória
+            snapshot = dict((domain, dict(data)) for domain, data in self.cache.items() if data['ips'])
+        if self._save_cache(snapshot):
+            with self.cache_lock:
+                # Só as alterações gravadas saem da conta; as feitas durante a gravação ficam pendentes
+                self._dirty = max(0, self._dirty - pending)
+
+    def _save_cache(self, cache):
+        """Salva o cache no arquivo JSON; False se não conseguiu"""
         try:
-            with open(self.cache_file, 'w') as f:
-                json.dump(self.cache, f, indent=2)
+            tmp = self.cache_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(cache, f)
+            if hasattr(os, 'replace'):
+                os.replace(tmp, self.cache_file)
+            else:
+                if os.path.exists(self.cache_file):
+                    os.remove(self.cache_file)
+                os.rename(tmp, self.cache_file)
+            return True
         except Exception as e:
             logging.error("Erro ao salvar cache: {}".format(e))
+            return False
 
     def is_valid_ipv4(self, ip):
         try:
@@ -86,7 +434,7 @@ class customdns:
         except socket.error:
             return False
 
-    def _build_dns_query(self, domain):
+    def _build_dns_query(self, domain, qtype=QTYPE_A):
         transaction_id = random.randint(0, 65535)
         flags = 0x0100
         questions = 1
@@ -97,85 +445,489 @@ class customdns:
         else:
             qname = b''.join(bytes([len(part)]) + part.encode() for part in domain.split('.')) + b'\x00'
 
-        qtype = 1  # A record
         qclass = 1  # IN
         question = qname + struct.pack('>HH', qtype, qclass)
         return header + question
 
+    def _skip_name(self, data, offset):
+        """Pula um nome (rótulos e/ou ponteiro de compressão) e devolve o offset seguinte"""
+        while True:
+            length = data[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xc0 == 0xc0:  # Ponteiro: 2 bytes e o nome termina aqui
+                return offset + 2
+            offset += 1 + length
+
     def _parse_dns_response(self, data):
-        answer_count = struct.unpack(">H", data[6:8])[0]
+        """Devolve (rcode, endereços, ttl) com todos os registros A/AAAA da resposta"""
+        data = bytearray(data)
+        rcode = data[3] & 0x0f
+        question_count, answer_count = struct.unpack(">HH", bytes(data[4:8]))
         offset = 12
-        while data[offset] != 0:
-            offset += 1
-        offset += 5  # null + qtype + qclass
+        for _ in range(question_count):
+            offset = self._skip_name(data, offset) + 4  # qtype + qclass
 
+        addresses = []
+        ttl = None
         for _ in range(answer_count):
-            offset += 2  # name (pointer)
-            rtype, rclass, ttl, rdlength = struct.unpack(">HHIH", data[offset:offset+10])
+            offset = self._skip_name(data, offset)
+            rtype, rclass, record_ttl, rdlength = struct.unpack(">HHIH", bytes(data[offset:offset+10]))
             offset += 10
-            if rtype == 1 and rdlength == 4:  # A record
-                ip_parts = struct.unpack(">BBBB", data[offset:offset+4])
-                return ".".join(map(str, ip_parts))
+            rdata = bytes(data[offset:offset+rdlength])
             offset += rdlength
-        return None
+            if len(rdata) != rdlength:
+                break  # Resposta truncada
+            if rtype == QTYPE_A and rdlength == 4:
+                addresses.append(socket.inet_ntoa(rdata))
+            elif rtype == QTYPE_AAAA and rdlength == 16:
+                addresses.append(self._ipv6_to_text(rdata))
+            else:
+                continue  # CNAME e outros: os endereços da cadeia vêm nos registros seguintes
+            ttl = record_ttl if ttl is None else min(ttl, record_ttl)
+        return rcode, addresses, ttl or 0
 
-    def resolve(self, domain, dns_custom):
-        # Verifica o cache
-        if domain in self.cache:
-            if self.cache[domain]['expires'] > time.time():
+    def _ipv6_to_text(self, packed):
+        if hasattr(socket, 'inet_ntop'):
+            return socket.inet_ntop(socket.AF_INET6, packed)
+        # Python 2 no Windows não tem inet_ntop
+        return ':'.join('{:x}'.format(group) for group in struct.unpack('>8H', packed))
+
+    def _cached(self, domain):
+        """Consulta o cache: devolve (encontrado, endereços); lista vazia = cache negativo"""
+        now = time.time()
+        with self.cache_lock:
+            entry = self.cache.get(domain)
+            if entry is None:
+                return False, []
+            if entry['expires'] > now:
+                entry['hits'] = entry.get('hits', 0) + 1
                 if self.mode_logger:
-                    logging.info("Cache hit for {}: {}".format(domain, self.cache[domain]['ip']))
-                return self.cache[domain]['ip']
+                    logging.info("Cache hit for {}: {}".format(domain, entry['ips']))
+                return True, entry['ips']
+            if entry['ips'] and entry.get('hits', 0) >= self.hot_hits and now - entry['expires'] < self.stale_ttl:
+                # Stale-while-revalidate: responde com o IP antigo e atualiza em segundo plano
+                entry['hits'] += 1
+                self._refresh(domain)
+                if self.mode_logger:
+                    logging.info("Cache stale for {}: {}".format(domain, entry['ips']))
+                return True, entry['ips']
+            # Remove entrada expirada
+            del self.cache[domain]
+            if entry['ips']:
+                self._schedule_save()
+        return False, []
+
+    def _store(self, domain, ips, ttl):
+        """Guarda a resposta pelo TTL dado (já limitado por _combine); lista vazia = cache negativo"""
+        with self.cache_lock:
+            if ips:
+                previous = self.cache.get(domain) or {}
+                self.cache[domain] = {
+                    'ips': ips,
+                    'expires': time.time() + ttl,
+                    'ttl': ttl,
+                    'hits': previous.get('hits', 0)
+                }
+                if domain in self.known_hosts:
+                    self.cache[domain]['warm'] = True
+                self._schedule_save()
             else:
-                # Remove entrada expirada
-                del self.cache[domain]
-                self._save_cache()
+                self.cache[domain] = {'ips': [], 'expires': time.time() + ttl}
 
-        try:
-            domain_clean = domain.strip('.')
-            if self.mode_logger:
-                logging.debug("Resolvendo {} via DNS {}".format(domain_clean, dns_custom))
+    def _refresh(self, domain):
+        with self.cache_lock:
+            if domain in self.refreshing:
+                return
+            self.refreshing.add(domain)
+
+        def run():
+            try:
+                self._query(domain)
+            finally:
+                with self.cache_lock:
+                    self.refreshing.discard(domain)
+        t = threading.Thread(target=run)
+        t.daemon = True
+        t.start()
+
+    def warm_up(self, hosts=(), keep_fresh=False):
+        """Resolve em segundo plano os hosts conhecidos (mais hosts, nomes ou URLs) que não
+        estão no cache ou vencem em breve; keep_fresh continua renovando enquanto o processo durar"""
+        with self.cache_lock:
+            for host in hosts:
+                if '://' in host:
+                    host = urlparse(host).hostname or ''
+                host = host.strip('.').lower()
+                if host and not self.is_valid_ipv4(host) and not self.is_valid_ipv6(host):
+                    self.known_hosts.add(host)
+                    entry = self.cache.get(host)
+                    if entry and entry['ips'] and not entry.get('warm'):
+                        entry['warm'] = True
+                        self._schedule_save()
+        pending = self._expiring_hosts()
+        if pending:
+            # Daemon: uma chamada curta do plugin não espera o DNS para terminar
+            t = threading.Thread(target=self._warm, args=(pending,))
+            t.daemon = True
+            t.start()
+        if keep_fresh:
+            with self.cache_lock:
+                if self._refresher is None:
+                    self.warm_stop.clear()
+                    self._refresher = threading.Thread(target=self._keep_fresh)
+                    self._refresher.daemon = True
+                    self._refresher.start()
+
+    def _expiring_hosts(self):
+        now = time.time()
+        with self.cache_lock:
+            pending = []
+            for host in self.known_hosts:
+                entry = self.cache.get(host)
+                if entry and not entry['ips'] and entry['expires'] > now:
+                    continue  # Falha recente em cache negativo
+                if entry and entry['ips']:
+                    ttl = entry.get('ttl', self.min_ttl)
+                    if now - (entry['expires'] - ttl) < self.refresh_interval:
+                        continue  # Resolvido há pouco
+                    if entry['expires'] - now > max(ttl * self.refresh_ahead, self.refresh_interval):
+                        continue  # Ainda longe de vencer
+                pending.append(host)
+            return pending
+
+    def _warm(self, hosts):
+        """Resolve hosts em paralelo (até warmup_workers consultas ao mesmo tempo) e grava o cache"""
+        hosts = list(hosts)
+        if self.mode_logger:
+            logging.debug("Warm-up DNS de {} hosts".format(len(hosts)))
 
-            query = self._build_dns_query(domain_clean)
+        def worker():
+            while True:
+                with self.cache_lock:
+                    while hosts and hosts[-1] in self.refreshing:
+                        hosts.pop()  # Já está sendo resolvido por outra thread
+                    if not hosts:
+                        return
+                    host = hosts.pop()
+                    self.refreshing.add(host)
+                try:
+                    self._query(host)
+                except Exception as e:
+                    if self.mode_logger:
+                        logging.error("Erro no warm-up de {}: {}".format(host, e))
+                finally:
+                    with self.cache_lock:
+                        self.refreshing.discard(host)
 
-            if self.is_valid_ipv6(dns_custom):
-                s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
-                addr = (dns_custom, 53, 0, 0)
+        workers = [threading.Thread(target=worker) for _ in range(min(self.warmup_workers, len(hosts)))]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+        self.flush()
+
+    def _keep_fresh(self):
+        while not self.warm_stop.wait(self.refresh_interval):
+            pending = self._expiring_hosts()
+            if pending:
+                self._warm(pending)
+
+    def _record_server(self, server, latency=None):
+        """Atualiza latência (média móvel) e falhas de um servidor; latency None = falha"""
+        with self.stats_lock:
+            stats = self.server_stats.setdefault(server, {'latency': None, 'ok': 0, 'fail': 0})
+            if latency is None:
+                stats['fail'] += 1
             else:
-                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                addr = (dns_custom, 53)
+                stats['ok'] += 1
+                stats['latency'] = latency if stats['latency'] is None else 0.3 * latency + 0.7 * stats['latency']
 
-            s.settimeout(3)
-            s.sendto(query, addr)
-            data, _ = s.recvfrom(512)
-            s.close()
+    def ordered_servers(self):
+        """Servidores do mais rápido e confiável para o pior"""
+        def score(server):
+            stats = self.server_stats.get(server) or {'latency': None, 'ok': 0, 'fail': 0}
+            attempts = stats['ok'] + stats['fail']
+            failure_rate = float(stats['fail']) / attempts if attempts else 0.0
+            latency = stats['latency'] if stats['latency'] is not None else 0.5
+            return latency * (1 + 4 * failure_rate)
+        with self.stats_lock:
+            return sorted(self.dns_server, key=score)
 
-            ip = self._parse_dns_response(data)
-            if ip:
-                # Salva no cache com timestamp de expiração
-                self.cache[domain] = {
-                    'ip': ip,
-                    'expires': time.time() + self.cache_ttl
-                }
-                self._save_cache()
+    def lookup(self, domain):
+        """Endereços de domain pelo cache ou pela rede; lista vazia se os servidores não souberem resolver"""
+        found, ips = self._cached(domain)
+        if found:
+            return ips
+        return self._query(domain)
+
+    def _query(self, domain):
+        """Consulta a rede sem olhar o cache e guarda o resultado, positivo ou negativo"""
+        if self.race_mode:
+            answer = self._ask(domain)
+        else:
+            answer = None
+            for dns_server in self.ordered_servers():
+                answer = self._ask(domain, [dns_server])
+                if answer:
+                    break
+        if not answer:
+            self._store(domain, [], self.failure_ttl)
+            return []
+        ips, ttl = answer
+        self._store(domain, ips, ttl if ips else self.negative_ttl)
+        return ips
+
+    def _ask(self, domain, servers=None):
+        """(endereços, ttl) pelo backend configurado, ou None se nenhum servidor responder"""
+        if self.backend == 'udp':
+            return self._race(domain, servers)
+        return self._exchange(domain, servers)
+
+    def _build_queries(self, domain):
+        """{transaction id: (qtype, consulta)} para A e, com ipv6, AAAA"""
+        domain_clean = domain.strip('.')
+        qtypes = (QTYPE_A, QTYPE_AAAA) if self.ipv6 else (QTYPE_A,)
+        queries = {}
+        while len(queries) < len(qtypes):
+            query = self._build_dns_query(domain_clean, qtypes[len(queries)])
+            if query[:2] not in queries:
+                queries[query[:2]] = (qtypes[len(queries)], query)
+        return queries
+
+    def _interleave(self, ipv4, ipv6):
+        """Alterna as famílias (RFC 8305), começando por IPv4"""
+        ordered = []
+        for i in range(max(len(ipv4), len(ipv6))):
+            ordered.extend(ipv4[i:i+1] + ipv6[i:i+1])
+        return ordered
+
+    def _combine(self, domain, answers):
+        """Junta as respostas {qtype: (rcode, endereços, ttl)} em (endereços, ttl)"""
+        if QTYPE_A not in answers and not any(ips for rcode, ips, ttl in answers.values()):
+            return None
+        if any(rcode == 3 for rcode, ips, ttl in answers.values()):
+            return [], 0  # NXDOMAIN
+        ips = self._interleave(answers.get(QTYPE_A, (0, [], 0))[1], answers.get(QTYPE_AAAA, (0, [], 0))[1])
+        ttl = 0
+        if ips:
+            ttl = max(self.min_ttl, min(min(ttl for rcode, addresses, ttl in answers.values() if addresses),
+                                        self.cache_ttl))
+            if QTYPE_A not in answers:
+                # Só IPv6 porque o A não chegou a tempo: fica pouco no cache, para o A ser consultado logo
+                ttl = self.failure_ttl
+        if self.mode_logger:
+            logging.debug("Resolved {} to {}".format(domain, ips))
+        return ips, ttl
+
+    def _exchange(self, domain, servers=None):
+        """Backends com conexão (tcp, tls, https): o melhor servidor primeiro, os outros se ele falhar"""
+        queries = self._build_queries(domain)
+        for server in servers or self.ordered_servers():
+            started = time.time()
+            try:
+                replies = self._backend_for(server).exchange([query for qtype, query in queries.values()],
+                                                             self.query_timeout)
+                answers = {}
+                for transaction_id, (qtype, query) in queries.items():
+                    rcode, ips, ttl = self._parse_dns_response(replies[transaction_id])
+                    if rcode not in (0, 3):
+                        raise socket.error("rcode {}".format(rcode))
+                    answers[qtype] = (rcode, ips, ttl)
+            except (socket.error, KeyError, IndexError, struct.error, ValueError) as e:
+                self._record_server(server)
                 if self.mode_logger:
-                    logging.debug("Resolved {} to {}".format(domain, ip))
-                return ip
+                    logging.debug("Falha ao resolver {} via {}: {}".format(domain, server, e))
+                continue
+            self._record_server(server, time.time() - started)
+            return self._combine(domain, answers)
+        return None
+
+    def _race(self, domain, servers=None):
+        """Pergunta A (e AAAA) a todos os servidores ao mesmo tempo: (endereços, ttl) ou None se ninguém responder"""
+        queries = self._build_queries(domain)
+        sockets = {}
+        sent = {}
+        addresses = {}
+        try:
+            for server in servers or self.ordered_servers():
+                host, port, _ = split_server(server)
+                family = socket.AF_INET6 if self.is_valid_ipv6(host) else socket.AF_INET
+                try:
+                    if family not in sockets:
+                        sockets[family] = socket.socket(family, socket.SOCK_DGRAM)
+                        sockets[family].setblocking(False)
+                    addr = (host, port, 0, 0) if family == socket.AF_INET6 else (host, port)
+                    addresses[(host, port)] = server
+                    for transaction_id, (qtype, query) in queries.items():
+                        sockets[family].sendto(query, addr)
+                        sent[(server, transaction_id)] = time.time()
+                except socket.error as e:
+                    self._record_server(server)
+                    if self.mode_logger:
+                        logging.debug("Falha ao enviar para {}: {}".format(server, e))
+            deadline = time.time() + self.query_timeout
+            answers = {}
+            self._collect(sockets, sent, addresses, queries, deadline, answers)
+            if sent:
+                # Os servidores mais lentos continuam sendo medidos em segundo plano
+                t = threading.Thread(target=self._collect, args=(sockets, sent, addresses, queries, deadline))
+                t.daemon = True
+                t.start()
+                sockets = {}
+            return self._combine(domain, answers)
         except Exception as e:
             if self.mode_logger:
-                logging.error("Erro ao resolver {} com {}: {}".format(domain, dns_custom, e))
+                logging.error("Erro ao resolver {}: {}".format(domain, e))
+        finally:
+            for s in sockets.values():
+                s.close()
         return None
 
+    def _collect(self, sockets, sent, addresses, queries, deadline, answers=None):
+        """Lê respostas até o prazo, registrando latência e falhas de cada servidor.
+
+        Com answers, guarda a primeira resposta de cada tipo e volta assim que
+        todos os tipos chegaram (ou resolution_delay depois de um A com endereços).
+        Um AAAA que chega primeiro não encerra a espera: o A é aguardado até o prazo.
+        """
+        stop_at = deadline
+        try:
+            while sent and time.time() < stop_at:
+                if answers is not None and len(answers) == len(queries):
+                    return
+                readable = select.select(list(sockets.values()), [], [], max(0, stop_at - time.time()))[0]
+                for s in readable:
+                    try:
+                        data, addr = s.recvfrom(512)
+                    except socket.error:
+                        continue
+                    server = addresses.get(addr[:2])
+                    if (server, data[:2]) not in sent:
+                        continue  # Resposta atrasada de outra consulta ou de origem desconhecida
+                    latency = time.time() - sent.pop((server, data[:2]))
+                    try:
+                        rcode, ips, ttl = self._parse_dns_response(data)
+                    except (IndexError, struct.error):
+                        rcode = -1  # Resposta malformada
+                    if rcode not in (0, 3):  # SERVFAIL, REFUSED...
+                        self._record_server(server)
+                        continue
+                    self._record_server(server, latency)
+                    qtype = queries[data[:2]][0]
+                    if answers is not None and qtype not in answers:
+                        answers[qtype] = (rcode, ips, ttl)
+                        if ips and qtype == QTYPE_A:
+                            stop_at = min(stop_at, time.time() + self.resolution_delay)
+            if time.time() < deadline:
+                return  # Saiu antes do prazo: quem falta ainda é medido em segundo plano
+            # Quem não respondeu dentro do prazo conta como falha
+            for server, transaction_id in list(sent):
+                self._record_server(server)
+            sent.clear()
+        finally:
+            if answers is None:
+                for s in sockets.values():
+                    s.close()
+
+    def resolve(self, domain, dns_custom):
+        """Resolve domain com um único servidor e devolve o primeiro IP"""
+        found, ips = self._cached(domain)
+        if found:
+            return ips[0] if ips else None
+        answer = self._ask(domain, [dns_custom])
+        if answer:
+            self._store(domain, answer[0], answer[1] if answer[0] else self.negative_ttl)
+            return answer[0][0] if answer[0] else None
+        return None
+
+    def connect_racing(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None,
+                       socket_options=None):
+        """create_connection com happy eyeballs (RFC 8305).
+
+        Tenta os endereços em paralelo, começando um novo a cada connect_stagger
+        segundos (ou logo que o anterior falhar), e fica com o primeiro que conectar.
+        """
+        host, port = address
+        if host.startswith('['):
+            host = host.strip('[]')
+        if not isinstance(timeout, (int, float)):
+            timeout = socket.getdefaulttimeout()
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        deadline = time.time() + timeout if timeout is not None else None
+        pending = {}
+        error = None
+        next_start = 0
+        try:
+            while infos or pending:
+                now = time.time()
+                if deadline is not None and now >= deadline:
+                    break
+                if infos and (not pending or now >= next_start):
+                    family, socktype, proto, _, sockaddr = infos.pop(0)
+                    sock = None
+                    try:
+                        sock = socket.socket(family, socktype, proto)
+                        for option in socket_options or ():
+                            sock.setsockopt(*option)
+                        if source_address:
+                            sock.bind(source_address)
+                        sock.setblocking(False)
+                        err = sock.connect_ex(sockaddr)
+                        if err and err not in CONNECT_IN_PROGRESS:
+                            raise socket.error(err, os.strerror(err))
+                        pending[sock] = sockaddr
+                        next_start = now + self.connect_stagger
+                    except socket.error as e:
+                        error = e
+                        if sock is not None:
+                            sock.close()
+                    continue
+                wait = next_start - now if infos else None
+                if deadline is not None:
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                candidates = list(pending)
+                _, writable, failed = select.select([], candidates, candidates, wait)
+                for sock in set(writable) | set(failed):
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if not err and sock not in failed:
+                        sockaddr = pending.pop(sock)
+                        sock.settimeout(timeout)
+                        if self.mode_logger and len(candidates) > 1:
+                            logging.debug("Conectado a {} ({})".format(sockaddr[0], host))
+                        return sock
+                    error = socket.error(err, os.strerror(err)) if err else socket.error("connect failed")
+                    del pending[sock]
+                    sock.close()
+                    next_start = 0  # Falhou: tenta o próximo endereço agora
+        finally:
+            for sock in pending:
+                sock.close()
+        raise error or socket.timeout("timed out")
+
+    def _addrinfo(self, ips, port, family=0, socktype=0, proto=0, *args, **kwargs):
+        """Monta a lista no formato de getaddrinfo, respeitando a família pedida"""
+        socktype = socktype or socket.SOCK_STREAM
+        proto = proto or (socket.IPPROTO_UDP if socktype == socket.SOCK_DGRAM else socket.IPPROTO_TCP)
+        result = []
+        for ip in ips:
+            if ':' in ip:
+                if family in (0, socket.AF_INET6):
+                    result.append((socket.AF_INET6, socktype, proto, '', (ip, port, 0, 0)))
+            elif family in (0, socket.AF_INET):
+                result.append((socket.AF_INET, socktype, proto, '', (ip, port)))
+        return result
+
     def _resolver(self, host, port, *args, **kwargs):
         try:
             if self.is_valid_ipv4(host) or self.is_valid_ipv6(host):
                 if self.mode_logger:
                     logging.debug("Bypass: {} já é IP".format(host))
-                return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (host, port))]
-            for dns_server in self.dns_server:
-                ip = self.resolve(host, dns_server)
-                if ip:
-                    return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', (ip, port))]
+                return (self.original_getaddrinfo or socket.getaddrinfo)(host, port, *args, **kwargs)
+            result = self._addrinfo(self.lookup(host), port, *args, **kwargs)
+            if result:
+                return result
 
             if self.mode_logger:
                 logging.warning("Falha ao resolver {}, fallback para getaddrinfo".format(host))
@@ -183,6 +935,4 @@ class customdns:
             if self.mode_logger:
                 logging.error("Erro no resolver para {}: {}".format(host, e))
 
-        return self.original_getaddrinfo(host, port, *args, **kwargs)
-
-
+        return (self.original_getaddrinfo or socket.getaddrinfo)(host, port, *args, **kwargs)
@@ -8,11 +8,19 @@ import time
 import logging
 import threading
 import socket
+import hashlib
+import mmap
+import random
+import bisect
+import select
+import shutil
+from collections import OrderedDict, deque
 try:
-    from kodi_six import xbmc, xbmcaddon
+    from kodi_six import xbmc, xbmcaddon, xbmcvfs
 except ImportError:
     import xbmc
     import xbmcaddon
+    import xbmcvfs
 # try:
 #     from resources.lib.dns import customdns
 # except:
@@ -21,23 +29,124 @@ try:
     from dns import *
 except:
     pass
-from requests.exceptions import ConnectionError, RequestException
+from requests.exceptions import RequestException
+from requests.structures import CaseInsensitiveDict
+from requests.adapters import HTTPAdapter
+try:
+    from urllib3.connection import HTTPConnection
+except ImportError:
+    from requests.packages.urllib3.connection import HTTPConnection
 try:
     from urllib3.exceptions import IncompleteRead
 except ImportError:
     from urllib2 import HTTPError as IncompleteRead  # Python 2 fallback
-from six.moves.urllib.parse import unquote_plus
+try:
+    from urllib3.exceptions import HTTPError as UpstreamReadError
+except ImportError:
+    from requests.packages.urllib3.exceptions import HTTPError as UpstreamReadError
+from six.moves.urllib.parse import unquote_plus, urlparse
+from six.moves import queue, http_client
 
 # Configuration
 PORT = 8599
+# Proxy engine: 'pool' serves connections from a fixed set of worker threads,
+# 'thread' keeps the legacy thread-per-connection behaviour.
+PROXY_ENGINE = 'pool'
+POOL_WORKERS = 32       # Max connections served concurrently
+POOL_QUEUE_SIZE = 128   # Accepted connections waiting for a free worker
+ACCEPT_BACKLOG = 128    # Kernel accept queue for the listening socket
+CLIENT_TIMEOUT = 5      # Socket timeout while reading a request or sending a response
+KEEPALIVE_TIMEOUT = 15  # Idle time allowed between requests on a persistent connection
+KEEPALIVE_BUSY_TIMEOUT = 0.5  # ... cut to this while other connections wait for a pool worker
+KEEPALIVE_POLL = 0.25   # How often an idle connection checks the pool queue
+# Routes that stream until the client hangs up, served outside the pool so they don't pin workers
+ENDLESS_ROUTES = ('/tsdownloader', '/hlsts')
+ENDLESS_MAX = POOL_WORKERS  # Endless streams served at once; more get a 503
+MAX_REQUEST_HEAD = 65536
+# Upstream connection pool
+UPSTREAM_MAX_ORIGINS = 16     # Origins with a live session at once
+UPSTREAM_MAX_PER_HOST = 8     # Connections kept alive per upstream host
+UPSTREAM_IDLE_TIMEOUT = 90    # Seconds before an unused origin session is closed
+ORIGIN_MAX_INFLIGHT = 6       # Concurrent upstream requests per origin, queued fairly beyond that (0 = unlimited)
+ORIGIN_QUEUE_TIMEOUT = 15     # Max wait for a slot before the request fails with OriginBusy
+ORIGIN_HOLD_MAX_BODY = 16 * 1024 * 1024  # Streamed bodies larger than this (or endless) free their slot at the headers
+ORIGIN_COOLDOWN = 10          # Rest after a 429 without Retry-After, doubled while they continue
+ORIGIN_MAX_COOLDOWN = 120
+ORIGIN_WINDOW = 60            # Seconds of history behind latency and error rates
+# Segment cache
+SEGMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory budget for all cached segments
+SEGMENT_CACHE_MAX_ITEM = 16 * 1024 * 1024   # Bodies larger than this are never cached
+SEGMENT_CACHE_TTL = 120                     # Seconds a cached segment stays valid
+# Segment prefetch
+PREFETCH_SEGMENTS = 3     # Segments fetched ahead after serving a media playlist (0 disables)
+PREFETCH_MAX_BPS = 0      # Bandwidth ceiling shared by prefetch downloads, bytes/s (0 = unlimited)
+PREFETCH_WORKERS = 2
+# Playlist cache
+PLAYLIST_CACHE_MAX_ENTRIES = 64
+PLAYLIST_VOD_TTL = 300        # Playlists with #EXT-X-ENDLIST never change
+PLAYLIST_MASTER_TTL = 30      # Master playlists carry no target duration
+PLAYLIST_FLIGHT_TIMEOUT = 15  # Max wait for a coalesced playlist fetch
+SEGMENT_FLIGHT_TIMEOUT = 20   # Max wait for the headers of a segment another client is downloading
+# Media relay: 'buffer' reads the upstream into one reusable buffer with adaptive
+# read sizes, 'chunks' keeps the legacy iter_content(4096) loop.
+RELAY_MODE = 'buffer'
+RELAY_MIN_READ = 64 * 1024
+RELAY_MAX_READ = 1024 * 1024
+CLIENT_SNDBUF = 1024 * 1024
+UPSTREAM_RCVBUF = 1024 * 1024
+# MP4 disk cache: sparse per-URL files in the addon profile
+DISK_CACHE_ENABLED = True
+DISK_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # Disk quota, whole files are evicted LRU first
+DISK_CACHE_DIRNAME = 'media_cache'
+# Parallel range downloads for MP4 hosts that throttle each connection
+ACCEL_ENABLED = False                  # Opt-in
+ACCEL_BLOCK_SIZE = 2 * 1024 * 1024     # Bytes requested per Range block
+ACCEL_CONNECTIONS = 4                  # Upper bound on concurrent block downloads
+ACCEL_REORDER_BLOCKS = 8               # Finished blocks held ahead of the client, bounds memory
+ACCEL_MIN_BYTES = 8 * 1024 * 1024      # Smaller bodies are relayed over one connection
+ACCEL_BLOCK_RETRIES = 4
+# /hlsretry retries
+RETRY_MAX_ATTEMPTS = 7
+RETRY_BASE_DELAY = 0.25   # First backoff, doubled per attempt with full jitter
+RETRY_MAX_DELAY = 3.0
+REQUEST_DEADLINE = 20     # Seconds a request may spend retrying before giving up
+LIVE_DEADLINE_FACTOR = 2  # Live segments give up after this many target durations
+RESUME_ATTEMPTS = 3       # Range re-requests allowed after an upstream body breaks off
+STITCH_LIVE_EDGE = 3        # Segments behind the end of a live playlist where stitching starts
+STITCH_STALL_TIMEOUT = 30   # A stitched stream ends after this long without a new segment
+BROADCAST_BUFFER_BYTES = 16 * 1024 * 1024  # Ring buffer shared by the clients of one /tsdownloader stream
+TIMESHIFT_MAX_BYTES = 512 * 1024 * 1024    # Disk ring per recorded channel, oldest segments dropped first
+TIMESHIFT_IDLE_TIMEOUT = 120               # Recording stops (and is deleted) once no player asked for this long
+TIMESHIFT_DIRNAME = 'timeshift'
+# Proxy-side adaptive bitrate: master playlists collapse to one virtual variant
+ABR_ENABLED = False       # Opt-in
+ABR_SAFETY = 0.8          # Fraction of the measured throughput a variant may use
+ABR_UP_BUFFER = 8         # Seconds buffered before stepping up a variant
+ABR_HOLD_BUFFER = 20      # Seconds buffered above which throughput dips don't force a step down
+ABR_MAX_SESSIONS = 16
+HEDGE_AFTER = 1.5         # Seconds without response headers before a second attempt is fired (0 disables)
+
+HTTP_REASONS = {
+    200: 'OK', 206: 'Partial Content', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 416: 'Range Not Satisfiable', 429: 'Too Many Requests',
+    500: 'Internal Server Error', 502: 'Bad Gateway', 503: 'Service Unavailable', 504: 'Gateway Timeout',
+}
+def http_reason(status):
+    """Reason phrase for a status line; upstream statuses may be ones HTTP_REASONS lacks."""
+    reason = HTTP_REASONS.get(status) or http_client.responses.get(status)
+    if reason:
+        return reason
+    return {2: 'OK', 3: 'Redirection', 4: 'Client Error'}.get(status // 100, 'Server Error')
+
+HOP_BY_HOP_HEADERS = ('host', 'connection', 'keep-alive', 'proxy-connection', 'te',
+                      'trailer', 'transfer-encoding', 'upgrade')
 DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/130.0.0.0 Safari/537.36"
 
 # Global caches and state
-IP_CACHE_TS = {}
-IP_CACHE_MP4 = {}
 AGENT_OF_CHAOS = {}
 COUNT_CLEAR = {}
 SHUTDOWN_EVENT = threading.Event()
+ENDLESS_SLOTS = threading.BoundedSemaphore(ENDLESS_MAX)
 
 # Logging setup
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -58,6 +167,516 @@ def monitor_kodi_shutdown(server):
     logging.info("Proxy server stopped due to Kodi shutdown.")
 
 
+class TunedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose upstream sockets get a larger receive buffer."""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = HTTPConnection.default_socket_options + [
+            (socket.SOL_SOCKET, socket.SO_RCVBUF, UPSTREAM_RCVBUF),
+        ]
+        return HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+class UpstreamPool(object):
+    """Process-wide requests sessions keyed by origin, so connections are reused across requests."""
+
+    def __init__(self, max_origins=UPSTREAM_MAX_ORIGINS, max_per_host=UPSTREAM_MAX_PER_HOST,
+                 idle_timeout=UPSTREAM_IDLE_TIMEOUT):
+        self.max_origins = max_origins
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.sessions = OrderedDict()  # origin -> [session, last_used]
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def origin(url):
+        parsed = urlparse(url)
+        scheme = (parsed.scheme or 'http').lower()
+        port = parsed.port or (443 if scheme == 'https' else 80)
+        return (scheme, (parsed.hostname or '').lower(), port)
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = TunedHTTPAdapter(pool_connections=4, pool_maxsize=self.max_per_host)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _expire(self, now):
+        for key in list(self.sessions.keys()):
+            session, last_used = self.sessions[key]
+            if now - last_used > self.idle_timeout:
+                del self.sessions[key]
+                session.close()
+
+    def session(self, url):
+        """Return the shared session for the origin of url."""
+        key = self.origin(url)
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            entry = self.sessions.pop(key, None) or [self._new_session(), now]
+            entry[1] = now
+            self.sessions[key] = entry
+            while len(self.sessions) > self.max_origins:
+                _, (oldest, _) = self.sessions.popitem(last=False)
+                oldest.close()
+        return entry[0]
+
+    def close_all(self):
+        with self.lock:
+            for session, _ in self.sessions.values():
+                session.close()
+            self.sessions.clear()
+
+UPSTREAM_POOL = UpstreamPool()
+
+TTFB_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Seconds
+THROUGHPUT_BUCKETS = (64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024,
+                      64 * 1024 * 1024)  # Bytes per second
+METRIC_ROUTES = ('/', '/stop', '/hlsretry', '/tsdownloader', '/hlsts', '/abr', '/abr/segment', '/timeshift',
+                 '/timeshift/segment', '/metrics', '/stats')
+METRIC_HELP = {  # Name -> (Prometheus type, help text)
+    'proxy_requests_total': ('counter', 'Client requests served, by route'),
+    'proxy_bytes_in_total': ('counter', 'Request head bytes read from clients, by route'),
+    'proxy_bytes_out_total': ('counter', 'Response body bytes sent to clients, by route'),
+    'proxy_upstream_responses_total': ('counter', 'Upstream responses by origin and status (error = no response)'),
+    'proxy_upstream_ttfb_seconds': ('histogram', 'Time to upstream response headers, by origin'),
+    'proxy_upstream_throughput_bytes_per_second': ('histogram', 'Throughput of complete upstream bodies, by origin'),
+    'proxy_resumes_total': ('counter', 'Broken upstream bodies resumed with a Range request'),
+    'proxy_retries_total': ('counter', 'Upstream request retries'),
+    'proxy_stream_bitrate_bps': ('gauge', 'Current bitrate of each active stream, by route, origin and stream id'),
+    'proxy_active_connections': ('gauge', 'Requests in progress, by route'),
+    'proxy_cache_hits_total': ('counter', 'Cache hits, by cache'),
+    'proxy_cache_misses_total': ('counter', 'Cache misses, by cache'),
+    'proxy_cache_hit_ratio': ('gauge', 'Cache hits over lookups, by cache'),
+    'proxy_cache_bytes': ('gauge', 'Bytes held, by cache'),
+}
+
+class Histogram(object):
+    """Cumulative-bucket histogram in the Prometheus layout."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """[(upper bound, observations at or below it)] ending with '+Inf'."""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((str(bound), total))
+        return result
+
+    def to_json(self):
+        return {'buckets': dict(self.cumulative()), 'sum': self.sum, 'count': self.count}
+
+class ProxyMetrics(object):
+    """In-memory counters and histograms behind /metrics and /stats.
+
+    Updates are a dict increment under one lock; everything derived (active
+    streams, cache sizes, origin health) is computed only when scraped.
+    """
+
+    def __init__(self):
+        self.counters = {}    # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.active = {}      # id(conn) -> conn with a request in progress
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def request_started(self, conn, route, target):
+        conn.route = route if route in METRIC_ROUTES else 'other'
+        conn.target = target
+        with self.lock:
+            self.active[id(conn)] = conn
+
+    def request_finished(self, conn):
+        labels = (('route', conn.route),)
+        with self.lock:
+            self.active.pop(id(conn), None)
+            for name, value in (('proxy_requests_total', 1), ('proxy_bytes_in_total', conn.bytes_in),
+                                ('proxy_bytes_out_total', conn.bytes_out)):
+                key = (name, labels)
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def _gauges(self):
+        """(name, labels, value) samples computed at scrape time."""
+        samples = []
+        with self.lock:
+            active = list(self.active.values())
+        routes = {}
+        for conn in active:
+            routes[conn.route] = routes.get(conn.route, 0) + 1
+            if conn.target:
+                samples.append(('proxy_stream_bitrate_bps', (('route', conn.route),) + stream_labels(conn.target),
+                                conn.current_bitrate()))
+        for route, count in routes.items():
+            samples.append(('proxy_active_connections', (('route', route),), count))
+        caches = [('segment', SEGMENT_CACHE.stats()), ('playlist', PLAYLIST_CACHE.stats())]
+        if DISK_CACHE.entries is not None:
+            caches.append(('disk', DISK_CACHE.stats()))
+        for name, stats in caches:
+            labels = (('cache', name),)
+            lookups = stats['hits'] + stats['misses']
+            samples.append(('proxy_cache_hits_total', labels, stats['hits']))
+            samples.append(('proxy_cache_misses_total', labels, stats['misses']))
+            samples.append(('proxy_cache_hit_ratio', labels, float(stats['hits']) / lookups if lookups else 0.0))
+            samples.append(('proxy_cache_bytes', labels, stats.get('bytes', 0)))
+        return samples
+
+    def snapshot(self):
+        """Everything as nested JSON-ready dicts."""
+        result = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        with self.lock:
+            counters = list(self.counters.items())
+            histograms = [(key, histogram.to_json()) for key, histogram in self.histograms.items()]
+        for (name, labels), value in counters:
+            result['counters'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in histograms:
+            histogram['labels'] = dict(labels)
+            result['histograms'].setdefault(name, []).append(histogram)
+        for name, labels, value in self._gauges():
+            result['gauges'].setdefault(name, []).append({'labels': dict(labels), 'value': value})
+        result['origins'] = ORIGIN_SCOREBOARD.snapshot()
+        result['broadcasts'] = BROADCAST_HUB.stats()
+        result['timeshift'] = TIMESHIFT.stats()
+        return result
+
+    def prometheus(self):
+        """Everything in the Prometheus text exposition format."""
+        def render(name, labels, value):
+            if labels:
+                label_text = ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels)
+                return '%s{%s} %s' % (name, label_text, value)
+            return '%s %s' % (name, value)
+
+        lines = []
+        declared = set()
+
+        def declare(name):
+            if name in declared:
+                return
+            declared.add(name)
+            kind, text = METRIC_HELP.get(name, ('untyped', None))
+            if text:
+                lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, histogram.cumulative(), histogram.sum, histogram.count)
+                                for key, histogram in self.histograms.items())
+        for (name, labels), value in counters:
+            declare(name)
+            lines.append(render(name, labels, value))
+        for (name, labels), buckets, total, count in histograms:
+            declare(name)
+            for bound, observed in buckets:
+                lines.append(render(name + '_bucket', labels + (('le', bound),), observed))
+            lines.append(render(name + '_sum', labels, total))
+            lines.append(render(name + '_count', labels, count))
+        for name, labels, value in sorted(self._gauges()):
+            declare(name)
+            lines.append(render(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+METRICS = ProxyMetrics()
+
+def origin_label(url):
+    return (('origin', '%s://%s:%d' % UpstreamPool.origin(url)),)
+
+def stream_labels(url):
+    """Labels naming a stream without exposing its URL, which often carries credentials or tokens."""
+    try:
+        origin = origin_label(url)
+    except ValueError:
+        origin = (('origin', 'invalid'),)
+    return origin + (('stream', hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]),)
+
+class OriginUnavailable(RequestException):
+    """The origin can't take this request now; retry_after is a hint in seconds for the client."""
+    retry_after = 1
+
+class OriginCoolingDown(OriginUnavailable):
+    """The origin asked us to back off for longer than the request can wait."""
+
+class OriginBusy(OriginUnavailable):
+    """Every request slot of the origin stayed taken for the whole queue timeout."""
+
+class OriginState(object):
+    """Rolling health and in-flight accounting of one upstream origin."""
+
+    def __init__(self, max_inflight=ORIGIN_MAX_INFLIGHT):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.waiters = deque()  # FIFO of tokens, so queued requests are served in arrival order
+        self.events = deque()   # (time, latency, outcome) with outcome 'ok', 'error' or 'limited'
+        self.cooldown_until = 0
+        self.cooldown = ORIGIN_COOLDOWN
+        self.cond = threading.Condition()
+
+    def acquire(self, timeout=ORIGIN_QUEUE_TIMEOUT, deadline=None):
+        """Wait for a request slot; returns a release function that is safe to call twice.
+
+        deadline is when the caller gives up on the request. A cool-down that
+        outlasts it (or timeout) raises OriginCoolingDown at once, so the
+        caller can serve from cache instead of sitting out the wait and then
+        hitting the origin anyway. No free slot by timeout raises OriginBusy,
+        by deadline Timeout.
+        """
+        token = object()
+        until = time.time() + timeout
+        if deadline is not None:
+            until = min(until, deadline)
+        with self.cond:
+            self.waiters.append(token)
+            try:
+                while True:
+                    now = time.time()
+                    if self.cooldown_until > until:
+                        error = OriginCoolingDown("Origin cooling down for %.0fs more" % (self.cooldown_until - now))
+                        error.retry_after = int(self.cooldown_until - now) + 1
+                        raise error
+                    if (self.waiters[0] is token and now >= self.cooldown_until and
+                            (not self.max_inflight or self.inflight < self.max_inflight)):
+                        break
+                    if now >= until:
+                        if deadline is not None and now >= deadline:
+                            raise requests.exceptions.Timeout("No upstream slot before the request deadline")
+                        raise OriginBusy("No upstream slot after %ds" % timeout)
+                    wake = min(until, self.cooldown_until) if self.cooldown_until > now else until
+                    self.cond.wait(max(0.01, min(1.0, wake - now)))
+            finally:
+                self.waiters.remove(token)
+                self.cond.notify_all()
+            self.inflight += 1
+        released = [False]
+
+        def release():
+            with self.cond:
+                if not released[0]:
+                    released[0] = True
+                    self.inflight -= 1
+                    self.cond.notify_all()
+        return release
+
+    def record(self, latency, status=None, retry_after=None):
+        """Account a finished request; status None means it raised."""
+        now = time.time()
+        outcome = 'ok' if status is not None and status < 400 or status in (404, 416) else 'error'
+        with self.cond:
+            if status == 429 or (status == 503 and retry_after):
+                outcome = 'limited'
+                try:
+                    pause = min(float(retry_after), ORIGIN_MAX_COOLDOWN)
+                except (TypeError, ValueError):
+                    pause = self.cooldown
+                    self.cooldown = min(self.cooldown * 2, ORIGIN_MAX_COOLDOWN)
+                self.cooldown_until = max(self.cooldown_until, now + pause)
+                logging.debug("[HLS Proxy] Origin rate limited, cooling down for %.0fs" % pause)
+            elif outcome == 'ok':
+                self.cooldown = ORIGIN_COOLDOWN
+            self.events.append((now, latency, outcome))
+            while self.events and self.events[0][0] < now - ORIGIN_WINDOW:
+                self.events.popleft()
+
+    def health(self):
+        now = time.time()
+        with self.cond:
+            events = [event for event in self.events if event[0] >= now - ORIGIN_WINDOW]
+            inflight, queued = self.inflight, len(self.waiters)
+            cooling = max(0.0, self.cooldown_until - now)
+        count = len(events)
+        errors = sum(1 for event in events if event[2] != 'ok')
+        health = {
+            'requests': count,
+            'latency': sum(event[1] for event in events) / count if count else None,
+            'error_rate': float(errors) / count if count else 0.0,
+            'rate_limited': sum(1 for event in events if event[2] == 'limited'),
+            'inflight': inflight,
+            'queued': queued,
+            'cooldown': cooling,
+        }
+        health['degraded'] = bool(cooling or (count >= 4 and health['error_rate'] >= 0.5) or
+                                  (health['latency'] or 0) > 5)
+        return health
+
+class OriginScoreboard(object):
+    """OriginStates keyed like UpstreamPool sessions; read it to steer away from degraded hosts."""
+
+    def __init__(self):
+        self.origins = {}
+        self.lock = threading.Lock()
+
+    def state(self, url):
+        key = UpstreamPool.origin(url)
+        with self.lock:
+            state = self.origins.get(key)
+            if state is None:
+                state = self.origins[key] = OriginState()
+            return state
+
+    def snapshot(self):
+        with self.lock:
+            origins = list(self.origins.items())
+        return dict(('%s://%s:%d' % key, state.health()) for key, state in origins)
+
+ORIGIN_SCOREBOARD = OriginScoreboard()
+
+def origin_health(url):
+    """Rolling health of the origin serving url (latency, error_rate, cooldown, degraded, ...)."""
+    return ORIGIN_SCOREBOARD.state(url).health()
+
+def is_origin_degraded(url):
+    return origin_health(url)['degraded']
+
+def upstream_get(url, deadline=None, **kwargs):
+    """GET url through the shared upstream pool, within its origin's in-flight limit.
+
+    The slot is held until a streamed response is closed, except for bodies
+    over ORIGIN_HOLD_MAX_BODY or of unknown length (MP4s, live streams): they
+    free it once the headers are in, so they don't starve short requests.
+    Raises OriginUnavailable when no slot can be had (see OriginState.acquire).
+    """
+    state = ORIGIN_SCOREBOARD.state(url)
+    release = state.acquire(deadline=deadline)
+    started = time.time()
+    try:
+        response = UPSTREAM_POOL.session(url).get(url, **kwargs)
+    except Exception:
+        state.record(time.time() - started)
+        METRICS.inc('proxy_upstream_responses_total', origin_label(url) + (('status', 'error'),))
+        release()
+        raise
+    latency = time.time() - started
+    state.record(latency, response.status_code, response.headers.get('retry-after'))
+    METRICS.observe('proxy_upstream_ttfb_seconds', origin_label(url), latency, TTFB_BUCKETS)
+    METRICS.inc('proxy_upstream_responses_total', origin_label(url) + (('status', str(response.status_code)),))
+    if not kwargs.get('stream'):
+        release()
+        return response
+    length = upstream_length(response)
+    if length is None or length > ORIGIN_HOLD_MAX_BODY:
+        release()
+    close = response.close
+
+    def close_and_release():
+        try:
+            close()
+        finally:
+            release()
+    response.close = close_and_release
+    return response
+
+class SegmentCache(object):
+    """Byte-budgeted LRU/TTL cache of complete media segments keyed by normalized URL."""
+
+    def __init__(self, max_bytes=SEGMENT_CACHE_MAX_BYTES, max_item=SEGMENT_CACHE_MAX_ITEM, ttl=SEGMENT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (body, headers, expires)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(url, range_header=None):
+        """Normalize url (scheme/host case, fragment) and append the requested range, if any."""
+        parsed = urlparse(url)
+        key = "%s://%s%s" % (parsed.scheme.lower(), parsed.netloc.lower(), parsed.path)
+        if parsed.query:
+            key += '?' + parsed.query
+        if range_header:
+            key += '|' + range_header.replace(' ', '')
+        return key
+
+    def _remove(self, key):
+        body, _, _ = self.entries.pop(key)
+        self.size -= len(body)
+
+    def get(self, url, range_header=None):
+        """Return (body, headers) for a cached segment, or None."""
+        key = self.make_key(url, range_header)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[2] < time.time():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = self.entries.pop(key)  # Mark as most recently used
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def put(self, url, body, headers, range_header=None, ttl=None):
+        """Store a complete body; returns False when it exceeds the per-item cap."""
+        if len(body) > self.max_item or len(body) > self.max_bytes:
+            return False
+        key = self.make_key(url, range_header)
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (body, CaseInsensitiveDict(headers), expires)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self.entries))
+                self._remove(oldest)
+                self.evictions += 1
+        return True
+
+    def contains(self, url, range_header=None):
+        """Whether a fresh copy is cached, without touching LRU order or counters."""
+        with self.lock:
+            entry = self.entries.get(self.make_key(url, range_header))
+            return entry is not None and entry[2] >= time.time()
+
+    def discard(self, url, range_header=None):
+        with self.lock:
+            key = self.make_key(url, range_header)
+            if key in self.entries:
+                self._remove(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            }
+
+SEGMENT_CACHE = SegmentCache()
+
 def get_ip(headers, client_address):
     """Extract client IP from request headers or remote address."""
     forwarded_for = headers.get("X-Forwarded-For", "")
@@ -94,61 +713,1969 @@ def rewrite_m3u8_urls(playlist_content, base_url, scheme, host):
             return segment_url
     return re.sub(r'^(?!#)\S+', replace_url, playlist_content, flags=re.MULTILINE)
 
-def stream_response(response, client_ip, url, headers, sess):
-    """Stream response chunks, caching for .mp4 and .ts files."""
-    cache_key = get_cache_key(client_ip, url) if any(ext in url.lower() for ext in ['.mp4', '.m3u8']) else client_ip
-    mode_ts = [False]  # Use list for Python 2 compatibility
+def is_cacheable_media(url):
+    """Media bodies (.mp4 and TS segments) that the segment cache may hold."""
+    lowered = url.lower()
+    return '.mp4' in lowered or '.ts' in lowered or '/hl' in lowered
+
+# Xtream live channels (/live/user/pass/1234.ts or /user/pass/1234.ts) are endless TS streams
+LIVE_CHANNEL_PATH = re.compile(r'^/(?:live/)?[^/]+/[^/]+/\d+\.ts$', re.I)
+
+def is_segment_url(url):
+    """URLs that rewrite_m3u8_urls treats as media segments.
+
+    Paths shaped like an Xtream live channel only count when they sit under a
+    live playlist the proxy has served, since on their own they never end.
+    """
+    lowered = url.lower()
+    if not (lowered.endswith('.ts') or '/hl' in lowered) or lowered.endswith('.m3u8'):
+        return False
+    if LIVE_CHANNEL_PATH.match(urlparse(url).path or ''):
+        return PLAYLIST_CACHE.target_duration(url) is not None
+    return True
+
+def playlist_segment_urls(playlist_content, base_url):
+    """Absolute URLs of the media segments listed in a media playlist, in order."""
+    urls = []
+    for line in playlist_content.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            absolute_url = urljoin(base_url + '/', line)
+        except ValueError:
+            continue
+        if is_segment_url(absolute_url):
+            urls.append(absolute_url)
+    return urls
 
+def stream_response(response, url, headers, range_header=None):
+    """Stream response chunks, storing the complete body of media segments in SEGMENT_CACHE."""
     def generate_chunks():
         bytes_read = 0
+        parts = [] if is_cacheable_media(url) else None
         try:
             for chunk in response.iter_content(chunk_size=4096):
                 if chunk:
                     bytes_read += len(chunk)
-                    if '.mp4' in url.lower():
-                        IP_CACHE_MP4.setdefault(cache_key, []).append(chunk)
-                        if len(IP_CACHE_MP4[cache_key]) > 20:
-                            IP_CACHE_MP4[cache_key].pop(0)
-                    elif '.ts' in url.lower() or '/hl' in url.lower():
-                        mode_ts[0] = True
-                        IP_CACHE_TS.setdefault(cache_key, []).append(chunk)
-                        if len(IP_CACHE_TS[cache_key]) > 20:
-                            IP_CACHE_TS[cache_key].pop(0)
+                    if parts is not None:
+                        if bytes_read <= SEGMENT_CACHE.max_item:
+                            parts.append(chunk)
+                        else:
+                            parts = None
                     yield chunk
-        except (IncompleteRead, ConnectionError) as e:
+            if parts is not None:
+                SEGMENT_CACHE.put(url, b''.join(parts), headers, range_header)
+        except (IncompleteRead, RequestException) as e:
             logging.debug("[HLS Proxy] Error processing chunks (bytes read: %d): %s" % (bytes_read, e))
-            cache = IP_CACHE_TS if mode_ts[0] else IP_CACHE_MP4
-            for chunk in cache.get(cache_key, [])[-5:]:
-                yield chunk
+            cached = SEGMENT_CACHE.get(url, range_header) if bytes_read == 0 else None
+            if cached is None:
+                # Splicing other bytes into a partly sent body would corrupt it; drop the connection
+                raise
+            yield cached[0]
         finally:
+            response.close()
+    return generate_chunks()
+
+def iter_body_buffered(response):
+    """Yield the upstream body as views into one reusable buffer.
+
+    A view is only valid until the next iteration, so it must be written out
+    before asking for more. Reads double from RELAY_MIN_READ up to
+    RELAY_MAX_READ while the upstream fills them quickly and halve when it
+    stalls, so slow origins still deliver their first bytes promptly.
+    """
+    fp = getattr(response.raw, '_fp', None)
+    direct = hasattr(fp, 'readinto') and not response.headers.get('content-encoding')
+    buf = memoryview(bytearray(RELAY_MAX_READ))
+    size = RELAY_MIN_READ
+    total = 0
+    began = time.time()
+    try:
+        while True:
+            started = time.time()
+            if direct:
+                n = fp.readinto(buf[:size])
+                chunk = buf[:n]
+            else:
+                chunk = response.raw.read(size, decode_content=True)
+                n = len(chunk)
+            if not n:
+                break
+            total += n
+            yield chunk
+            elapsed = time.time() - started
+            if n == size and elapsed < 0.05:
+                size = min(size * 2, RELAY_MAX_READ)
+            elif elapsed > 0.25:
+                size = max(size // 2, RELAY_MIN_READ)
+        if direct:
+            response.raw.release_conn()  # Fully read: hand the connection back to the pool
+    finally:
+        response.close()
+        observe_throughput(response.url, total, time.time() - began)
+
+def iter_resumable(response, url, req_headers, reader=iter_body_buffered):
+    """Relay an upstream body, resuming with a Range request if it breaks off partway.
+
+    Bytes handed to the client are counted, so the continuation is requested
+    from exactly the next byte. Origins that answer the Range request with a
+    200 are read from the top and the bytes already sent are skipped.
+    """
+    position = content_range_total(response)
+    expected = upstream_length(response)
+    if position is None or expected is None:
+        for chunk in reader(response):
+            yield chunk
+        return
+    offset, total = position
+    delivered = 0
+    skip = 0
+    resumes = 0
+    try:
+        while True:
             try:
-                sess.close()
-            except:
+                for chunk in reader(response):
+                    if skip:
+                        if len(chunk) <= skip:
+                            skip -= len(chunk)
+                            continue
+                        chunk = chunk[skip:]
+                        skip = 0
+                    if len(chunk) > expected - delivered:
+                        # A 200 continuation runs past a ranged end; the rest isn't needed
+                        chunk = chunk[:expected - delivered]
+                        if chunk:
+                            yield chunk
+                        return
+                    delivered += len(chunk)
+                    yield chunk
+                    # Once everything is delivered, keep iterating: the reader then sees EOF
+                    # and hands the connection back to the pool instead of closing it
+                if delivered >= expected:
+                    return
+                error = "body ended short"
+            except (RequestException, UpstreamReadError, IncompleteRead, socket.error) as e:
+                error = e
+            response.close()
+            while True:
+                resumes += 1
+                if resumes > RESUME_ATTEMPTS:
+                    raise IOError("Upstream failed after %d of %d bytes: %s" % (delivered, expected, error))
+                logging.debug("[HLS Proxy] %s broke off after %d of %d bytes (%s), resuming" %
+                              (url, delivered, expected, error))
+                METRICS.inc('proxy_resumes_total')
+                time.sleep(random.uniform(0, RETRY_BASE_DELAY * (2 ** resumes)))
+                resume_headers = dict((k, v) for k, v in req_headers.items() if k.lower() != 'range')
+                resume_headers['Range'] = 'bytes=%d-%d' % (offset + delivered, offset + expected - 1)
+                try:
+                    response = upstream_get(url, headers=resume_headers, allow_redirects=True, stream=True, timeout=9)
+                except RequestException as e:
+                    error = e
+                    continue
+                resumed = content_range_total(response) if response.status_code in (200, 206) else None
+                if resumed is not None and resumed[1] == total and resumed[0] <= offset + delivered:
+                    skip = offset + delivered - resumed[0]
+                    break
+                error = "HTTP %d on resume" % response.status_code
+                response.close()
+    finally:
+        response.close()
+
+def observe_throughput(url, size, elapsed):
+    if size >= RELAY_MIN_READ and elapsed > 0:
+        METRICS.observe('proxy_upstream_throughput_bytes_per_second', origin_label(url), size / elapsed,
+                        THROUGHPUT_BUCKETS)
+
+def iter_response(response):
+    """Iterate an upstream body according to RELAY_MODE."""
+    if RELAY_MODE == 'buffer':
+        return iter_body_buffered(response)
+    return response.iter_content(chunk_size=4096)
+
+def addon_profile():
+    translate = getattr(xbmcvfs, 'translatePath', None) or xbmc.translatePath
+    return translate(xbmcaddon.Addon().getAddonInfo('profile'))
+
+def parse_range(range_header, size):
+    """Parse a single-range 'bytes=' header into [start, end) for a body of size bytes.
+
+    Returns None when there is no header and False for forms we don't serve
+    (multiple ranges, other units).
+    """
+    if not range_header:
+        return None
+    match = re.match(r'^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$', range_header)
+    if not match or not (match.group(1) or match.group(2)):
+        return False
+    if not match.group(1):
+        return max(0, size - int(match.group(2))), size  # Suffix range: last N bytes
+    start = int(match.group(1))
+    end = min(int(match.group(2)) + 1, size) if match.group(2) else size
+    return start, end
+
+def content_range_total(response):
+    """(offset, total size) of an upstream 200/206 body, or None when unknown."""
+    if response.headers.get('content-encoding'):
+        return None
+    if response.status_code == 206:
+        match = re.match(r'bytes\s+(\d+)-\d+/(\d+)', response.headers.get('content-range', ''))
+        return (int(match.group(1)), int(match.group(2))) if match else None
+    length = upstream_length(response)
+    return (0, length) if length else None
+
+class SparseEntry(object):
+    """One cached URL: a sparse data file plus the byte ranges present in it."""
+
+    def __init__(self, key, url, size, content_type, ranges=None, atime=None):
+        self.key = key
+        self.url = url
+        self.size = size
+        self.content_type = content_type
+        self.ranges = ranges or []  # Sorted, non-overlapping [start, end) pairs
+        self.atime = atime or time.time()
+        self.users = 0
+        self.lock = threading.Lock()
+
+    def cached_bytes(self):
+        with self.lock:
+            return sum(end - start for start, end in self.ranges)
+
+    def add(self, start, end):
+        """Mark [start, end) as present, merging with neighbouring ranges."""
+        if end <= start:
+            return
+        with self.lock:
+            merged = []
+            for s, e in self.ranges:
+                if e < start or s > end:
+                    merged.append([s, e])
+                else:
+                    start, end = min(s, start), max(e, end)
+            merged.append([start, end])
+            merged.sort()
+            self.ranges = merged
+
+    def pieces(self, start, end):
+        """Split [start, end) into (start, end, cached) pieces."""
+        result = []
+        pos = start
+        with self.lock:
+            for s, e in self.ranges:
+                if e <= pos or s >= end:
+                    continue
+                if s > pos:
+                    result.append((pos, s, False))
+                result.append((max(s, pos), min(e, end), True))
+                pos = min(e, end)
+        if pos < end:
+            result.append((pos, end, False))
+        return result
+
+    def to_json(self):
+        with self.lock:
+            return {'url': self.url, 'size': self.size, 'content_type': self.content_type,
+                    'ranges': self.ranges, 'atime': self.atime}
+
+class SparseWriter(object):
+    """Writes a relayed body into an entry's data file, recording each range as it lands."""
+
+    def __init__(self, cache, entry, offset):
+        self.cache = cache
+        self.entry = entry
+        self.start = self.pos = offset
+        self.since_check = 0
+        self.f = open(cache.data_path(entry.key), 'r+b', 0)  # Unbuffered: readers see writes at once
+        self.f.seek(offset)
+
+    def write(self, chunk):
+        if self.f is None or self.pos >= self.entry.size:
+            return
+        chunk = chunk[:self.entry.size - self.pos]
+        self.f.write(chunk)
+        self.pos += len(chunk)
+        self.entry.add(self.start, self.pos)
+        self.since_check += len(chunk)
+        if self.since_check >= 8 * 1024 * 1024:
+            self.since_check = 0
+            if not self.cache.enforce_quota():
+                logging.debug("[HLS Proxy] Disk cache quota reached, no longer caching %s" % self.entry.url)
+                self.close()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            self.cache.save(self.entry)
+
+class SparseFileCache(object):
+    """Disk cache of MP4 byte ranges, with whole files evicted LRU past max_bytes."""
+
+    def __init__(self, max_bytes=DISK_CACHE_MAX_BYTES, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = None  # key -> SparseEntry, loaded on first use
+        self.sparse = True   # False where a truncated file takes its full size on disk (FAT, NTFS)
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if self.entries is not None:
+            return
+        self.entries = {}
+        if self.directory is None:
+            self.directory = os.path.join(addon_profile(), DISK_CACHE_DIRNAME)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.sparse = self._supports_sparse_files()
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            key = name[:-5]
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    data = json.load(f)
+                if os.path.exists(self.data_path(key)):
+                    self.entries[key] = SparseEntry(key, data['url'], data['size'], data['content_type'],
+                                                    data['ranges'], data['atime'])
+                    continue
+            except Exception as e:
+                logging.debug("[HLS Proxy] Dropping disk cache index %s: %s" % (name, e))
+            self._delete_files(key)
+
+    def _supports_sparse_files(self):
+        """Whether truncating a file up leaves it unallocated on this filesystem."""
+        probe = os.path.join(self.directory, 'sparse.probe')
+        try:
+            with open(probe, 'wb') as f:
+                f.truncate(16 * 1024 * 1024)
+            blocks = getattr(os.stat(probe), 'st_blocks', None)  # Not reported on Windows
+            return blocks is not None and blocks * 512 < 1024 * 1024
+        except (IOError, OSError):
+            return False
+        finally:
+            try:
+                os.remove(probe)
+            except OSError:
                 pass
-    return generate_chunks()
 
-def stream_cache(client_ip, url):
-    """Stream cached chunks for .mp4 or .ts files."""
-    if url:
-        cache_key = get_cache_key(client_ip, url) if any(ext in url.lower() for ext in ['.mp4', '.m3u8']) else client_ip
-        cache = IP_CACHE_MP4 if '.mp4' in url.lower() else IP_CACHE_TS if ('.ts' in url.lower() or '/hl' in url.lower()) else None
-        if cache:
-            def generate_cached_chunks():
-                if cache_key in cache:
-                    for chunk in cache.get(cache_key, [])[-5:]:
-                        yield chunk
+    def free_bytes(self):
+        """Free space on the cache's filesystem, or None when it can't be told."""
+        try:
+            if hasattr(shutil, 'disk_usage'):
+                return shutil.disk_usage(self.directory).free
+            stat = os.statvfs(self.directory)
+            return stat.f_bavail * stat.f_frsize
+        except (AttributeError, OSError):
+            return None
+
+    def disk_bytes(self, entry):
+        """Space entry takes against the quota: what is cached, or its full size without sparse files."""
+        return entry.cached_bytes() if self.sparse else entry.size
+
+    @staticmethod
+    def make_key(url):
+        return hashlib.sha1(SegmentCache.make_key(url).encode('utf-8')).hexdigest()
+
+    def data_path(self, key):
+        return os.path.join(self.directory, key + '.data')
+
+    def _delete_files(self, key):
+        for path in (self.data_path(key), os.path.join(self.directory, key + '.json')):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def lookup(self, url):
+        """Return the entry for url, or None."""
+        with self.lock:
+            self._load()
+            entry = self.entries.get(self.make_key(url))
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry.atime = time.time()
+            return entry
+
+    def create(self, url, size, content_type):
+        """Return the entry for url, creating an empty sparse file of size bytes if needed."""
+        with self.lock:
+            self._load()
+            key = self.make_key(url)
+            entry = self.entries.get(key)
+            if entry is not None and entry.size == size:
+                return entry
+            if entry is not None:
+                self._remove(key)  # Size changed upstream: the cached ranges are stale
+            # Without sparse files the whole size is allocated right away
+            reserve = 0 if self.sparse else size
+            if reserve > self.max_bytes or not self.enforce_quota(reserve):
+                raise IOError("No room in the disk cache quota for %d bytes" % size)
+            free = self.free_bytes()
+            if free is not None and size > free:
+                raise IOError("Only %d bytes free on disk for a %d byte file" % (free, size))
+            with open(self.data_path(key), 'wb') as f:
+                f.truncate(size)
+            entry = self.entries[key] = SparseEntry(key, url, size, content_type)
+            self.save(entry)
+            return entry
+
+    def writer(self, entry, offset):
+        return SparseWriter(self, entry, offset)
+
+    def acquire(self, entry):
+        with self.lock:
+            entry.users += 1
+
+    def release(self, entry):
+        with self.lock:
+            entry.users -= 1
+
+    def save(self, entry):
+        try:
+            with open(os.path.join(self.directory, entry.key + '.json'), 'w') as f:
+                json.dump(entry.to_json(), f)
+        except (IOError, OSError) as e:
+            logging.debug("[HLS Proxy] Could not save disk cache index: %s" % e)
+
+    def _remove(self, key):
+        self.entries.pop(key, None)
+        self._delete_files(key)
+
+    def used_bytes(self):
+        with self.lock:
+            self._load()
+            return sum(self.disk_bytes(entry) for entry in self.entries.values())
+
+    def enforce_quota(self, reserve=0):
+        """Evict least recently used idle files until reserve more bytes fit; False if they can't."""
+        with self.lock:
+            limit = self.max_bytes - reserve
+            used = self.used_bytes()
+            for entry in sorted(self.entries.values(), key=lambda e: e.atime):
+                if used <= limit:
+                    break
+                if entry.users:
+                    continue
+                used -= self.disk_bytes(entry)
+                self._remove(entry.key)
+            return used <= limit
+
+    def stats(self):
+        with self.lock:
+            self._load()
+            return {'files': len(self.entries), 'bytes': self.used_bytes(), 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+DISK_CACHE = SparseFileCache()
+
+def disk_cache_writer(url, response):
+    """SparseWriter teeing an upstream MP4 response into the disk cache, or None."""
+    if not DISK_CACHE_ENABLED or '.mp4' not in url.lower() or response.status_code not in (200, 206):
+        return None
+    position = content_range_total(response)
+    if position is None:
+        return None
+    offset, total = position
+    try:
+        entry = DISK_CACHE.create(url, total, response.headers.get('content-type', 'video/mp4'))
+        return DISK_CACHE.writer(entry, offset)
+    except (IOError, OSError) as e:
+        logging.debug("[HLS Proxy] Disk cache unavailable: %s" % e)
+        return None
+
+def fetch_missing_range(conn, entry, start, end, req_headers):
+    """Relay [start, end) of entry from the upstream, writing it into the disk cache.
+
+    The hole gets the same treatment as /hlsretry: jittered retries within a
+    RetryPolicy, a hedged second attempt, a fresh User-Agent after each
+    failure, a retry without Range on 416, and a body that resumes if it
+    breaks off.
+    """
+    hole_headers = dict(req_headers)
+    hole_headers['Range'] = 'bytes=%d-%d' % (start, end - 1)
+    policy = RetryPolicy()
+    while True:
+        hedge_headers = dict(hole_headers)
+        hedge_headers['User-Agent'] = binascii.b2a_hex(os.urandom(20))[:32]
+        try:
+            response = hedged_get(entry.url, hole_headers, hedge_headers, policy,
+                                  allow_redirects=True, stream=True, timeout=9)
+        except RequestException as e:
+            error = str(e)
+        else:
+            position = content_range_total(response) if response.status_code in (200, 206) else None
+            if position is not None and position[1] == entry.size and position[0] <= start:
+                break
+            error = "HTTP %d" % response.status_code
+            response.close()
+            if response.status_code == 416 and 'Range' in hole_headers:
+                hole_headers.pop('Range')  # Read it from the top instead
+                continue
+        logging.debug("[HLS Proxy] Hole %d-%d of %s failed (%s), attempt %d" %
+                      (start, end - 1, entry.url, error, policy.attempts))
+        hole_headers['User-Agent'] = binascii.b2a_hex(os.urandom(20))[:32]
+        if not policy.backoff():
+            raise IOError("Upstream can't serve bytes %d-%d (%s)" % (start, end - 1, error))
+    skip = start - position[0]  # Origins without range support resend from the top
+    writer = DISK_CACHE.writer(entry, position[0])
+    remaining = end - start
+    body = iter_resumable(response, response.url, hole_headers)
+    try:
+        for chunk in body:
+            writer.write(chunk)
+            if skip:
+                dropped = min(skip, len(chunk))
+                chunk = chunk[dropped:]
+                skip -= dropped
+            if remaining < len(chunk):
+                chunk = chunk[:remaining]
+            conn.write(chunk)
+            remaining -= len(chunk)
+            if remaining <= 0:
+                break
+    finally:
+        body.close()
+        writer.close()
+    if remaining > 0:
+        raise IOError("Upstream ended %d bytes short" % remaining)
+
+def serve_from_disk_cache(conn, url, headers):
+    """Answer an MP4 request from the sparse disk cache, fetching only the missing holes upstream."""
+    entry = DISK_CACHE.lookup(url)
+    if entry is None:
+        return False
+    byte_range = parse_range(headers.get('Range'), entry.size)
+    if byte_range is False:
+        return False
+    response_headers = {'Content-Type': entry.content_type, 'Accept-Ranges': 'bytes'}
+    if byte_range is None:
+        start, end, status = 0, entry.size, 200
+    else:
+        start, end = byte_range
+        status = 206
+        if start >= entry.size or start >= end:
+            conn.send_response(416, b'', None, {'Content-Range': 'bytes */%d' % entry.size})
+            return True
+        response_headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, entry.size)
+    req_headers = dict((k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+    req_headers.setdefault('User-Agent', DEFAULT_USER_AGENT)
+    conn.start_response(status, response_headers, end - start)
+    if conn.head_only:
+        return True
+    DISK_CACHE.acquire(entry)
+    try:
+        with open(DISK_CACHE.data_path(entry.key), 'rb') as f:
+            for piece_start, piece_end, cached in entry.pieces(start, end):
+                if cached:
+                    conn.sendfile(f, piece_start, piece_end - piece_start)
                 else:
-                    logging.debug("[HLS Proxy] Cache empty for %s" % cache_key)
-            return generate_cached_chunks()
+                    fetch_missing_range(conn, entry, piece_start, piece_end, req_headers)
+    finally:
+        DISK_CACHE.release(entry)
+    conn.finish()
+    return True
+
+class RangeAccelerator(object):
+    """Relays bytes [start, end) of url as fixed-size Range blocks fetched over several connections.
+
+    The response that is already open serves the first block while workers
+    download the following ones; blocks are yielded strictly in order and at
+    most ACCEL_REORDER_BLOCKS of them are held ahead of the client. The number
+    of active connections drops on 403/429 and slowly grows back on success.
+    """
+
+    def __init__(self, url, headers, start, end, first_response=None):
+        self.url = url
+        self.headers = dict(headers)
+        self.headers.pop('Range', None)
+        self.first_response = first_response
+        self.blocks = [(s, min(s + ACCEL_BLOCK_SIZE, end)) for s in range(start, end, ACCEL_BLOCK_SIZE)]
+        self.pending = list(range(1 if first_response is not None else 0, len(self.blocks)))
+        self.done = {}  # Block index -> body
+        self.delivered = 0
+        self.limit = min(ACCEL_CONNECTIONS, max(1, len(self.pending)))
+        self.successes = 0
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def _take(self, worker_id):
+        """Next block index for a worker, or None once there is nothing left to do."""
+        with self.cond:
+            while not self.closed and self.error is None and self.pending:
+                if worker_id < self.limit and self.pending[0] < self.delivered + ACCEL_REORDER_BLOCKS:
+                    return self.pending.pop(0)
+                self.cond.wait(1.0)
+            return None
+
+    def _fetch_block(self, index):
+        start, end = self.blocks[index]
+        headers = dict(self.headers)
+        headers['Range'] = 'bytes=%d-%d' % (start, end - 1)
+        response = upstream_get(self.url, headers=headers, allow_redirects=True, stream=True, timeout=9)
+        try:
+            if response.status_code != 206:
+                return response.status_code, None
+            body = response.content
+            return 206, body if len(body) == end - start else None
+        finally:
+            response.close()
+
+    def _worker(self, worker_id):
+        while True:
+            index = self._take(worker_id)
+            if index is None:
+                return
+            body = None
+            for attempt in range(ACCEL_BLOCK_RETRIES):
+                try:
+                    status, body = self._fetch_block(index)
+                except RequestException as e:
+                    status, body = 0, None
+                    logging.debug("[HLS Proxy] Range block %d failed: %s" % (index, e))
+                if body is not None or self.closed:
+                    break
+                with self.cond:
+                    if status in (403, 429):
+                        self.limit = max(1, self.limit - 1)
+                        self.successes = 0
+                        logging.debug("[HLS Proxy] Upstream refused block %d (HTTP %d), %d connections" %
+                                      (index, status, self.limit))
+                    if worker_id >= self.limit:
+                        break  # Hand the block back to a worker still within the limit
+                time.sleep(0.5 * (attempt + 1))
+            with self.cond:
+                if body is not None:
+                    self.done[index] = body
+                    self.successes += 1
+                    if self.successes >= 2 * self.limit and self.limit < ACCEL_CONNECTIONS:
+                        self.limit += 1
+                        self.successes = 0
+                elif worker_id >= self.limit and not self.closed:
+                    self.pending.insert(0, index)
+                else:
+                    self.error = "Range block %d-%d failed" % self.blocks[index]
+                self.cond.notify_all()
+
+    def __iter__(self):
+        for worker_id in range(ACCEL_CONNECTIONS):
+            worker = threading.Thread(target=self._worker, args=(worker_id,))
+            worker.daemon = True
+            worker.start()
+        try:
+            if self.first_response is not None:
+                remaining = self.blocks[0][1] - self.blocks[0][0]
+                body = iter_body_buffered(self.first_response)
+                try:
+                    for chunk in body:
+                        if len(chunk) > remaining:
+                            chunk = chunk[:remaining]
+                        yield chunk
+                        remaining -= len(chunk)
+                        if remaining <= 0:
+                            break
+                finally:
+                    body.close()
+                if remaining > 0:
+                    raise IOError("Upstream ended %d bytes short" % remaining)
+                self._advance(1)
+            while self.delivered < len(self.blocks):
+                with self.cond:
+                    while self.delivered not in self.done and self.error is None:
+                        self.cond.wait(1.0)
+                    if self.error is not None:
+                        raise IOError(self.error)
+                    body = self.done.pop(self.delivered)
+                self._advance(self.delivered + 1)
+                yield body
+        finally:
+            with self.cond:
+                self.closed = True
+                self.cond.notify_all()
+
+    def _advance(self, delivered):
+        with self.cond:
+            self.delivered = delivered
+            self.cond.notify_all()
+
+def accelerated_body(response, url, req_headers):
+    """RangeAccelerator for an upstream MP4 response worth splitting, or None."""
+    if not ACCEL_ENABLED or '.mp4' not in url.lower():
+        return None
+    if response.status_code != 206 and response.headers.get('accept-ranges', '').lower() != 'bytes':
+        return None
+    position = content_range_total(response)
+    length = upstream_length(response)
+    if position is None or length is None or length < ACCEL_MIN_BYTES:
+        return None
+    return RangeAccelerator(url, req_headers, position[0], position[0] + length, response)
+
+def stream_cache(url, range_header=None):
+    """Return (body, headers) of the complete cached segment for url, or None."""
+    if url and is_cacheable_media(url):
+        cached = SEGMENT_CACHE.get(url, range_header)
+        if cached is None:
+            logging.debug("[HLS Proxy] Cache empty for %s" % url)
+        return cached
     return None
 
+class RateLimiter(object):
+    """Token bucket shared by several threads; consume() sleeps to stay under max_bps."""
+
+    def __init__(self, max_bps):
+        self.max_bps = max_bps
+        self.allowance = float(max_bps)
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, amount):
+        if not self.max_bps:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.max_bps, self.allowance + (now - self.last) * self.max_bps)
+            self.last = now
+            self.allowance -= amount
+            wait = -self.allowance / self.max_bps if self.allowance < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+class InflightDownload(object):
+    """Upstream body downloaded once and tee'd to every subscriber as bytes arrive.
+
+    The whole body is kept while it fits in max_buffer, so late subscribers
+    start from the first byte. A bigger body is oversized: chunks every
+    subscriber has read are dropped and the pump waits in wait_room until the
+    slowest one catches up, so memory stays bounded by max_buffer.
+    """
+
+    def __init__(self, max_buffer=SEGMENT_CACHE_MAX_ITEM):
+        self.cond = threading.Condition()
+        self.max_buffer = max_buffer
+        self.chunks = []
+        self.first = 0         # Index in the body of self.chunks[0]
+        self.buffered = 0
+        self.size = 0
+        self.status = None
+        self.headers = None
+        self.length = None
+        self.started = False
+        self.done = False
+        self.failed = False
+        self.oversized = False
+        self.positions = {}    # Subscriber token -> index of its next chunk
+        self.watched = False   # Somebody subscribed at some point
+        self.deserted = False  # ... and every subscriber has gone since
+
+    def start(self, status, headers, length):
+        with self.cond:
+            self.status = status
+            self.headers = CaseInsensitiveDict(headers)
+            self.length = length
+            self.started = True
+            if length is not None and length > self.max_buffer:
+                self.oversized = True
+            self.cond.notify_all()
+
+    def feed(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.buffered += len(chunk)
+            if self.size > self.max_buffer:
+                self.oversized = True
+            self._trim()
+            self.cond.notify_all()
+
+    def _trim(self):
+        if not self.oversized or not self.positions:
+            return
+        read = min(self.positions.values())
+        while self.first < read and self.chunks:
+            self.buffered -= len(self.chunks.pop(0))
+            self.first += 1
+
+    def wait_room(self, timeout):
+        """Block the pump while an oversized body is max_buffer ahead of its slowest subscriber.
+
+        Returns False when it should stop: every subscriber has gone, or an
+        oversized body got no subscriber within timeout.
+        """
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.oversized and self.buffered > self.max_buffer and not self.deserted:
+                if SHUTDOWN_EVENT.is_set() or (not self.watched and time.time() >= deadline):
+                    return False
+                self.cond.wait(1.0)
+            return not self.deserted
+
+    def finish(self):
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def fail(self):
+        with self.cond:
+            self.failed = True
+            self.cond.notify_all()
+
+    def body(self):
+        with self.cond:
+            return b''.join(self.chunks)
+
+    def wait_headers(self, timeout):
+        """Wait until the upstream answered; False if the download failed or timed out."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while not self.started and not self.failed and time.time() < deadline:
+                self.cond.wait(min(1.0, max(0.0, deadline - time.time())))
+            return self.started
+
+    def iter_body(self):
+        """Yield the body from its first byte, blocking for bytes still in flight."""
+        token = object()
+        with self.cond:
+            if self.first:
+                raise IOError("Shared download already moved past its first byte")
+            self.positions[token] = 0
+            self.watched = True
+        index = 0
+        try:
+            while True:
+                with self.cond:
+                    while index >= self.first + len(self.chunks) and not self.done and not self.failed:
+                        if SHUTDOWN_EVENT.is_set():
+                            raise IOError("Proxy shutting down")
+                        self.cond.wait(1.0)
+                    pending = self.chunks[index - self.first:]
+                    index += len(pending)
+                    finished, failed = self.done, self.failed
+                for chunk in pending:
+                    yield chunk
+                with self.cond:
+                    self.positions[token] = index
+                    self._trim()
+                    self.cond.notify_all()
+                if not pending:
+                    if failed and not finished:
+                        raise IOError("Upstream download failed")
+                    return
+        finally:
+            with self.cond:
+                del self.positions[token]
+                if not self.positions:
+                    self.deserted = True
+                self.cond.notify_all()
+
+class InflightRegistry(object):
+    """In-flight downloads keyed by upstream URL, so identical requests share one download."""
+
+    def __init__(self):
+        self.downloads = {}
+        self.lock = threading.Lock()
+
+    def claim(self, url):
+        """Return (download, leader); the leader must fetch and eventually release it."""
+        key = SegmentCache.make_key(url)
+        with self.lock:
+            download = self.downloads.get(key)
+            if download is not None:
+                return download, False
+            download = self.downloads[key] = InflightDownload()
+            return download, True
+
+    def release(self, url, download):
+        key = SegmentCache.make_key(url)
+        with self.lock:
+            if self.downloads.get(key) is download:
+                del self.downloads[key]
+
+    def abandon(self, url, download):
+        """Release a download that never started, waking its subscribers."""
+        self.release(url, download)
+        download.fail()
+
+SEGMENT_FLIGHTS = InflightRegistry()
+
+def iter_content_chunks(response):
+    return response.iter_content(chunk_size=65536)
+
+def pump_download(download, response, url, headers, throttle=None):
+    """Read an upstream response into download, caching the complete body.
+
+    Stops once every subscriber has gone. An oversized body (a live stream or
+    a progressive download) leaves the registry so no one else joins it, and is
+    not cached. throttle (the prefetch bandwidth cap) only applies until a
+    player subscribes, so a player never waits on it.
+    """
+    began = time.time()
+    try:
+        for chunk in iter_resumable(response, url, headers, iter_content_chunks):
+            if SHUTDOWN_EVENT.is_set():
+                raise IOError("Proxy shutting down")
+            if chunk:
+                download.feed(chunk)
+                if download.oversized:
+                    SEGMENT_FLIGHTS.release(url, download)
+                if throttle and not download.watched:
+                    throttle(len(chunk))
+            if not download.wait_room(SEGMENT_FLIGHT_TIMEOUT):
+                raise IOError("No subscribers left")
+        if not download.oversized:
+            SEGMENT_CACHE.put(url, download.body(), download.headers)
+        download.finish()
+        observe_throughput(url, download.size, time.time() - began)
+    except Exception as e:
+        logging.debug("[HLS Proxy] Download of %s failed after %d bytes: %s" % (url, download.size, e))
+        download.fail()
+    finally:
+        response.close()
+        SEGMENT_FLIGHTS.release(url, download)
+
+def relay_inflight(conn, download):
+    """Relay a shared download to the client; False if it failed before answering."""
+    if not download.wait_headers(SEGMENT_FLIGHT_TIMEOUT):
+        return False
+    conn.start_response(download.status, download.headers, download.length)
+    if conn.head_only:
+        return True
+    body = download.iter_body()
+    try:
+        for chunk in body:
+            conn.write(chunk)
+    finally:
+        body.close()  # Unsubscribe now, not whenever the generator is collected
+    conn.finish()
+    return True
+
+class SegmentPrefetcher(object):
+    """Downloads the next segments of served media playlists into SEGMENT_CACHE in the background."""
+
+    def __init__(self, cache, segments=PREFETCH_SEGMENTS, max_bps=PREFETCH_MAX_BPS, workers=PREFETCH_WORKERS):
+        self.cache = cache
+        self.segments = segments
+        self.workers = workers
+        self.limiter = RateLimiter(max_bps)
+        self.tasks = queue.Queue()
+        self.pending = set()
+        self.requested = OrderedDict()  # Recently requested segment keys, bounded
+        self.lock = threading.Lock()
+        self.started = False
+
+    def _start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name='proxy-prefetch-%d' % i)
+            t.daemon = True
+            t.start()
+
+    def note_request(self, url):
+        """Record a segment requested by a player, so prefetch continues after it."""
+        key = self.cache.make_key(url)
+        with self.lock:
+            self.requested.pop(key, None)
+            self.requested[key] = True
+            while len(self.requested) > 256:
+                self.requested.popitem(last=False)
+
+    def schedule(self, segment_urls, live, headers):
+        """Queue the segments that follow the last one requested from this playlist."""
+        if not self.segments or not segment_urls:
+            return
+        start = None
+        with self.lock:
+            for i in range(len(segment_urls) - 1, -1, -1):
+                if self.cache.make_key(segment_urls[i]) in self.requested:
+                    start = i + 1
+                    break
+        if start is None:
+            # Players start a live playlist about three segments from its end
+            start = max(0, len(segment_urls) - 3) if live else 0
+        fetch_headers = dict((k, v) for k, v in headers.items() if k.lower() != 'range')
+        self._start()
+        for url in segment_urls[start:start + self.segments]:
+            key = self.cache.make_key(url)
+            with self.lock:
+                if key in self.pending or self.cache.contains(url):
+                    continue
+                self.pending.add(key)
+            self.tasks.put((url, fetch_headers))
+
+    def _worker(self):
+        while not SHUTDOWN_EVENT.is_set():
+            url, headers = self.tasks.get()
+            try:
+                self._fetch(url, headers)
+            except Exception as e:
+                logging.debug("[HLS Proxy] Prefetch failed for %s: %s" % (url, e))
+            finally:
+                with self.lock:
+                    self.pending.discard(self.cache.make_key(url))
+
+    def _fetch(self, url, headers):
+        download, leader = SEGMENT_FLIGHTS.claim(url)
+        if not leader:
+            return  # A client is already downloading it
+        try:
+            response = upstream_get(url, headers=headers, allow_redirects=True, stream=True, timeout=9)
+        except Exception:
+            SEGMENT_FLIGHTS.abandon(url, download)
+            raise
+        if response.status_code != 200:
+            logging.debug("[HLS Proxy] Prefetch got HTTP %d for %s" % (response.status_code, url))
+            response.close()
+            SEGMENT_FLIGHTS.abandon(url, download)
+            return
+        download.start(200, {'Content-Type': 'video/mp2t'}, upstream_length(response))
+        pump_download(download, response, url, headers, self.limiter.consume)
+
+PREFETCHER = SegmentPrefetcher(SEGMENT_CACHE)
+
+class SingleFlight(object):
+    """Lets one thread (the leader) do the work for a key while the others wait for it."""
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def begin(self, key):
+        """Return True if the caller became the leader for key."""
+        with self.lock:
+            if key in self.flights:
+                return False
+            self.flights[key] = threading.Event()
+            return True
+
+    def end(self, key):
+        with self.lock:
+            event = self.flights.pop(key, None)
+        if event:
+            event.set()
+
+    def wait(self, key, timeout=None):
+        with self.lock:
+            event = self.flights.get(key)
+        if event:
+            event.wait(timeout)
+
+class PlaylistCache(object):
+    """Rewritten playlists kept for a TTL derived from #EXT-X-TARGETDURATION."""
+
+    def __init__(self, max_entries=PLAYLIST_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (entry, expires)
+        self.targets = OrderedDict()  # Segment directory -> target duration of its live playlist
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def ttl_for(playlist_content):
+        """Half a target duration for live media playlists, longer for VOD and masters."""
+        if '#EXT-X-STREAM-INF' in playlist_content:
+            return PLAYLIST_MASTER_TTL
+        if '#EXT-X-ENDLIST' in playlist_content or '#EXT-X-PLAYLIST-TYPE:VOD' in playlist_content:
+            return PLAYLIST_VOD_TTL
+        match = re.search(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)', playlist_content)
+        return max(1.0, float(match.group(1)) / 2) if match else 1.0
+
+    def get(self, url):
+        key = SegmentCache.make_key(url)
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None or item[1] < time.time():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries[key] = self.entries.pop(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, url, entry, ttl):
+        key = SegmentCache.make_key(url)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (entry, time.time() + ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def note_target(self, base_url, playlist_content):
+        """Remember the target duration of a live media playlist for the segments under base_url."""
+        match = re.search(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)', playlist_content)
+        if not match or '#EXT-X-ENDLIST' in playlist_content:
+            return
+        with self.lock:
+            self.targets.pop(base_url, None)
+            self.targets[base_url] = float(match.group(1))
+            while len(self.targets) > self.max_entries:
+                self.targets.popitem(last=False)
+
+    def target_duration(self, segment_url):
+        with self.lock:
+            return self.targets.get(segment_url.split('?', 1)[0].rsplit('/', 1)[0])
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+PLAYLIST_CACHE = PlaylistCache()
+PLAYLIST_FLIGHTS = SingleFlight()
+
+class RetryPolicy(object):
+    """Exponential backoff with full jitter, bounded by an attempt count and a deadline."""
+
+    def __init__(self, deadline=REQUEST_DEADLINE, max_delay=RETRY_MAX_DELAY, max_attempts=RETRY_MAX_ATTEMPTS):
+        self.expires = time.time() + deadline
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.attempts = 0
+
+    @classmethod
+    def for_url(cls, url):
+        """Live segments may not outlive their place in the playlist window."""
+        target = PLAYLIST_CACHE.target_duration(url) if is_segment_url(url) else None
+        if target:
+            return cls(min(REQUEST_DEADLINE, target * LIVE_DEADLINE_FACTOR), min(RETRY_MAX_DELAY, target / 2))
+        return cls()
+
+    def remaining(self):
+        return max(0.0, self.expires - time.time())
+
+    def allows(self):
+        return self.attempts < self.max_attempts and self.remaining() > 0
+
+    def backoff(self):
+        """Sleep before the next attempt; returns False once the budget is spent."""
+        delay = random.uniform(0, min(self.max_delay, RETRY_BASE_DELAY * (2 ** self.attempts)))
+        self.attempts += 1
+        METRICS.inc('proxy_retries_total')
+        if not self.allows():
+            return False
+        time.sleep(min(delay, self.remaining()))
+        return self.allows()
+
+def hedged_get(url, headers, hedge_headers=None, policy=None, hedge_after=HEDGE_AFTER, **kwargs):
+    """GET url, firing a second attempt with hedge_headers when the first is slow.
+
+    The first 200/206 response wins and the other one is closed. When both
+    fail, the first failure is returned (or raised). With a policy nothing
+    outlives its deadline: each attempt's timeout is capped by the time left,
+    and Timeout is raised when no attempt has answered by then.
+    """
+    results = queue.Queue()
+    lock = threading.Lock()
+    settled = [False]
+    timeout = kwargs.pop('timeout', None)
+    if policy is not None:
+        kwargs['deadline'] = policy.expires
+
+    def attempt(attempt_headers, attempt_timeout):
+        try:
+            result = (upstream_get(url, headers=attempt_headers, timeout=attempt_timeout, **kwargs), None)
+        except Exception as e:
+            # Not only network errors: a malformed url must be reported too, not kill the thread
+            result = (None, e)
+        with lock:
+            if not settled[0]:
+                results.put(result)
+                return
+        if result[0] is not None:
+            result[0].close()
+
+    def launch(attempt_headers):
+        attempt_timeout = timeout
+        if policy is not None:
+            left = max(0.1, policy.remaining())
+            attempt_timeout = left if timeout is None else min(timeout, left)
+        t = threading.Thread(target=attempt, args=(attempt_headers, attempt_timeout))
+        t.daemon = True
+        t.start()
+
+    def wait(limit=None):
+        """Next result within limit seconds and the deadline; queue.Empty otherwise."""
+        if policy is not None:
+            limit = policy.remaining() if limit is None else min(limit, policy.remaining())
+        return results.get(timeout=limit)
+
+    def succeeded(result):
+        return result[0] is not None and result[0].status_code in (200, 206)
+
+    launch(headers)
+    pending = 1
+    first = result = None
+    try:
+        try:
+            result = wait(hedge_after if hedge_headers and hedge_after else None)
+            pending -= 1
+        except queue.Empty:
+            if policy is not None and not policy.remaining():
+                raise
+            # A second request would only add to the load of a struggling origin
+            if not is_origin_degraded(url):
+                logging.debug("[HLS Proxy] No response after %.1fs, hedging %s" % (hedge_after, url))
+                launch(hedge_headers)
+                pending += 1
+            result = wait()
+            pending -= 1
+        first = result
+        while pending and not succeeded(result):
+            result = wait()
+            pending -= 1
+    except queue.Empty:
+        pass
+    with lock:
+        settled[0] = True
+    while True:
+        try:
+            extra = results.get_nowait()
+        except queue.Empty:
+            break
+        if extra[0] is not None:
+            extra[0].close()
+    if first is None:
+        raise requests.exceptions.Timeout("No response from %s within the request deadline" % url)
+    if not succeeded(result):
+        result = first
+    if first[0] is not None and first[0] is not result[0]:
+        first[0].close()
+    if result[1] is not None:
+        raise result[1]
+    return result[0]
+
+def send_playlist(conn, entry):
+    """Send a rewritten playlist and prefetch the segments that follow."""
+    conn.send_response(200, entry['body'], 'application/x-mpegURL')
+    if entry['segments']:
+        PREFETCHER.schedule(entry['segments'], entry['live'], entry['headers'])
+
+def serve_cached_playlist(conn, url):
+    entry = PLAYLIST_CACHE.get(url)
+    if entry is None:
+        return False
+    send_playlist(conn, entry)
+    return True
+
+def master_variants(playlist_content, base_url):
+    """(bandwidth, absolute URL) of every variant listed in a master playlist."""
+    variants = []
+    bandwidth = None
+    for line in playlist_content.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF'):
+            match = re.search(r'[:,]BANDWIDTH=(\d+)', line)
+            bandwidth = int(match.group(1)) if match else 0
+        elif line and not line.startswith('#') and bandwidth is not None:
+            variants.append((bandwidth, urljoin(base_url + '/', line)))
+            bandwidth = None
+    return variants
+
+def parse_media_playlist(playlist_content, base_url):
+    """Media sequence, target duration, end flag and (sequence, URL, duration, discontinuity) segments."""
+    match = re.search(r'#EXT-X-MEDIA-SEQUENCE:\s*(\d+)', playlist_content)
+    sequence = int(match.group(1)) if match else 0
+    match = re.search(r'#EXT-X-TARGETDURATION:\s*(\d+(?:\.\d+)?)', playlist_content)
+    playlist = {
+        'sequence': sequence,
+        'target': float(match.group(1)) if match else 6.0,
+        'endlist': '#EXT-X-ENDLIST' in playlist_content,
+        'segments': [],
+    }
+    discontinuity = False
+    duration = playlist['target']
+    for line in playlist_content.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-DISCONTINUITY') and not line.startswith('#EXT-X-DISCONTINUITY-SEQUENCE'):
+            discontinuity = True
+        elif line.startswith('#EXTINF:'):
+            match = re.match(r'#EXTINF:\s*(\d+(?:\.\d+)?)', line)
+            duration = float(match.group(1)) if match else playlist['target']
+        elif line and not line.startswith('#'):
+            playlist['segments'].append((sequence, urljoin(base_url + '/', line), duration, discontinuity))
+            sequence += 1
+            duration = playlist['target']
+            discontinuity = False
+    return playlist
+
+def mark_ts_discontinuity(chunk, offset, marked):
+    """Set the discontinuity_indicator on the first adapted packet of each PID in chunk.
+
+    offset is the position of chunk within its segment, used to find packet
+    boundaries; marked collects the PIDs already flagged. Packets whose header
+    straddles two chunks are left alone.
+    """
+    data = bytearray(chunk)
+    start = (-offset) % 188
+    for i in range(start, len(data) - 5, 188):
+        if data[i] != 0x47:
+            break
+        pid = ((data[i + 1] & 0x1f) << 8) | data[i + 2]
+        if pid in marked or not data[i + 3] & 0x20 or not data[i + 4]:
+            continue
+        data[i + 5] |= 0x80
+        marked.add(pid)
+    return bytes(data)
+
+def iter_segment(url, headers):
+    """Yield one media segment, from SEGMENT_CACHE or a shared upstream download."""
+    cached = SEGMENT_CACHE.get(url)
+    if cached is not None:
+        yield cached[0]
+        return
+    download, leader = SEGMENT_FLIGHTS.claim(url)
+    if leader:
+        try:
+            response = upstream_get(url, headers=headers, allow_redirects=True, stream=True, timeout=9)
+        except Exception:
+            SEGMENT_FLIGHTS.abandon(url, download)
+            raise
+        if response.status_code != 200:
+            response.close()
+            SEGMENT_FLIGHTS.abandon(url, download)
+            raise IOError("HTTP %d" % response.status_code)
+        download.start(200, {'Content-Type': 'video/mp2t'}, upstream_length(response))
+        pump = threading.Thread(target=pump_download, args=(download, response, url, headers))
+        pump.daemon = True
+        pump.start()
+    elif not download.wait_headers(SEGMENT_FLIGHT_TIMEOUT):
+        raise IOError("Shared download failed")
+    for chunk in download.iter_body():
+        yield chunk
+
+class LiveStitcher(object):
+    """Server-side HLS client that follows a media playlist and yields its segments as one TS stream.
+
+    The playlist is polled at half its target duration while no new segment
+    is listed, EXT-X-MEDIA-SEQUENCE decides which segments are new, and the
+    segments following the current one are prefetched. Segments after an
+    EXT-X-DISCONTINUITY, a skipped segment or a sequence jump get the TS
+    discontinuity_indicator so the demuxer resets its clocks.
+    """
+
+    def __init__(self, url, headers):
+        self.url = url
+        self.headers = dict((k, v) for k, v in headers.items() if k.lower() != 'range')
+        self.next_sequence = None
+        self.stopped = False
+
+    def load_playlist(self):
+        """Fetch the media playlist, following a master playlist to its highest bandwidth variant."""
+        url = self.url
+        for _ in range(3):
+            response = upstream_get(url, headers=self.headers, allow_redirects=True, timeout=9)
+            if response.status_code != 200:
+                raise IOError("Playlist returned HTTP %d" % response.status_code)
+            content = response.content.decode('utf-8', errors='ignore')
+            base_url = response.url.split('?', 1)[0].rsplit('/', 1)[0]
+            variants = master_variants(content, base_url)
+            if not variants:
+                PLAYLIST_CACHE.note_target(base_url, content)
+                return parse_media_playlist(content, base_url)
+            url = self.url = max(variants)[1]
+        raise IOError("Too many nested master playlists")
+
+    def __iter__(self):
+        last_progress = time.time()
+        policy = RetryPolicy(STITCH_STALL_TIMEOUT)
+        discontinuity = False
+        while not self.stopped and not SHUTDOWN_EVENT.is_set():
+            if time.time() - last_progress > STITCH_STALL_TIMEOUT:
+                logging.warning("[HLS Stitch] No new segments for %ds, ending stream" % STITCH_STALL_TIMEOUT)
+                return
+            try:
+                playlist = self.load_playlist()
+            except (RequestException, IOError) as e:
+                logging.warning("[HLS Stitch] Playlist error: %s" % e)
+                if not policy.backoff():
+                    return
+                continue
+            policy = RetryPolicy(STITCH_STALL_TIMEOUT)
+            segments = playlist['segments']
+            if not segments:
+                time.sleep(playlist['target'] / 2)
+                continue
+            first, last = segments[0][0], segments[-1][0]
+            if self.next_sequence is None:
+                self.next_sequence = first if playlist['endlist'] else max(first, last - STITCH_LIVE_EDGE + 1)
+            elif self.next_sequence < first or self.next_sequence > last + 1:
+                logging.warning("[HLS Stitch] Sequence %d outside playlist window %d-%d, rejoining live edge" %
+                                (self.next_sequence, first, last))
+                self.next_sequence = max(first, last - STITCH_LIVE_EDGE + 1)
+                discontinuity = True
+            pending = [segment for segment in segments if segment[0] >= self.next_sequence]
+            for sequence, segment_url, _, marked_discontinuity in pending:
+                if self.stopped or SHUTDOWN_EVENT.is_set():
+                    return
+                PREFETCHER.note_request(segment_url)
+                PREFETCHER.schedule([segment[1] for segment in segments], not playlist['endlist'], self.headers)
+                discontinuity = discontinuity or marked_discontinuity
+                offset = 0
+                marked = set()
+                try:
+                    for chunk in iter_segment(segment_url, self.headers):
+                        if discontinuity and offset < 1024 * 1024:
+                            chunk = mark_ts_discontinuity(chunk, offset, marked)
+                        offset += len(chunk)
+                        yield chunk
+                    discontinuity = False
+                except (RequestException, IOError) as e:
+                    logging.warning("[HLS Stitch] Skipping segment %d: %s" % (sequence, e))
+                    discontinuity = True
+                self.next_sequence = sequence + 1
+                last_progress = time.time()
+            if playlist['endlist'] and self.next_sequence > last:
+                return
+            if not pending:
+                time.sleep(playlist['target'] / 2)
+
+TS_VIDEO_STREAM_TYPES = (0x01, 0x02, 0x10, 0x1B, 0x24, 0x42, 0xEA)  # MPEG-1/2, MPEG-4, H.264, HEVC, AVS, VC-1
+
+class TsProgram(object):
+    """Video PID of a TS stream, learnt from its PAT and PMT as packets go by."""
+
+    def __init__(self):
+        self.pmt_pid = None
+        self.video_pid = None
+
+    def _section(self, data, i):
+        """Start of the PSI section in the packet at i (after the pointer field), or None."""
+        start = ts_payload_offset(data, i)
+        if start is None or start >= i + 188:
+            return None
+        return start + 1 + data[start]
+
+    def note(self, data, i, pid):
+        """Read the PAT or PMT starting in the packet at i, if it is one."""
+        try:
+            if pid == 0:
+                s = self._section(data, i)
+                if s is None or data[s] != 0x00:
+                    return
+                end = min(s + 3 + (((data[s + 1] & 0x0F) << 8) | data[s + 2]) - 4, i + 188)
+                for p in range(s + 8, end - 3, 4):
+                    if (data[p] << 8) | data[p + 1]:  # Program 0 is the network PID
+                        self.pmt_pid = ((data[p + 2] & 0x1F) << 8) | data[p + 3]
+                        return
+            elif pid == self.pmt_pid:
+                s = self._section(data, i)
+                if s is None or data[s] != 0x02:
+                    return
+                end = min(s + 3 + (((data[s + 1] & 0x0F) << 8) | data[s + 2]) - 4, i + 188)
+                p = s + 12 + (((data[s + 10] & 0x0F) << 8) | data[s + 11])
+                while p + 5 <= end:
+                    if data[p] in TS_VIDEO_STREAM_TYPES:
+                        self.video_pid = ((data[p + 1] & 0x1F) << 8) | data[p + 2]
+                        return
+                    p += 5 + (((data[p + 3] & 0x0F) << 8) | data[p + 4])
+        except IndexError:
+            pass  # Section runs past this packet or the data; wait for the next copy
+
+def ts_payload_offset(data, i):
+    """Offset of the payload of the TS packet at i, or None if it carries none."""
+    if not data[i + 3] & 0x10:
+        return None
+    if data[i + 3] & 0x20:
+        return i + 5 + data[i + 4]
+    return i + 4
+
+def find_random_access(data, program=None):
+    """Offset of the first video random access point in packet-aligned data, or None.
+
+    A point is a packet with random_access_indicator that starts a PES packet
+    on the video PID. Audio sets the flag on nearly every packet, so before
+    program (a TsProgram) knows the video PID, only PES stream ids 0xE0-0xEF
+    (video) count.
+    """
+    for i in range(0, len(data) - 187, 188):
+        flags = data[i + 1]
+        if not flags & 0x40:
+            continue  # Not a payload_unit_start
+        pid = ((flags & 0x1F) << 8) | data[i + 2]
+        if program is not None and program.video_pid is None:
+            program.note(data, i, pid)
+        if not (data[i + 3] & 0x20 and data[i + 4] and data[i + 5] & 0x40):
+            continue
+        if program is not None and program.video_pid is not None:
+            if pid == program.video_pid:
+                return i
+            continue
+        start = ts_payload_offset(data, i)
+        if start is not None and start + 3 < i + 188 and data[start:start + 3] == b'\x00\x00\x01' and \
+                0xE0 <= data[start + 3] <= 0xEF:
+            return i
+    return None
+
+class BroadcastChannel(object):
+    """One upstream TS reader whose packet-aligned output is shared by every subscriber.
+
+    Chunks are kept in a ring buffer of BROADCAST_BUFFER_BYTES. A subscriber
+    joins at the newest chunk holding a random access point (or the newest
+    chunk when the stream flags none), and one that falls out of the buffer
+    is moved forward the same way.
+    """
+
+    def __init__(self, hub, key, source):
+        self.hub = hub
+        self.key = key
+        self.source = source
+        self.chunks = []  # (data, random access offset or None)
+        self.base = 0     # Position of chunks[0] in the stream
+        self.size = 0
+        self.subscribers = 0
+        self.done = False
+        self.program = TsProgram()
+        self.cond = threading.Condition()
+
+    def start(self):
+        reader = threading.Thread(target=self._read, name='proxy-broadcast')
+        reader.daemon = True
+        reader.start()
+
+    def _append(self, data):
+        with self.cond:
+            self.chunks.append((data, find_random_access(data, self.program)))
+            self.size += len(data)
+            while self.size > BROADCAST_BUFFER_BYTES and len(self.chunks) > 1:
+                self.size -= len(self.chunks.pop(0)[0])
+                self.base += 1
+            self.cond.notify_all()
+
+    def _read(self):
+        iterator = iter(self.source)
+        carry = b''
+        synced = False
+        try:
+            for chunk in iterator:
+                if not self.subscribers or SHUTDOWN_EVENT.is_set():
+                    break
+                data = carry + bytes(chunk)
+                if not synced:
+                    start = data.find(b'\x47')
+                    while start != -1 and start + 188 < len(data) and data[start + 188:start + 189] != b'\x47':
+                        start = data.find(b'\x47', start + 1)
+                    if start == -1 or start + 188 >= len(data):
+                        carry = data[-188:]  # Not enough to confirm packet sync yet
+                        continue
+                    data = data[start:]
+                    synced = True
+                aligned = len(data) - len(data) % 188
+                carry = data[aligned:]
+                if aligned:
+                    self._append(data[:aligned])
+        except Exception as e:
+            logging.warning("[TS Broadcast] Upstream reader failed: %s" % e)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+            self.hub.remove(self)
+
+    def _join_position(self):
+        for index in range(len(self.chunks) - 1, -1, -1):
+            if self.chunks[index][1] is not None:
+                return self.base + index, self.chunks[index][1]
+        return self.base + max(0, len(self.chunks) - 1), 0
+
+    def subscribe(self):
+        """Yield the shared stream from the latest random access point until it ends."""
+        with self.cond:
+            position, offset = self._join_position()
+        try:
+            while True:
+                with self.cond:
+                    while (position >= self.base + len(self.chunks) and not self.done
+                           and not SHUTDOWN_EVENT.is_set()):
+                        self.cond.wait(1.0)
+                    if position < self.base:
+                        logging.warning("[TS Broadcast] Subscriber fell %d chunks behind, skipping ahead" %
+                                        (self.base - position))
+                        position, offset = self._join_position()
+                    if position >= self.base + len(self.chunks):
+                        return
+                    data = self.chunks[position - self.base][0]
+                yield data[offset:] if offset else data
+                position += 1
+                offset = 0
+        finally:
+            self.hub.leave(self)
+
+class BroadcastHub(object):
+    """BroadcastChannels keyed by upstream URL, started by their first subscriber."""
+
+    def __init__(self):
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def join(self, key, source_factory):
+        """Subscribe to the channel for key, starting source_factory() as its upstream if needed."""
+        with self.lock:
+            channel = self.channels.get(key)
+            created = channel is None
+            if created:
+                channel = self.channels[key] = BroadcastChannel(self, key, source_factory())
+            channel.subscribers += 1
+        if created:
+            logging.debug("[TS Broadcast] Starting upstream for %s" % key)
+            channel.start()
+        return channel.subscribe()
+
+    def leave(self, channel):
+        with self.lock:
+            channel.subscribers -= 1
+            if channel.subscribers <= 0 and self.channels.get(channel.key) is channel:
+                # Later subscribers get a fresh upstream; this reader stops at its next chunk
+                del self.channels[channel.key]
+
+    def remove(self, channel):
+        with self.lock:
+            if self.channels.get(channel.key) is channel:
+                del self.channels[channel.key]
+
+    def stats(self):
+        with self.lock:
+            return dict((key, {'subscribers': channel.subscribers, 'buffered': channel.size})
+                        for key, channel in self.channels.items())
+
+BROADCAST_HUB = BroadcastHub()
+
+class TimeshiftChannel(object):
+    """Records a live playlist into a size-bounded ring of segment files for pause and seek back.
+
+    Each segment is written once, sequentially, to its own file and only then
+    listed; the oldest files are deleted once the channel exceeds max_bytes.
+    """
+
+    def __init__(self, manager, key, url, headers, directory, max_bytes=TIMESHIFT_MAX_BYTES):
+        self.manager = manager
+        self.key = key
+        self.source = LiveStitcher(url, headers)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segments = OrderedDict()  # sequence -> (duration, size, discontinuity)
+        self.size = 0
+        self.target = 6.0
+        self.endlist = False
+        self.last_access = time.time()
+        self.cond = threading.Condition()
+
+    def start(self):
+        recorder = threading.Thread(target=self._record, name='proxy-timeshift')
+        recorder.daemon = True
+        recorder.start()
+
+    def touch(self):
+        self.last_access = time.time()
+
+    def segment_path(self, sequence):
+        return os.path.join(self.directory, '%d.ts' % sequence)
+
+    def _store(self, sequence, segment_url, duration, discontinuity):
+        path = self.segment_path(sequence)
+        with open(path + '.part', 'wb') as f:
+            for chunk in iter_segment(segment_url, self.source.headers):
+                f.write(chunk)
+            size = f.tell()
+        os.rename(path + '.part', path)
+        with self.cond:
+            self.segments[sequence] = (duration, size, discontinuity)
+            self.size += size
+            while self.size > self.max_bytes and len(self.segments) > 1:
+                oldest, (_, oldest_size, _) = self.segments.popitem(last=False)
+                self.size -= oldest_size
+                try:
+                    os.remove(self.segment_path(oldest))
+                except OSError:
+                    pass
+            self.cond.notify_all()
+
+    def _record(self):
+        next_sequence = None
+        discontinuity = False
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            while not SHUTDOWN_EVENT.is_set() and time.time() - self.last_access < TIMESHIFT_IDLE_TIMEOUT:
+                try:
+                    playlist = self.source.load_playlist()
+                except (RequestException, IOError) as e:
+                    logging.warning("[Timeshift] Playlist error: %s" % e)
+                    time.sleep(self.target / 2)
+                    continue
+                self.target = playlist['target']
+                segments = playlist['segments']
+                if segments:
+                    first, last = segments[0][0], segments[-1][0]
+                    if next_sequence is None:
+                        next_sequence = first if playlist['endlist'] else max(first, last - STITCH_LIVE_EDGE + 1)
+                    elif next_sequence < first or next_sequence > last + 1:
+                        next_sequence = max(first, last - STITCH_LIVE_EDGE + 1)
+                        discontinuity = True
+                pending = [segment for segment in segments if segment[0] >= next_sequence]
+                for sequence, segment_url, duration, marked_discontinuity in pending:
+                    try:
+                        self._store(sequence, segment_url, duration, discontinuity or marked_discontinuity)
+                        discontinuity = False
+                    except (RequestException, IOError) as e:
+                        logging.warning("[Timeshift] Lost segment %d: %s" % (sequence, e))
+                        discontinuity = True
+                    next_sequence = sequence + 1
+                if playlist['endlist'] and segments and next_sequence > segments[-1][0]:
+                    with self.cond:
+                        self.endlist = True
+                        self.cond.notify_all()
+                    # Complete: keep it while the player still reads it
+                    while not SHUTDOWN_EVENT.is_set() and time.time() - self.last_access < TIMESHIFT_IDLE_TIMEOUT:
+                        time.sleep(1)
+                    break
+                if not pending:
+                    time.sleep(self.target / 2)
+        except Exception as e:
+            logging.warning("[Timeshift] Recorder failed: %s" % e)
+        finally:
+            self.manager.remove(self)
+            logging.debug("[Timeshift] Stopped recording %s" % self.source.url)
+
+    def wait_ready(self, count, timeout):
+        """Wait until count segments are recorded; False if none arrived in time."""
+        deadline = time.time() + timeout
+        with self.cond:
+            while len(self.segments) < count and not self.endlist and time.time() < deadline:
+                self.cond.wait(min(1.0, max(0.0, deadline - time.time())))
+            return bool(self.segments)
+
+    def playlist(self):
+        """Local media playlist listing every recorded segment."""
+        with self.cond:
+            segments = list(self.segments.items())
+            endlist = self.endlist
+        lines = ['#EXTM3U', '#EXT-X-VERSION:3',
+                 '#EXT-X-TARGETDURATION:%d' % int(max([self.target] + [item[1][0] for item in segments]) + 0.999),
+                 '#EXT-X-MEDIA-SEQUENCE:%d' % (segments[0][0] if segments else 0)]
+        for sequence, (duration, _, discontinuity) in segments:
+            if discontinuity:
+                lines.append('#EXT-X-DISCONTINUITY')
+            lines.append('#EXTINF:%.3f,' % duration)
+            lines.append('http://127.0.0.1:%d/timeshift/segment?channel=%s&seq=%d' % (PORT, self.key, sequence))
+        if endlist:
+            lines.append('#EXT-X-ENDLIST')
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def open_segment(self, sequence):
+        """Open a recorded segment for reading, or None once it left the ring."""
+        with self.cond:
+            if sequence not in self.segments:
+                return None
+            try:
+                return open(self.segment_path(sequence), 'rb')
+            except (IOError, OSError):
+                return None
+
+class TimeshiftManager(object):
+    """Timeshift recordings keyed by playlist URL, stored under the addon profile."""
+
+    def __init__(self):
+        self.channels = {}
+        self.directory = None
+        self.lock = threading.Lock()
+
+    def open(self, url, headers):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        with self.lock:
+            channel = self.channels.get(key)
+            if channel is None:
+                if self.directory is None:
+                    self.directory = os.path.join(addon_profile(), TIMESHIFT_DIRNAME)
+                channel = self.channels[key] = TimeshiftChannel(self, key, url, headers,
+                                                                os.path.join(self.directory, key))
+                channel.start()
+            channel.touch()
+            return channel
+
+    def get(self, key):
+        with self.lock:
+            channel = self.channels.get(key)
+        if channel is not None:
+            channel.touch()
+        return channel
+
+    def remove(self, channel):
+        with self.lock:
+            if self.channels.get(channel.key) is channel:
+                del self.channels[channel.key]
+        for name in os.listdir(channel.directory) if os.path.isdir(channel.directory) else []:
+            try:
+                os.remove(os.path.join(channel.directory, name))
+            except OSError:
+                pass
+        try:
+            os.rmdir(channel.directory)
+        except OSError:
+            pass
+
+    def stats(self):
+        with self.lock:
+            return dict((key, {'segments': len(channel.segments), 'bytes': channel.size})
+                        for key, channel in self.channels.items())
+
+TIMESHIFT = TimeshiftManager()
+
+class AbrSession(object):
+    """Picks the rendition behind one virtual variant from measured throughput and buffer level.
+
+    Segments are addressed by media sequence number, which the renditions of
+    an HLS ladder share, so every virtual segment request is resolved against
+    the rendition selected at that moment. Throughput is the lower of a fast
+    and a slow moving average of upstream downloads; the player's buffer is
+    estimated as media time delivered minus wall time since playback began.
+    """
+
+    def __init__(self, key, variants, headers):
+        self.key = key
+        self.variants = sorted(variants)
+        self.headers = dict((k, v) for k, v in headers.items() if k.lower() != 'range')
+        self.index = 0  # Start on the lowest rendition and climb once throughput is known
+        self.fast = None
+        self.slow = None
+        self.playlists = {}  # Variant index -> (parsed playlist, raw content, fetched at)
+        self.delivered = 0.0
+        self.started = None
+        self.last_request = time.time()
+        self.last_served = None  # Variant index of the previous segment
+        self.lock = threading.Lock()
+
+    def master_playlist(self):
+        peak = self.variants[-1][0]
+        return ('#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=%d\nhttp://127.0.0.1:%d/abr?session=%s\n' %
+                (peak, PORT, self.key))
+
+    def variant_playlist(self, index, refresh=False):
+        """Parsed playlist of a rendition, refetched when a live one is older than half its target."""
+        with self.lock:
+            cached = self.playlists.get(index)
+        if cached and not refresh:
+            parsed, _, fetched = cached
+            if parsed['endlist'] or time.time() - fetched < parsed['target'] / 2:
+                return cached
+        response = upstream_get(self.variants[index][1], headers=self.headers, allow_redirects=True, timeout=9)
+        if response.status_code != 200:
+            raise IOError("Variant playlist returned HTTP %d" % response.status_code)
+        content = response.content.decode('utf-8', errors='ignore')
+        base_url = response.url.split('?', 1)[0].rsplit('/', 1)[0]
+        cached = (parse_media_playlist(content, base_url), content, time.time())
+        with self.lock:
+            self.playlists[index] = cached
+        return cached
+
+    def media_playlist(self):
+        """The selected rendition's playlist with its segments pointing at /abr/segment."""
+        parsed, content, _ = self.variant_playlist(self.index)
+        base_url = parsed['segments'][0][1].rsplit('/', 1)[0] if parsed['segments'] else ''
+        sequence = parsed['sequence']
+        lines = []
+        for line in content.splitlines():
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#'):
+                lines.append('http://127.0.0.1:%d/abr/segment?session=%s&seq=%d' % (PORT, self.key, sequence))
+                sequence += 1
+            else:
+                # Keys and init sections stay upstream, but must not be relative to the proxy
+                lines.append(re.sub(r'URI="([^"]+)"',
+                                    lambda m: 'URI="%s"' % urljoin(base_url + '/', m.group(1)), line))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def segment(self, sequence):
+        """(URL, duration, variant index) of a segment in the selected rendition."""
+        index = self.index
+        for refresh in (False, True):
+            parsed = self.variant_playlist(index, refresh)[0]
+            for segment in parsed['segments']:
+                if segment[0] == sequence:
+                    return segment[1], segment[2], index
+            if parsed['endlist']:
+                break
+        if self.last_served is not None and self.last_served != index:
+            # Ladders that don't share sequence numbers: stay on the rendition in use
+            for segment in self.variant_playlist(self.last_served)[0]['segments']:
+                if segment[0] == sequence:
+                    return segment[1], segment[2], self.last_served
+        return None
+
+    def buffer_level(self):
+        if self.started is None:
+            return 0.0
+        return max(0.0, self.delivered - (time.time() - self.started))
+
+    def record(self, size, elapsed, duration, measured):
+        """Account a served segment and choose the rendition for the next one."""
+        with self.lock:
+            now = time.time()
+            if self.started is None or now - self.last_request > 30:
+                self.started, self.delivered = now, 0.0  # Start, or resume after a pause or seek
+            self.last_request = now
+            self.delivered += duration
+            if measured and elapsed > 0:
+                sample = size * 8 / elapsed
+                self.fast = sample if self.fast is None else 0.5 * sample + 0.5 * self.fast
+                self.slow = sample if self.slow is None else 0.15 * sample + 0.85 * self.slow
+            if self.fast is None:
+                return
+            budget = min(self.fast, self.slow) * ABR_SAFETY
+            buffered = self.buffer_level()
+            target = 0
+            for i, (bandwidth, _) in enumerate(self.variants):
+                if bandwidth <= budget:
+                    target = i
+            if target > self.index:
+                target = self.index + 1 if buffered >= ABR_UP_BUFFER or self.index == 0 else self.index
+            elif target < self.index and buffered >= ABR_HOLD_BUFFER:
+                target = self.index
+            if target != self.index:
+                logging.debug("[HLS ABR] %s: %d -> %d bps (throughput %d bps, buffer %.1fs)" %
+                              (self.key, self.variants[self.index][0], self.variants[target][0],
+                               min(self.fast, self.slow), buffered))
+                self.index = target
+
+class AbrRegistry(object):
+    """AbrSessions keyed by master playlist URL, least recently used dropped first."""
+
+    def __init__(self, max_sessions=ABR_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def open(self, url, variants, headers):
+        key = hashlib.sha1(SegmentCache.make_key(url).encode('utf-8')).hexdigest()[:16]
+        with self.lock:
+            session = self.sessions.pop(key, None)
+            if session is None or sorted(variants) != session.variants:
+                session = AbrSession(key, variants, headers)
+            self.sessions[key] = session
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def get(self, key):
+        with self.lock:
+            return self.sessions.get(key)
+
+ABR_SESSIONS = AbrRegistry()
+
 def parse_headers(request):
-    """Parse HTTP headers from raw request."""
-    headers = {}
-    for line in request.splitlines():
-        if ': ' in line:
-            key, value = line.split(': ', 1)
-            headers[key] = value
+    """Parse HTTP headers from raw request into a case-insensitive dict."""
+    headers = CaseInsensitiveDict()
+    for line in request.splitlines()[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip()] = value.strip()
     return headers
 
 def urljoin(base, url):
@@ -159,226 +2686,736 @@ def urljoin(base, url):
         from urlparse import urljoin  # Python 2
     return urljoin(base, url)
 
-def handle_request(client_socket, client_address, server_socket):
-    """Handle incoming HTTP request."""
-    try:
-        client_socket.settimeout(5)
-        request_data = client_socket.recv(4096).decode('utf-8', errors='ignore')
-        if not request_data:
+class ClientConnection(object):
+    """Client side of a proxy connection: reads requests and writes framed responses."""
+
+    def __init__(self, client_socket):
+        self.sock = client_socket
+        self.buffer = b''
+        self.method = 'GET'
+        self.version = 'HTTP/1.1'
+        self.keep_alive = False
+        self.chunked = False
+        self.remaining = None
+        self.route = None
+        self.target = None
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.window_start = time.time()
+        self.window_bytes = 0
+        self.bitrate = 0.0
+
+    @property
+    def head_only(self):
+        return self.method == 'HEAD'
+
+    def _recv_into_buffer(self):
+        data = self.sock.recv(8192)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def read_request(self):
+        """Read the next request head, returning (method, path, headers) or None on EOF."""
+        while b'\r\n\r\n' not in self.buffer:
+            if len(self.buffer) > MAX_REQUEST_HEAD:
+                raise ValueError("Request head too large")
+            if not self._recv_into_buffer():
+                return None
+        head, self.buffer = self.buffer.split(b'\r\n\r\n', 1)
+        self.bytes_in = len(head) + 4
+        self.bytes_out = 0
+        request_data = head.decode('utf-8', errors='ignore')
+        method, path, version = request_data.split('\r\n', 1)[0].split(' ', 2)
+        headers = parse_headers(request_data)
+
+        # Discard any request body so the next request starts on a clean buffer
+        body_length = int(headers.get('Content-Length', 0) or 0)
+        while len(self.buffer) < body_length:
+            if not self._recv_into_buffer():
+                return None
+        self.buffer = self.buffer[body_length:]
+
+        self.method = method.upper()
+        self.version = version.strip().upper()
+        connection = headers.get('Connection', '').lower()
+        if 'Transfer-Encoding' in headers:
+            self.keep_alive = False
+        elif self.version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection
+        else:
+            self.keep_alive = 'close' not in connection
+        self.chunked = False
+        self.remaining = None
+        return self.method, path, headers
+
+    def start_response(self, status, headers=None, length=None, stream=False):
+        """Send status line and headers.
+
+        A known length frames the body with Content-Length; otherwise the body
+        is chunked for HTTP/1.1 clients, or delimited by closing the connection
+        when stream=True (endless bodies) or for HTTP/1.0 clients.
+        """
+        lines = ["HTTP/1.1 %d %s" % (status, http_reason(status))]
+        for k, v in (headers or {}).items():
+            lines.append("%s: %s" % (k, v))
+        if length is not None:
+            lines.append("Content-Length: %d" % length)
+            self.remaining = length
+        elif self.head_only:
+            pass
+        elif not stream and self.version != 'HTTP/1.0':
+            lines.append("Transfer-Encoding: chunked")
+            self.chunked = True
+        else:
+            self.keep_alive = False
+        lines.append("Connection: %s" % ('keep-alive' if self.keep_alive else 'close'))
+        head = ("\r\n".join(lines) + "\r\n\r\n").encode('utf-8')
+        self.sock.sendall(head)
+        self.bytes_out += len(head)
+
+    def write(self, data):
+        """Write a piece of the response body."""
+        if self.head_only or not data:
             return
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        self._sent(len(data))
+        if self.chunked:
+            self.sock.sendall(("%x\r\n" % len(data)).encode('ascii'))
+            self.sock.sendall(data)
+            self.sock.sendall(b"\r\n")
+        else:
+            self.sock.sendall(data)
+
+    def sendfile(self, f, offset, count):
+        """Send count bytes of the file f from offset.
 
-        # Parse request
-        lines = request_data.splitlines()
-        if not lines:
+        Uses the kernel sendfile when the body isn't chunked, otherwise copies
+        blocks out of a memory map of the file.
+        """
+        if self.head_only or count <= 0:
             return
-        request_line = lines[0]
-        method, path, _ = request_line.split(' ', 2)
-        if method != 'GET':
-            client_socket.sendall(b"HTTP/1.1 405 Method Not Allowed\r\n\r\n")
+        if not self.chunked and hasattr(self.sock, 'sendfile'):
+            if self.remaining is not None:
+                self.remaining -= count
+            self._sent(count)
+            self.sock.sendfile(f, offset, count)
             return
-
-        headers = parse_headers(request_data)
-        parsed_path = urljoin('http://localhost' + path, path)  # Fake base for parsing
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
         try:
-            from urlparse import urlparse, parse_qs  # Python 2
-        except ImportError:
-            from urllib.parse import urlparse, parse_qs  # Python 3
-        parsed = urlparse(parsed_path)
-        query_params = parse_qs(parsed.query)
-        path = parsed.path
-
-        if path == "/":
-            response = json.dumps({"message": "ONEPLAY PROXY"})
-            client_socket.sendall(
-                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n" +
-                response.encode('utf-8')
-            )
-        elif path == "/stop":
-            response = json.dumps({"message": "Proxy shutting down"})
-            client_socket.sendall(
-                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n" +
-                response.encode('utf-8')
-            )
-            SHUTDOWN_EVENT.set()
-            server_socket.close()
-        elif path == "/hlsretry":
-            customdns()
-            url = query_params.get('url', [None])[0]
+            end = offset + count
+            while offset < end:
+                block = min(RELAY_MAX_READ, end - offset)
+                self.write(mapped[offset:offset + block])
+                offset += block
+        finally:
+            mapped.close()
+
+    def _sent(self, count):
+        """Account body bytes, refreshing the bitrate over windows of at least a second."""
+        self.bytes_out += count
+        self.window_bytes += count
+        now = time.time()
+        if now - self.window_start >= 1.0:
+            self.bitrate = self.window_bytes * 8 / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+
+    def current_bitrate(self):
+        """Bits per second sent over the last window, decaying to 0 once writes stop."""
+        idle = time.time() - self.window_start
+        return self.bitrate if idle < 2.0 else self.window_bytes * 8 / idle
+
+    def finish(self):
+        """Terminate the current response body."""
+        if self.head_only:
+            return
+        if self.chunked:
+            self.sock.sendall(b"0\r\n\r\n")
+            self.chunked = False
+        elif self.remaining:
+            # Body shorter than announced: the client can't reuse this connection
+            self.keep_alive = False
+
+    def send_response(self, status, body=b'', content_type='text/plain', headers=None):
+        """Send a complete response with a Content-Length framed body."""
+        response_headers = dict(headers or {})
+        if content_type:
+            response_headers['Content-Type'] = content_type
+        self.start_response(status, response_headers, length=len(body))
+        self.write(body)
+        self.finish()
+
+def upstream_length(response):
+    """Body length announced by the upstream, if it can be forwarded as-is."""
+    if response.headers.get('content-encoding'):
+        return None  # requests decodes the body, so the upstream length doesn't apply
+    try:
+        return int(response.headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+def handle_request(client_socket, client_address, server_socket):
+    """Serve HTTP requests on a client connection until either side closes it."""
+    serve_connection(ClientConnection(client_socket), client_address, server_socket, pooled=WORKER_POOL is not None)
+
+def serve_connection(conn, client_address, server_socket, request=None, pooled=False):
+    """Request loop of handle_request, starting with request if one was already read.
+
+    On a pool worker (pooled) the connection is handed to a thread of its own
+    when it asks for one of the ENDLESS_ROUTES, at most ENDLESS_MAX of them at once.
+    """
+    client_socket = conn.sock
+    detached = False
+    try:
+        if request is None:
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, CLIENT_SNDBUF)
+        client_socket.settimeout(CLIENT_TIMEOUT)
+        while not SHUTDOWN_EVENT.is_set():
+            if request is None:
+                try:
+                    request = conn.read_request()
+                except socket.timeout:
+                    break
+                except ValueError as e:
+                    logging.debug("[HLS Proxy] Malformed request: %s" % e)
+                    conn.keep_alive = False
+                    conn.send_response(400, b"Bad Request")
+                    break
+                if request is None:
+                    break
+            method, path, headers = request
+            if pooled and path.split('?', 1)[0] in ENDLESS_ROUTES:
+                if not ENDLESS_SLOTS.acquire(False):
+                    logging.debug("[HLS Proxy] Too many endless streams, refusing %s" % path)
+                    conn.keep_alive = False
+                    conn.send_response(503, b"Too many streams", headers={'Retry-After': '1'})
+                    break
+                t = threading.Thread(target=serve_endless, args=(conn, client_address, server_socket, request))
+                t.daemon = True
+                t.start()
+                detached = True
+                return
+            request = None
+            handle_route(conn, method, path, headers, client_address, server_socket)
+            if not conn.keep_alive or not wait_for_request(conn, pooled):
+                break
+    except Exception as e:
+        logging.error("Error handling request: %s" % e)
+    finally:
+        if not detached:
             try:
-                url = unquote_plus(url)
+                client_socket.close()
             except:
                 pass
-            client_ip = get_ip(headers, client_address)
-            cache_key = get_cache_key(client_ip, url) if url and any(x in url.lower() for x in ['.mp4', '.m3u8']) else client_ip
 
-            if not url:
-                client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\nNo URL provided")
-                return
+def serve_endless(conn, client_address, server_socket, request):
+    """serve_connection on a thread of its own, holding one of the ENDLESS_SLOTS."""
+    try:
+        serve_connection(conn, client_address, server_socket, request)
+    finally:
+        ENDLESS_SLOTS.release()
 
-            session = requests.Session()
-            req_headers = dict((k, v) for k, v in headers.items() if k.lower() != 'host')
-            original_headers = req_headers.copy()
-            max_retries = 7
-            attempts = 0
-            tried_without_range = [False]
-            change_user_agent = [False]
-            media_type = (
-                'video/mp4' if '.mp4' in url.lower()
-                else 'video/mp2t' if '.ts' in url.lower() or '/hl' in url.lower()
-                else 'application/octet-stream'
-            )
-            response_headers = {}
-            status = 200
-
-            while attempts < max_retries:
+def wait_for_request(conn, pooled):
+    """Wait on an idle keep-alive connection until the client sends its next request.
+
+    Returns False after KEEPALIVE_TIMEOUT, or once idle for KEEPALIVE_BUSY_TIMEOUT
+    while accepted connections are queued for a pool worker this one holds.
+    """
+    if conn.buffer:
+        return True  # Pipelined request already read
+    started = time.time()
+    while not SHUTDOWN_EVENT.is_set():
+        idle = time.time() - started
+        limit = KEEPALIVE_BUSY_TIMEOUT if pooled and WORKER_POOL.backlog() else KEEPALIVE_TIMEOUT
+        if idle >= limit:
+            return False
+        try:
+            if select.select([conn.sock], [], [], min(KEEPALIVE_POLL, limit - idle))[0]:
+                return True
+        except (select.error, ValueError):
+            return False
+    return False
+
+def handle_route(conn, method, path, headers, client_address, server_socket):
+    """Dispatch a single parsed request to its route."""
+    if method not in ('GET', 'HEAD'):
+        conn.send_response(405, b"Method Not Allowed", headers={'Allow': 'GET, HEAD'})
+        return
+
+    parsed_path = urljoin('http://localhost' + path, path)  # Fake base for parsing
+    try:
+        from urlparse import urlparse, parse_qs  # Python 2
+    except ImportError:
+        from urllib.parse import urlparse, parse_qs  # Python 3
+    parsed = urlparse(parsed_path)
+    query_params = parse_qs(parsed.query)
+    path = parsed.path
+
+    METRICS.request_started(conn, path, query_params.get('url', [None])[0])
+    try:
+        dispatch_route(conn, path, headers, query_params, client_address, server_socket)
+    finally:
+        METRICS.request_finished(conn)
+
+def dispatch_route(conn, path, headers, query_params, client_address, server_socket):
+    if path == "/":
+        response = json.dumps({"message": "ONEPLAY PROXY"})
+        conn.send_response(200, response.encode('utf-8'), 'application/json')
+    elif path == "/stop":
+        response = json.dumps({"message": "Proxy shutting down"})
+        conn.keep_alive = False
+        conn.send_response(200, response.encode('utf-8'), 'application/json')
+        SHUTDOWN_EVENT.set()
+        server_socket.close()
+    elif path == "/hlsretry":
+        handle_hlsretry(conn, headers, query_params, client_address)
+    elif path == "/tsdownloader":
+        handle_tsdownloader(conn, headers, query_params)
+    elif path == "/hlsts":
+        handle_hlsts(conn, headers, query_params)
+    elif path == "/abr":
+        handle_abr(conn, query_params)
+    elif path == "/abr/segment":
+        handle_abr_segment(conn, query_params)
+    elif path == "/timeshift":
+        handle_timeshift(conn, headers, query_params)
+    elif path == "/timeshift/segment":
+        handle_timeshift_segment(conn, query_params)
+    elif path == "/metrics":
+        conn.send_response(200, METRICS.prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+    elif path == "/stats":
+        conn.send_response(200, json.dumps(METRICS.snapshot()).encode('utf-8'), 'application/json')
+    else:
+        conn.send_response(404, b"Not Found")
+
+def handle_hlsretry(conn, headers, query_params, client_address):
+    """Proxy a playlist, segment or media file, retrying failed upstream requests."""
+    customdns()
+    url = query_params.get('url', [None])[0]
+    try:
+        url = unquote_plus(url)
+    except:
+        pass
+    client_ip = get_ip(headers, client_address)
+    cache_key = get_cache_key(client_ip, url) if url and any(x in url.lower() for x in ['.mp4', '.m3u8']) else client_ip
+
+    if not url:
+        conn.send_response(400, b"No URL provided")
+        return
+    request_range = headers.get('Range')
+    if is_segment_url(url):
+        PREFETCHER.note_request(url)
+        if send_cached_segment(conn, url, request_range):
+            return
+        if not request_range:
+            # Share one upstream download among every client asking for this segment
+            download, leader = SEGMENT_FLIGHTS.claim(url)
+            if leader:
                 try:
-                    range_header = req_headers.get('Range')
-                    if '.mp4' in url.lower() and range_header and tried_without_range[0]:
-                        req_headers.pop('Range', None)
-
-                    if AGENT_OF_CHAOS.get(cache_key) and not ('.ts' in url.lower() or '/hl' in url.lower()):
-                        req_headers['User-Agent'] = AGENT_OF_CHAOS[cache_key] if change_user_agent[0] else original_headers.get('User-Agent', DEFAULT_USER_AGENT)
-                    elif '.ts' in url.lower() or '/hl' in url.lower():
-                        req_headers['User-Agent'] = binascii.b2a_hex(os.urandom(20))[:32] if change_user_agent[0] or not req_headers.get('User-Agent') else original_headers.get('User-Agent', DEFAULT_USER_AGENT)
-
-                    response = session.get(url, headers=req_headers, allow_redirects=True, stream=True, timeout=9)
-
-                    if response.status_code in (200, 206):
-                        if '.mp4' in url.lower() or '.m3u8' in url.lower():
-                            url = response.url
-                        change_user_agent[0] = False
-                        if client_ip in COUNT_CLEAR and COUNT_CLEAR.get(client_ip, 0) > 4:
-                            try:
-                                AGENT_OF_CHAOS.pop(cache_key, None)
-                                IP_CACHE_MP4.pop(cache_key, None)
-                                IP_CACHE_TS.pop(cache_key, None)
-                            except:
-                                pass
-                            COUNT_CLEAR[client_ip] = 0
-                        else:
-                            COUNT_CLEAR[client_ip] = COUNT_CLEAR.get(client_ip, 0) + 1
-
-                        content_type = response.headers.get("content-type", "").lower()
-                        if "mpegurl" in content_type or ".m3u8" in url.lower():
-                            base_url = url.rsplit('/', 1)[0]
-                            playlist_content = response.content.decode('utf-8', errors='ignore')
-                            rewritten = rewrite_m3u8_urls(playlist_content, base_url, 'http', '127.0.0.1:%d' % PORT)
-                            client_socket.sendall(
-                                b"HTTP/1.1 200 OK\r\nContent-Type: application/x-mpegURL\r\n\r\n" +
-                                rewritten.encode('utf-8')
-                            )
-                            return
-
-                        if '/hl' in url.lower() and '_' in url.lower() and '.ts' in url.lower():
-                            try:
-                                seg_ = re.findall(r'_(.*?)\.ts', url)[0]
-                                url = url.replace('_%s.ts' % seg_, '_%s.ts' % (int(seg_) + 1))
-                            except:
-                                pass
-
-                        media_type = (
-                            'video/mp4' if '.mp4' in url.lower()
-                            else 'video/mp2t' if '.ts' in url.lower() or '/hl' in url.lower()
-                            else response.headers.get("content-type", "application/octet-stream")
-                        )
-                        response_headers = dict((k, v) for k, v in response.headers.items()
-                                                if k.lower() in ['content-type', 'accept-ranges', 'content-range'])
-                        status = 206 if response.status_code == 206 else 200
-
-                        header_str = "HTTP/1.1 %d OK\r\n" % status
-                        for k, v in response_headers.items():
-                            header_str += "%s: %s\r\n" % (k, v)
-                        header_str += "Content-Type: %s\r\n\r\n" % media_type
-                        client_socket.sendall(header_str.encode('utf-8'))
-
-                        for chunk in stream_response(response, client_ip, url, req_headers, session):
-                            client_socket.sendall(chunk)
-                        return
+                    fetch_hlsretry(conn, url, headers, client_ip, cache_key, download)
+                finally:
+                    if not download.started:
+                        SEGMENT_FLIGHTS.abandon(url, download)
+                return
+            if relay_inflight(conn, download) or send_cached_segment(conn, url):
+                return
+    elif '.mp4' in url.lower():
+        if DISK_CACHE_ENABLED and serve_from_disk_cache(conn, url, headers):
+            return
+    elif not is_cacheable_media(url):
+        if serve_cached_playlist(conn, url):
+            return
+        if '.m3u8' in url.lower():
+            # Coalesce concurrent polls of one playlist into a single upstream fetch
+            if PLAYLIST_FLIGHTS.begin(url):
+                try:
+                    return fetch_hlsretry(conn, url, headers, client_ip, cache_key)
+                finally:
+                    PLAYLIST_FLIGHTS.end(url)
+            PLAYLIST_FLIGHTS.wait(url, PLAYLIST_FLIGHT_TIMEOUT)
+            if serve_cached_playlist(conn, url):
+                return
+    fetch_hlsretry(conn, url, headers, client_ip, cache_key)
 
-                    elif response.status_code == 416 and range_header and not tried_without_range[0]:
-                        tried_without_range[0] = True
-                        continue
+def fetch_hlsretry(conn, url, headers, client_ip, cache_key, download=None):
+    """Fetch url upstream for /hlsretry and relay it to the client.
+
+    When download is given the body is pumped into it in the background and
+    this client is served as one of its subscribers.
+    """
+    request_url = url
+    request_range = headers.get('Range')
+    req_headers = dict((k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+    original_headers = req_headers.copy()
+    policy = RetryPolicy.for_url(url)
+    tried_without_range = [False]
+    change_user_agent = [False]
+    media_type = (
+        'video/mp4' if '.mp4' in url.lower()
+        else 'video/mp2t' if '.ts' in url.lower() or '/hl' in url.lower()
+        else 'application/octet-stream'
+    )
+    response_headers = {}
+    status = 200
+
+    while policy.allows():
+        try:
+            range_header = req_headers.get('Range')
+            if '.mp4' in url.lower() and range_header and tried_without_range[0]:
+                req_headers.pop('Range', None)
+
+            if AGENT_OF_CHAOS.get(cache_key) and not ('.ts' in url.lower() or '/hl' in url.lower()):
+                req_headers['User-Agent'] = AGENT_OF_CHAOS[cache_key] if change_user_agent[0] else original_headers.get('User-Agent', DEFAULT_USER_AGENT)
+            elif '.ts' in url.lower() or '/hl' in url.lower():
+                req_headers['User-Agent'] = binascii.b2a_hex(os.urandom(20))[:32] if change_user_agent[0] or not req_headers.get('User-Agent') else original_headers.get('User-Agent', DEFAULT_USER_AGENT)
+
+            hedge_headers = dict(req_headers)
+            hedge_headers['User-Agent'] = AGENT_OF_CHAOS.get(cache_key) or binascii.b2a_hex(os.urandom(20))[:32]
+            try:
+                response = hedged_get(url, req_headers, hedge_headers, policy, allow_redirects=True, stream=True, timeout=9)
+            except RequestException:
+                raise
+            except Exception as e:
+                # Not a network failure (a malformed url, say): another attempt won't fare better
+                logging.error("[HLS Proxy] Can't fetch %s: %s" % (url, e))
+                break
+
+            if response.status_code in (200, 206):
+                if '.mp4' in url.lower() or '.m3u8' in url.lower():
+                    url = response.url
+                change_user_agent[0] = False
+                if client_ip in COUNT_CLEAR and COUNT_CLEAR.get(client_ip, 0) > 4:
+                    AGENT_OF_CHAOS.pop(cache_key, None)
+                    COUNT_CLEAR[client_ip] = 0
+                else:
+                    COUNT_CLEAR[client_ip] = COUNT_CLEAR.get(client_ip, 0) + 1
+
+                content_type = response.headers.get("content-type", "").lower()
+                if "mpegurl" in content_type or ".m3u8" in url.lower():
+                    base_url = url.rsplit('/', 1)[0]
+                    playlist_content = response.content.decode('utf-8', errors='ignore')
+                    response.close()
+                    variants = master_variants(playlist_content, base_url) if ABR_ENABLED else []
+                    if len(variants) > 1:
+                        rewritten = ABR_SESSIONS.open(request_url, variants, req_headers).master_playlist()
                     else:
-                        change_user_agent[0] = True
-                        logging.debug("Error code %d, attempt %d" % (response.status_code, attempts))
-                        AGENT_OF_CHAOS[cache_key] = binascii.b2a_hex(os.urandom(20))[:32]
-                        time.sleep(3)
-                        attempts += 1
-                        if '.ts' in url.lower() or '/hl' in url.lower() or '.mp4' in url.lower():
-                            header_str = "HTTP/1.1 %d OK\r\nContent-Type: %s\r\n" % (status, media_type)
-                            for k, v in response_headers.items():
-                                header_str += "%s: %s\r\n" % (k, v)
-                            header_str += "\r\n"
-                            client_socket.sendall(header_str.encode('utf-8'))
-                            for chunk in stream_cache(client_ip, url) or []:
-                                client_socket.sendall(chunk)
-                            return
+                        rewritten = rewrite_m3u8_urls(playlist_content, base_url, 'http', '127.0.0.1:%d' % PORT)
+                    entry = {
+                        'body': rewritten.encode('utf-8'),
+                        'segments': playlist_segment_urls(playlist_content, base_url) if '#EXTINF' in playlist_content else [],
+                        'live': '#EXT-X-ENDLIST' not in playlist_content,
+                        'headers': req_headers,
+                    }
+                    PLAYLIST_CACHE.put(request_url, entry, PlaylistCache.ttl_for(playlist_content))
+                    PLAYLIST_CACHE.note_target(base_url, playlist_content)
+                    send_playlist(conn, entry)
+                    return
+
+                if '/hl' in url.lower() and '_' in url.lower() and '.ts' in url.lower():
+                    try:
+                        seg_ = re.findall(r'_(.*?)\.ts', url)[0]
+                        url = url.replace('_%s.ts' % seg_, '_%s.ts' % (int(seg_) + 1))
+                    except:
+                        pass
+
+                media_type = (
+                    'video/mp4' if '.mp4' in url.lower()
+                    else 'video/mp2t' if '.ts' in url.lower() or '/hl' in url.lower()
+                    else response.headers.get("content-type", "application/octet-stream")
+                )
+                response_headers = dict((k, v) for k, v in response.headers.items()
+                                        if k.lower() in ['accept-ranges', 'content-range'])
+                response_headers['Content-Type'] = media_type
+                status = 206 if response.status_code == 206 else 200
+
+                if download is not None:
+                    download.start(status, response_headers, upstream_length(response))
+                    pump = threading.Thread(target=pump_download, args=(download, response, request_url, req_headers))
+                    pump.daemon = True
+                    pump.start()
+                    relay_inflight(conn, download)
+                    return
+
+                conn.start_response(status, response_headers, upstream_length(response))
+                if conn.head_only:
+                    response.close()
+                    return
+                writer = disk_cache_writer(request_url, response)
+                body = accelerated_body(response, url, req_headers)
+                if body is not None:
+                    logging.debug("[HLS Proxy] Splitting %s over %d connections" % (url, ACCEL_CONNECTIONS))
+                elif RELAY_MODE == 'buffer':
+                    body = iter_resumable(response, response.url, req_headers)
+                else:
+                    body = stream_response(response, request_url, response_headers, request_range)
+                try:
+                    for chunk in body:
+                        conn.write(chunk)
+                        if writer:
+                            writer.write(chunk)
                 except RequestException as e:
-                    change_user_agent[0] = True
-                    logging.debug("Unknown error: %s" % e)
-                    AGENT_OF_CHAOS[cache_key] = binascii.b2a_hex(os.urandom(20))[:32]
-                    time.sleep(3)
-                    attempts += 1
-                    if '.ts' in url.lower() or '/hl' in url.lower() or '.mp4' in url.lower():
-                        header_str = "HTTP/1.1 %d OK\r\nContent-Type: %s\r\n" % (status, media_type)
-                        for k, v in response_headers.items():
-                            header_str += "%s: %s\r\n" % (k, v)
-                        header_str += "\r\n"
-                        client_socket.sendall(header_str.encode('utf-8'))
-                        for chunk in stream_cache(client_ip, url) or []:
-                            client_socket.sendall(chunk)
-                        return
+                    # The response has started: retrying would write a second one into this body,
+                    # so leave the retry loop and drop the connection instead
+                    conn.keep_alive = False
+                    raise IOError("Upstream broke off mid-body: %s" % e)
+                finally:
+                    if writer:
+                        writer.close()
+                conn.finish()
+                return
 
-            client_socket.sendall(b"HTTP/1.1 502 Bad Gateway\r\n\r\nFailed to connect after multiple attempts")
-        elif path == "/tsdownloader":
-            customdns()
-            url = query_params.get('url', [None])[0]
-            if not url:
-                client_socket.sendall(b"HTTP/1.1 400 Bad Request\r\n\r\nMissing 'url' parameter")
+            elif response.status_code == 416 and range_header and not tried_without_range[0]:
+                response.close()
+                tried_without_range[0] = True
+                continue
+            else:
+                response.close()
+                change_user_agent[0] = True
+                logging.debug("Error code %d, attempt %d" % (response.status_code, policy.attempts))
+                AGENT_OF_CHAOS[cache_key] = binascii.b2a_hex(os.urandom(20))[:32]
+                if send_cached_segment(conn, request_url, request_range):
+                    return
+                policy.backoff()
+        except OriginUnavailable as e:
+            logging.debug("[HLS Proxy] %s, not waiting for %s" % (e, url))
+            if send_cached_segment(conn, request_url, request_range):
                 return
-            try:
-                url = unquote_plus(url)
-            except:
-                pass
+            conn.send_response(503, b"Upstream busy", None, {'Retry-After': str(e.retry_after)})
+            return
+        except RequestException as e:
+            change_user_agent[0] = True
+            logging.debug("Unknown error: %s" % e)
+            AGENT_OF_CHAOS[cache_key] = binascii.b2a_hex(os.urandom(20))[:32]
+            if send_cached_segment(conn, request_url, request_range):
+                return
+            policy.backoff()
 
-            req_headers = dict((k, v) for k, v in headers.items() if k.lower() != 'host')
-            stop_ts = [False]
-            last_url = ['']
+    conn.send_response(502, b"Failed to connect after multiple attempts")
 
-            def generate_ts():
-                while not stop_ts[0] and not SHUTDOWN_EVENT.is_set():
-                    try:
-                        if not last_url[0]:
-                            last_url[0] = requests.get(url, headers=req_headers, allow_redirects=True, stream=True, timeout=5).url
-                        response = requests.get(last_url[0], headers=req_headers, stream=True, timeout=15)
-                        if response.status_code == 200:
-                            for chunk in response.iter_content(chunk_size=4096):
-                                if stop_ts[0] or SHUTDOWN_EVENT.is_set():
-                                    logging.warning("[TS Downloader] Stream stopped by client or shutdown.")
-                                    return
-                                if chunk:
-                                    yield chunk
-                            response.close()
-                        else:
-                            logging.warning("[TS Downloader] HTTP response %d" % response.status_code)
-                    except Exception as e:
-                        logging.warning("[TS Downloader] Stream error: %s" % e)
-                logging.warning("[TS Downloader] Stream terminated by client or shutdown")
+def handle_tsdownloader(conn, headers, query_params):
+    """Relay an endless TS stream, reconnecting to the upstream whenever it ends."""
+    customdns()
+    url = query_params.get('url', [None])[0]
+    if not url:
+        conn.send_response(400, b"Missing 'url' parameter")
+        return
+    try:
+        url = unquote_plus(url)
+    except:
+        pass
 
-            client_socket.sendall(b"HTTP/1.1 200 OK\r\nContent-Type: video/mp2t\r\n\r\n")
-            try:
-                for chunk in generate_ts():
-                    client_socket.sendall(chunk)
-            except (socket.error, BrokenPipeError):
-                logging.warning("[TS Downloader] Client disconnected")
-                stop_ts[0] = True
-    except Exception as e:
-        logging.error("Error handling request: %s" % e)
+    if '.m3u8' in url.lower():
+        # A playlist can't be relayed as an endless TS body; stitch its segments instead
+        stream_stitched(conn, url, headers)
+        return
+
+    req_headers = dict((k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+    relay_broadcast(conn, url, lambda: iter_ts_upstream(url, req_headers), "[TS Downloader]")
+
+def iter_ts_upstream(url, req_headers):
+    """Endless TS body of url, reconnecting to the upstream whenever it ends."""
+    last_url = ''
+    while not SHUTDOWN_EVENT.is_set():
+        try:
+            if not last_url:
+                first = upstream_get(url, headers=req_headers, allow_redirects=True, stream=True, timeout=5)
+                last_url = first.url
+                first.close()
+            response = upstream_get(last_url, headers=req_headers, stream=True, timeout=15)
+            if response.status_code == 200:
+                try:
+                    for chunk in iter_response(response):
+                        if chunk:
+                            yield chunk
+                finally:
+                    response.close()
+            else:
+                logging.warning("[TS Downloader] HTTP response %d" % response.status_code)
+                response.close()
+                time.sleep(1)
+        except Exception as e:
+            logging.warning("[TS Downloader] Stream error: %s" % e)
+            time.sleep(1)
+    logging.warning("[TS Downloader] Stream terminated by shutdown")
+
+def relay_broadcast(conn, key, source_factory, label):
+    """Serve a shared endless TS stream, joining or starting its broadcast channel."""
+    conn.start_response(200, {'Content-Type': 'video/mp2t'}, stream=True)
+    if conn.head_only:
+        return
+    body = BROADCAST_HUB.join(key, source_factory)
+    try:
+        for chunk in body:
+            conn.write(chunk)
+        conn.finish()
+    except (socket.error, BrokenPipeError):
+        logging.warning("%s Client disconnected" % label)
     finally:
+        body.close()
+
+def handle_hlsts(conn, headers, query_params):
+    """Play a live HLS playlist as one continuous video/mp2t response."""
+    customdns()
+    url = query_params.get('url', [None])[0]
+    if not url:
+        conn.send_response(400, b"Missing 'url' parameter")
+        return
+    stream_stitched(conn, unquote_plus(url), headers)
+
+def handle_timeshift(conn, headers, query_params):
+    """Record a live playlist and answer with a local playlist of everything recorded so far."""
+    customdns()
+    url = query_params.get('url', [None])[0]
+    if not url:
+        conn.send_response(400, b"Missing 'url' parameter")
+        return
+    req_headers = dict((k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+    channel = TIMESHIFT.open(unquote_plus(url), req_headers)
+    if not channel.wait_ready(STITCH_LIVE_EDGE, PLAYLIST_FLIGHT_TIMEOUT):
+        conn.send_response(504, b"No segments recorded yet")
+        return
+    conn.send_response(200, channel.playlist(), 'application/x-mpegURL')
+
+def handle_timeshift_segment(conn, query_params):
+    channel = TIMESHIFT.get(query_params.get('channel', [''])[0])
+    try:
+        sequence = int(query_params.get('seq', [''])[0])
+    except ValueError:
+        sequence = None
+    f = channel.open_segment(sequence) if channel is not None and sequence is not None else None
+    if f is None:
+        conn.send_response(404, b"Segment not in timeshift buffer")
+        return
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        conn.start_response(200, {'Content-Type': 'video/mp2t'}, size)
+        conn.sendfile(f, 0, size)
+        conn.finish()
+
+def handle_abr(conn, query_params):
+    """Media playlist of an ABR session's virtual variant."""
+    session = ABR_SESSIONS.get(query_params.get('session', [''])[0])
+    if session is None:
+        conn.send_response(404, b"Unknown ABR session")
+        return
+    try:
+        body = session.media_playlist()
+    except (RequestException, IOError) as e:
+        logging.debug("[HLS ABR] Playlist failed: %s" % e)
+        conn.send_response(502, b"Variant playlist unavailable")
+        return
+    conn.send_response(200, body, 'application/x-mpegURL')
+
+def handle_abr_segment(conn, query_params):
+    """Serve one virtual segment from the rendition the session currently selects."""
+    session = ABR_SESSIONS.get(query_params.get('session', [''])[0])
+    try:
+        sequence = int(query_params.get('seq', [''])[0])
+        segment = session.segment(sequence) if session is not None else None
+    except (ValueError, RequestException, IOError) as e:
+        logging.debug("[HLS ABR] Segment lookup failed: %s" % e)
+        segment = None
+    if segment is None:
+        conn.send_response(404, b"Segment not in playlist")
+        return
+    url, duration, index = segment
+    switched = session.last_served is not None and session.last_served != index
+    session.last_served = index
+    measured = not SEGMENT_CACHE.contains(url)
+    started = time.time()
+    size = 0
+    marked = set()
+    body = iter_segment(url, session.headers)
+    try:
+        chunk = next(body, None)
+    except (RequestException, IOError) as e:
+        logging.debug("[HLS ABR] Segment %d failed: %s" % (sequence, e))
+        session.record(0, time.time() - started, 0, False)
+        conn.send_response(502, b"Segment unavailable")
+        return
+    conn.start_response(200, {'Content-Type': 'video/mp2t'})
+    while chunk is not None:
+        if switched and size < 1024 * 1024:
+            chunk = mark_ts_discontinuity(chunk, size, marked)  # New rendition, new decoder parameters
+        size += len(chunk)
+        conn.write(chunk)
+        chunk = next(body, None)
+    conn.finish()
+    session.record(size, time.time() - started, duration, measured)
+
+def stream_stitched(conn, url, headers):
+    req_headers = dict((k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS)
+    relay_broadcast(conn, 'hlsts:' + url, lambda: LiveStitcher(url, req_headers), "[HLS Stitch]")
+
+def send_cached_segment(conn, url, range_header=None):
+    """Answer a media request with its complete cached copy, if there is one."""
+    cached = stream_cache(url, range_header)
+    if cached is None:
+        return False
+    body, cached_headers = cached
+    status = 206 if 'Content-Range' in cached_headers else 200
+    conn.send_response(status, body, None, cached_headers)
+    return True
+
+class ProxyWorkerPool(object):
+    """Fixed-size pool of worker threads serving accepted client sockets."""
+
+    def __init__(self, handler, workers=POOL_WORKERS, queue_size=POOL_QUEUE_SIZE):
+        self.handler = handler
+        self.workers = workers
+        self.tasks = queue.Queue(maxsize=queue_size)
+        self.threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name='proxy-worker-%d' % i)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            try:
+                self.handler(*task)
+            except Exception as e:
+                logging.error("Worker error: %s" % e)
+
+    def backlog(self):
+        """Connections accepted but still waiting for a worker."""
+        return self.tasks.qsize()
+
+    def submit(self, client_socket, client_address, server_socket):
+        """Queue a connection; reject it with 503 when the pool is saturated."""
         try:
-            client_socket.close()
-        except:
-            pass
+            self.tasks.put_nowait((client_socket, client_address, server_socket))
+            return True
+        except queue.Full:
+            logging.warning("[Proxy] Worker pool saturated, rejecting %s" % (client_address,))
+            try:
+                client_socket.sendall(b"HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\n\r\n")
+            except socket.error:
+                pass
+            try:
+                client_socket.close()
+            except:
+                pass
+            return False
+
+    def shutdown(self):
+        for _ in self.threads:
+            try:
+                self.tasks.put_nowait(None)
+            except queue.Full:
+                break
+
+WORKER_POOL = None  # The running ProxyWorkerPool with the 'pool' engine
 
 def is_proxy_running():
     """Check if the proxy is already running by checking the port."""
@@ -401,7 +3438,7 @@ def start_proxy():
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     try:
         server_socket.bind(('127.0.0.1', PORT))
-        server_socket.listen(5)
+        server_socket.listen(ACCEPT_BACKLOG)
     except socket.error as e:
         xbmc.log("[Proxy] Failed to bind to port %d: %s" % (PORT, e), level=xbmc.LOGERROR)
         server_socket.close()
@@ -409,13 +3446,23 @@ def start_proxy():
 
     #monitor = KodiMonitor(server_socket)
 
+    global WORKER_POOL
+    pool = None
+    if PROXY_ENGINE == 'pool':
+        pool = ProxyWorkerPool(handle_request)
+        pool.start()
+    WORKER_POOL = pool
+
     def run_server():
         try:
-            xbmc.log("[Proxy] Starting proxy server on port %d" % PORT, level=xbmc.LOGINFO)
+            xbmc.log("[Proxy] Starting proxy server on port %d (engine: %s)" % (PORT, PROXY_ENGINE), level=xbmc.LOGINFO)
             while not SHUTDOWN_EVENT.is_set():
                 try:
                     client_socket, client_address = server_socket.accept()
-                    threading.Thread(target=handle_request, args=(client_socket, client_address, server_socket)).start()
+                    if pool:
+                        pool.submit(client_socket, client_address, server_socket)
+                    else:
+                        threading.Thread(target=handle_request, args=(client_socket, client_address, server_socket)).start()
                 except socket.error:
                     if not SHUTDOWN_EVENT.is_set():
                         logging.error("Error accepting connection")
@@ -423,6 +3470,8 @@ def start_proxy():
             xbmc.log("[Proxy] Server error: %s" % e, level=xbmc.LOGERROR)
         finally:
             server_socket.close()
+            if pool:
+                pool.shutdown()
             xbmc.log("[Proxy] Proxy server stopped", level=xbmc.LOGINFO)
 
     threading.Thread(target=run_server).start()
@@ -431,6 +3480,11 @@ def start_proxy():
 
 def kodiproxy():
     """Start the Kodi proxy server."""
+    try:
+        # Playback is about to start: resolve known hosts now and keep them fresh while it runs
+        customdns().warm_up(keep_fresh=True)
+    except Exception:
+        pass
     if start_proxy():
         xbmc.log("[Addon] Proxy started successfully", level=xbmc.LOGINFO)
     else:
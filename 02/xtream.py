@@ -334,6 +334,11 @@ def parselist(url):
                     iptv.append({'dns': dns, 'username': username, 'password': password})
     except:
         pass
+    try:
+        # O host da lista e os servidores que ela traz são os próximos a serem acessados
+        customdns().warm_up([url] + [item['dns'] for item in iptv])
+    except:
+        pass
     # teste iptv - tirar isso
     return iptv
 
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""Per-stream CPU cost of the proxy media relay, per RELAY_MODE.
+
+Serves a synthetic file from a local origin, downloads it through
+/hlsretry with several concurrent clients and reports the proxy process
+CPU time for each relay mode. Each mode also fetches a small body several
+times in a row and reports how many upstream connections that opened: with
+keep-alive working it is 1. Linux only (CPU is read from /proc).
+
+    python tools/bench_relay.py --size-mb 200 --clients 4
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import kodi_offline  # noqa: E402
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+REUSE_BODY = 300 * 1024
+
+
+def run_origin(port, size, connections):
+    block = os.urandom(1024 * 1024)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            with connections.get_lock():
+                connections.value += 1
+            BaseHTTPRequestHandler.setup(self)
+
+        def do_GET(self):
+            size = REUSE_BODY if self.path.startswith('/reuse/') else self.server.size
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            sent = 0
+            view = memoryview(block)
+            try:
+                while sent < size:
+                    n = min(len(block), size - sent)
+                    self.wfile.write(view[:n])
+                    sent += n
+            except socket.error:
+                pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.size = size
+    server.serve_forever()
+
+
+def run_proxy(port, mode):
+    kodi_offline.install()
+    import logging
+    import proxy
+    logging.getLogger().setLevel(logging.WARNING)
+    proxy.PORT = port
+    proxy.RELAY_MODE = mode
+    proxy.start_proxy()
+    while True:
+        time.sleep(3600)
+
+
+def cpu_seconds(pid):
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def download(port, url):
+    sock = socket.create_connection(('127.0.0.1', port))
+    request = 'GET /hlsretry?url=%s HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: close\r\n\r\n' % url
+    sock.sendall(request.encode('ascii'))
+    buf = memoryview(bytearray(1024 * 1024))
+    received = 0
+    while True:
+        n = sock.recv_into(buf)
+        if not n:
+            break
+        received += n
+    sock.close()
+    return received
+
+
+def wait_port(port):
+    for _ in range(100):
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('port %d did not open' % port)
+
+
+def upstream_connections(port, origin_port, connections, fetches):
+    """Upstream connections opened by fetches sequential /hlsretry downloads of a small body."""
+    before = connections.value
+    for n in range(fetches):
+        # A new URL each time so no proxy cache answers in place of the origin
+        download(port, 'http://127.0.0.1:%d/reuse/%d.bin' % (origin_port, n))
+    return connections.value - before
+
+
+def bench(mode, args, connections):
+    proxy_port = args.port
+    proc = multiprocessing.Process(target=run_proxy, args=(proxy_port, mode))
+    proc.daemon = True
+    proc.start()
+    wait_port(proxy_port)
+    url = 'http://127.0.0.1:%d/movie.mp4' % args.origin_port
+    pool = multiprocessing.Pool(args.clients)
+    cpu_before = cpu_seconds(proc.pid)
+    started = time.time()
+    received = sum(pool.starmap(download, [(proxy_port, url)] * args.clients))
+    elapsed = time.time() - started
+    cpu = cpu_seconds(proc.pid) - cpu_before
+    pool.close()
+    reused = upstream_connections(proxy_port, args.origin_port, connections, args.reuse_fetches)
+    proc.terminate()
+    proc.join()
+    mbytes = received / 1048576.0
+    print('%-7s %8.1f MB %7.2f s %8.1f Mbps  proxy CPU %6.2f s  (%.3f CPU s per stream-GB)' % (
+        mode, mbytes, elapsed, mbytes * 8 / elapsed, cpu, cpu / (mbytes / 1024.0)))
+    print('%-7s %d sequential fetches used %d upstream connection(s)%s' % (
+        mode, args.reuse_fetches, reused, '' if reused <= 1 else '  <- keep-alive broken'))
+    time.sleep(0.5)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=200, help='body size served by the origin')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent streams')
+    parser.add_argument('--port', type=int, default=18599, help='proxy port')
+    parser.add_argument('--origin-port', type=int, default=18700)
+    parser.add_argument('--modes', default='chunks,buffer')
+    parser.add_argument('--reuse-fetches', type=int, default=5, help='sequential fetches for the reuse check')
+    args = parser.parse_args()
+
+    connections = multiprocessing.Value('i', 0)
+    origin = multiprocessing.Process(target=run_origin, args=(args.origin_port, args.size_mb * 1048576,
+                                                              connections))
+    origin.daemon = True
+    origin.start()
+    wait_port(args.origin_port)
+    for mode in args.modes.split(','):
+        bench(mode, args, connections)
+    origin.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""Stand-in DNS resolver for testing dns.py backends offline.
+
+Answers A and AAAA queries from a small static zone over every transport
+customdns can use:
+
+    UDP and TCP on --port             (set_backend('udp'/'tcp', ['127.0.0.1:5353']))
+    DNS over TLS on --tls-port        (set_backend('tls', ['127.0.0.1:8853#localhost']))
+    DNS over HTTPS on --https-port    (set_backend('https', ['https://127.0.0.1:8443/dns-query']))
+
+TLS uses --cert/--key, or a self-signed certificate for localhost/127.0.0.1
+generated with the openssl command; point customdns().tls_cafile at the
+printed certificate. Connections are kept alive and pipelined queries are
+answered in order, so connection reuse shows up in the per-transport counts
+printed on exit.
+
+    python tools/dns_standin.py --record iptv.example=127.0.0.1 --default 127.0.0.1 --latency 0.02
+"""
+import argparse
+import base64
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, TCPServer, UDPServer, BaseRequestHandler
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, TCPServer, UDPServer, BaseRequestHandler
+    from urlparse import urlparse, parse_qs
+
+QTYPE_A = 1
+QTYPE_AAAA = 28
+
+
+class ZoneConfig(object):
+    def __init__(self, records=None, default=None, ttl=300, latency=0.0):
+        self.records = records or {}    # Lowercase name -> list of IPv4/IPv6 addresses
+        self.default = default or []    # Addresses for any other name; empty = NXDOMAIN
+        self.ttl = ttl
+        self.latency = latency          # Seconds before each answer
+        self.stats = {'udp': 0, 'tcp': 0, 'tls': 0, 'https': 0, 'connections': 0}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args):
+        records = {}
+        for item in args.record:
+            name, ip = item.split('=', 1)
+            records.setdefault(name.lower().rstrip('.'), []).append(ip)
+        return cls(records, [args.default] if args.default else [], args.ttl, args.latency)
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+    def lookup(self, name):
+        return self.records.get(name.lower().rstrip('.'), self.default) or None
+
+
+def add_arguments(parser):
+    parser.add_argument('--record', action='append', default=[], metavar='NAME=IP',
+                        help='answer NAME with IP (repeat for several addresses)')
+    parser.add_argument('--default', help='address for names without a --record (default: NXDOMAIN)')
+    parser.add_argument('--ttl', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each answer')
+
+
+def answer(config, query):
+    """DNS response bytes for one query message."""
+    query = bytearray(query)
+    offset = 12
+    labels = []
+    while query[offset]:
+        length = query[offset]
+        labels.append(bytes(query[offset + 1:offset + 1 + length]).decode('ascii'))
+        offset += 1 + length
+    qtype = struct.unpack('>H', bytes(query[offset + 1:offset + 3]))[0]
+    question = bytes(query[12:offset + 5])
+    if config.latency:
+        time.sleep(config.latency)
+    ips = config.lookup('.'.join(labels))
+    records = []
+    for ip in ips or ():
+        if qtype == QTYPE_AAAA and ':' in ip:
+            packed = socket.inet_pton(socket.AF_INET6, ip)
+        elif qtype == QTYPE_A and ':' not in ip:
+            packed = socket.inet_aton(ip)
+        else:
+            continue
+        records.append(b'\xc0\x0c' + struct.pack('>HHIH', qtype, 1, config.ttl, len(packed)) + packed)
+    flags = 0x8180 if ips is not None else 0x8183  # NOERROR / NXDOMAIN
+    header = bytes(query[:2]) + struct.pack('>HHHHH', flags, 1, len(records), 0, 0)
+    return header + question + b''.join(records)
+
+
+def self_signed_certificate():
+    """(cert, key) paths of a new certificate for localhost and 127.0.0.1."""
+    folder = tempfile.mkdtemp(prefix='dns_standin_')
+    cert = os.path.join(folder, 'cert.pem')
+    key = os.path.join(folder, 'key.pem')
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '2',
+                           '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+                           '-keyout', key, '-out', cert],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    return cert, key
+
+
+class ThreadingUDPServer(ThreadingMixIn, UDPServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(ThreadingMixIn, TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    ssl_context = None
+
+    def get_request(self):
+        sock, addr = TCPServer.get_request(self)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Pipelined replies go out at once
+        if self.ssl_context is not None:
+            # Handshake in the handler thread, not in the accept loop
+            sock = self.ssl_context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+        return sock, addr
+
+
+class ThreadingHTTPSServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    ssl_context = None
+    get_request = ThreadingTCPServer.get_request
+
+
+def make_handlers(config):
+    class UdpHandler(BaseRequestHandler):
+        def handle(self):
+            data, sock = self.request
+            config.count('udp')
+            sock.sendto(answer(config, data), self.client_address)
+
+    class StreamHandler(BaseRequestHandler):
+        """Length-prefixed messages (RFC 7766) until the client closes."""
+
+        def handle(self):
+            kind = 'tls' if isinstance(self.request, ssl.SSLSocket) else 'tcp'
+            config.count('connections')
+            try:
+                if kind == 'tls':
+                    self.request.do_handshake()
+                reader = self.request.makefile('rb')
+                while True:
+                    prefix = reader.read(2)
+                    if len(prefix) < 2:
+                        return
+                    query = reader.read(struct.unpack('>H', prefix)[0])
+                    config.count(kind)
+                    reply = answer(config, query)
+                    self.request.sendall(struct.pack('>H', len(reply)) + reply)
+            except (socket.error, ssl.SSLError):
+                pass
+
+    class HttpsHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def setup(self):
+            config.count('connections')
+            self.request.do_handshake()
+            BaseHTTPRequestHandler.setup(self)
+
+        def reply(self, query):
+            config.count('https')
+            body = answer(config, query)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/dns-message')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            self.reply(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+
+        def do_GET(self):
+            encoded = parse_qs(urlparse(self.path).query).get('dns', [''])[0]
+            self.reply(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+
+    return UdpHandler, StreamHandler, HttpsHandler
+
+
+def serve(config, port=5353, tls_port=8853, https_port=8443, cert=None, key=None, host='127.0.0.1'):
+    """Start every transport in daemon threads; returns the list of servers."""
+    udp_handler, stream_handler, https_handler = make_handlers(config)
+    servers = [ThreadingUDPServer((host, port), udp_handler), ThreadingTCPServer((host, port), stream_handler)]
+    if tls_port or https_port:
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(cert, key)
+        if tls_port:
+            tls = ThreadingTCPServer((host, tls_port), stream_handler)
+            tls.ssl_context = context
+            servers.append(tls)
+        if https_port:
+            https = ThreadingHTTPSServer((host, https_port), https_handler)
+            https.ssl_context = context
+            servers.append(https)
+    for server in servers:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    return servers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=5353, help='UDP and TCP port')
+    parser.add_argument('--tls-port', type=int, default=8853, help='DNS over TLS port (0 = off)')
+    parser.add_argument('--https-port', type=int, default=8443, help='DNS over HTTPS port (0 = off)')
+    parser.add_argument('--cert', help='PEM certificate (default: self-signed for localhost)')
+    parser.add_argument('--key', help='PEM private key')
+    add_arguments(parser)
+    args = parser.parse_args()
+    config = ZoneConfig.from_args(args)
+    cert, key = args.cert, args.key
+    if (args.tls_port or args.https_port) and not cert:
+        cert, key = self_signed_certificate()
+        print('Self-signed certificate (use as tls_cafile): %s' % cert)
+    serve(config, args.port, args.tls_port, args.https_port, cert, key)
+    print('DNS stand-in on 127.0.0.1: udp/tcp %d, tls %d, https %d' % (args.port, args.tls_port, args.https_port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        print(', '.join('%s %d' % item for item in sorted(config.stats.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Run addon modules outside Kodi for benchmarks and load tests.
+
+install() puts the addon version folder named in config.json on sys.path and,
+when the real Kodi modules are missing, registers minimal xbmc, xbmcaddon and
+xbmcvfs stand-ins so proxy.py and dns.py can be imported from a plain Python.
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def addon_dir():
+    """Folder of the version referenced by config.json (e.g. 02/)."""
+    with open(os.path.join(ROOT, 'config.json')) as f:
+        return os.path.join(ROOT, json.load(f)['version'])
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install(profile=None):
+    """Make the addon importable; returns the profile directory used."""
+    profile = profile or tempfile.mkdtemp(prefix='spartan-profile-')
+    path = addon_dir()
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    try:
+        import xbmc  # noqa: F401
+        return profile
+    except ImportError:
+        pass
+
+    class Monitor(object):
+        def abortRequested(self):
+            return False
+
+        def waitForAbort(self, timeout=None):
+            time.sleep(timeout or 1)
+            return False
+
+    class Addon(object):
+        def __init__(self, *args):
+            pass
+
+        def getAddonInfo(self, key):
+            return profile if key == 'profile' else 'offline'
+
+        def getSetting(self, key):
+            return ''
+
+    def log(msg, level=0):
+        if level >= 2:
+            sys.stderr.write('%s\n' % msg)
+
+    _module('xbmc', LOGDEBUG=0, LOGINFO=1, LOGWARNING=2, LOGERROR=3, log=log,
+            Monitor=Monitor, translatePath=lambda p: p)
+    _module('xbmcaddon', Addon=Addon)
+    _module('xbmcvfs', translatePath=lambda p: p, exists=os.path.exists, mkdir=os.makedirs)
+    _module('xbmcgui')
+    _module('xbmcplugin')
+    return profile
@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""Load test: simulated Kodi players against the proxy and a synthetic origin.
+
+Starts tools/synthetic_origin.py and the proxy in their own processes, then
+runs HLS players (master -> variant playlist polling -> segments through
+/hlsretry), continuous TS players (/tsdownloader) and MP4 players (ranged
+reads with seeks through /hlsretry). Prints proxy CPU and RSS while it runs,
+then segment TTFB percentiles, sustained Mbps and errors per player kind.
+Linux only (CPU and RSS are read from /proc).
+
+    python tools/loadtest.py --hls 8 --ts 2 --mp4 2 --duration 60 --latency 0.05 --error-rate 0.02
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import kodi_offline  # noqa: E402
+import synthetic_origin  # noqa: E402
+from bench_relay import cpu_seconds, wait_port  # noqa: E402
+
+try:
+    from urllib.parse import quote
+except ImportError:
+    from urllib import quote
+
+
+def run_proxy(port, overrides):
+    kodi_offline.install()
+    import logging
+    import proxy
+    logging.getLogger().setLevel(logging.WARNING)
+    proxy.PORT = port
+    for name, value in overrides.items():
+        setattr(proxy, name, value)
+    proxy.start_proxy()
+    while True:
+        time.sleep(3600)
+
+
+def rss_bytes(pid):
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Results(object):
+    """Samples shared by all players of one kind."""
+
+    def __init__(self):
+        self.ttfb = []
+        self.bytes = 0
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def count_bytes(self, size):
+        with self.lock:
+            self.bytes += size
+
+    def add(self, ttfb=None, size=0, error=False):
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+            if error:
+                self.errors += 1
+            elif ttfb is not None:
+                self.ttfb.append(ttfb)
+
+
+def timed_get(session, url, results, headers=None):
+    """GET url, recording time to first body byte and bytes read."""
+    started = time.time()
+    ttfb = None
+    size = 0
+    try:
+        response = session.get(url, headers=headers, stream=True, timeout=30)
+        for chunk in response.iter_content(65536):
+            if ttfb is None:
+                ttfb = time.time() - started
+            size += len(chunk)
+        response.close()
+        ok = response.status_code in (200, 206)
+    except requests.RequestException:
+        ok = False
+    results.add(ttfb, size, not ok)
+    return ok
+
+
+def hls_player(proxy_url, origin_url, kind, deadline, results):
+    """Play a master playlist like Kodi: pick a variant, start 3 segments from the live edge, poll."""
+    session = requests.Session()
+    hlsretry = proxy_url + '/hlsretry?url='
+    try:
+        master = session.get(hlsretry + quote('%s/%s/bench/master.m3u8' % (origin_url, kind)), timeout=30).text
+    except requests.RequestException:
+        results.add(error=True)
+        return
+    variants = [line for line in master.splitlines() if line.startswith('http')]
+    if not variants:
+        results.add(error=True)
+        return
+    variant = variants[len(variants) // 2]
+    seen = set()
+    first = True
+    while time.time() < deadline:
+        try:
+            playlist = session.get(variant, timeout=30).text
+        except requests.RequestException:
+            results.add(error=True)
+            time.sleep(1)
+            continue
+        segments = [line for line in playlist.splitlines() if line.startswith('http')]
+        if first:
+            segments = segments[-3:] if kind == 'live' else segments
+            first = False
+        fresh = [segment for segment in segments if segment not in seen]
+        for segment in fresh:
+            if time.time() >= deadline:
+                return
+            seen.add(segment)
+            timed_get(session, segment, results)
+        if '#EXT-X-ENDLIST' in playlist and not fresh:
+            return
+        if not fresh:
+            time.sleep(1)
+
+
+def ts_player(proxy_url, origin_url, deadline, results):
+    session = requests.Session()
+    url = proxy_url + '/tsdownloader?url=' + quote('%s/stream/bench/2500.ts' % origin_url)
+    started = time.time()
+    try:
+        response = session.get(url, stream=True, timeout=30)
+        ttfb = None
+        for chunk in response.iter_content(65536):
+            if ttfb is None:
+                ttfb = time.time() - started
+            results.count_bytes(len(chunk))  # Counted as it arrives so the running report sees it
+            if time.time() >= deadline:
+                break
+        response.close()
+        results.add(ttfb)
+    except requests.RequestException:
+        results.add(error=True)
+
+
+def mp4_player(proxy_url, origin_url, size_mb, deadline, results):
+    """Read the file in 4 MB ranges, seeking to a random position every few reads."""
+    import random
+    session = requests.Session()
+    url = proxy_url + '/hlsretry?url=' + quote('%s/media/bench.mp4?mb=%d' % (origin_url, size_mb))
+    size = size_mb * 1024 * 1024
+    step = 4 * 1024 * 1024
+    position = 0
+    reads = 0
+    while time.time() < deadline:
+        end = min(position + step, size) - 1
+        timed_get(session, url, results, {'Range': 'bytes=%d-%d' % (position, end)})
+        reads += 1
+        position = end + 1 if end + 1 < size else 0
+        if reads % 4 == 0:
+            position = random.randrange(0, size // step) * step
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hls', type=int, default=4, help='live HLS players')
+    parser.add_argument('--vod', type=int, default=0, help='VOD HLS players')
+    parser.add_argument('--ts', type=int, default=1, help='/tsdownloader players')
+    parser.add_argument('--mp4', type=int, default=1, help='ranged MP4 players')
+    parser.add_argument('--mp4-size-mb', type=int, default=256)
+    parser.add_argument('--duration', type=int, default=30, help='seconds')
+    parser.add_argument('--port', type=int, default=18599, help='proxy port')
+    parser.add_argument('--origin-port', type=int, default=18700)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help='override a proxy setting, e.g. --set RELAY_MODE=chunks')
+    synthetic_origin.add_arguments(parser)
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.set:
+        name, value = item.split('=', 1)
+        try:
+            value = int(value)
+        except ValueError:
+            value = {'True': True, 'False': False}.get(value, value)
+        overrides[name] = value
+
+    origin = multiprocessing.Process(target=synthetic_origin.serve,
+                                     args=(args.origin_port, synthetic_origin.OriginConfig.from_args(args)))
+    origin.daemon = True
+    origin.start()
+    proxy = multiprocessing.Process(target=run_proxy, args=(args.port, overrides))
+    proxy.daemon = True
+    proxy.start()
+    wait_port(args.origin_port)
+    wait_port(args.port)
+
+    proxy_url = 'http://127.0.0.1:%d' % args.port
+    origin_url = 'http://127.0.0.1:%d' % args.origin_port
+    deadline = time.time() + args.duration
+    results = dict((kind, Results()) for kind in ('live', 'vod', 'ts', 'mp4'))
+    players = []
+    for _ in range(args.hls):
+        players.append(threading.Thread(target=hls_player, args=(proxy_url, origin_url, 'live', deadline,
+                                                                 results['live'])))
+    for _ in range(args.vod):
+        players.append(threading.Thread(target=hls_player, args=(proxy_url, origin_url, 'vod', deadline,
+                                                                  results['vod'])))
+    for _ in range(args.ts):
+        players.append(threading.Thread(target=ts_player, args=(proxy_url, origin_url, deadline, results['ts'])))
+    for _ in range(args.mp4):
+        players.append(threading.Thread(target=mp4_player, args=(proxy_url, origin_url, args.mp4_size_mb,
+                                                                  deadline, results['mp4'])))
+    started = time.time()
+    for player in players:
+        player.daemon = True
+        player.start()
+
+    print('%6s %8s %8s %10s' % ('time', 'cpu %', 'rss MB', 'total Mbps'))
+    cpu_start = last_cpu = cpu_seconds(proxy.pid)
+    last_time = started
+    last_bytes = 0
+    while any(player.is_alive() for player in players) and time.time() < deadline + 30:
+        time.sleep(5)
+        now = time.time()
+        cpu = cpu_seconds(proxy.pid)
+        total = sum(r.bytes for r in results.values())
+        print('%6.0f %8.1f %8.1f %10.1f' % (now - started, 100 * (cpu - last_cpu) / (now - last_time),
+                                            rss_bytes(proxy.pid) / 1048576.0,
+                                            (total - last_bytes) * 8 / (now - last_time) / 1e6))
+        last_cpu, last_time, last_bytes = cpu, now, total
+    elapsed = time.time() - started
+
+    print('\n%-5s %6s %6s %9s %9s %9s %9s' % ('kind', 'reqs', 'errors', 'ttfb p50', 'ttfb p90', 'ttfb p99',
+                                            'Mbps'))
+    for kind, r in results.items():
+        if not r.requests:
+            continue
+        print('%-5s %6d %6d %8.0fms %8.0fms %8.0fms %9.1f' % (
+            kind, r.requests, r.errors, 1000 * percentile(r.ttfb, 0.5), 1000 * percentile(r.ttfb, 0.9),
+            1000 * percentile(r.ttfb, 0.99), r.bytes * 8 / elapsed / 1e6))
+    print('\nproxy CPU %.1f s over %.0f s (%.1f%%), RSS %.1f MB' % (
+        cpu_seconds(proxy.pid) - cpu_start, elapsed, 100 * (cpu_seconds(proxy.pid) - cpu_start) / elapsed,
+        rss_bytes(proxy.pid) / 1048576.0))
+    proxy.terminate()
+    origin.terminate()
+
+
+if __name__ == '__main__':
+    main()
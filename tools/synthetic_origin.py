@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""Stand-in IPTV origin serving synthetic HLS, TS and MP4 media.
+
+Everything is generated on the fly, so benchmarks and load tests run offline:
+
+    /live/<name>/master.m3u8          master playlist, one variant per --bitrates entry
+    /live/<name>/<kbps>/index.m3u8    live sliding window that advances every segment duration
+    /vod/<name>/<kbps>/index.m3u8     VOD playlist of --vod-segments segments
+    /<live|vod>/<name>/<kbps>/<n>.ts  TS segment of <kbps> for one segment duration
+    /stream/<name>/<kbps>.ts          endless TS body paced at <kbps>
+    /media/<name>.mp4?mb=<n>          <n> MB file with Range support
+
+Latency, jitter, per-connection throttling and 5xx/429 error injection apply
+to every request.
+
+    python tools/synthetic_origin.py --port 18700 --latency 0.05 --jitter 0.1 --error-rate 0.02
+"""
+import argparse
+import random
+import re
+import socket
+import struct
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+TS_PACKET = 188
+VIDEO_PID = 0x100
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class OriginConfig(object):
+    def __init__(self, latency=0.0, jitter=0.0, throttle=0, error_rate=0.0, rate_limit_rate=0.0,
+                 segment_duration=2.0, window=6, vod_segments=60, bitrates=(800, 2500, 5000)):
+        self.latency = latency                    # Seconds added before every response
+        self.jitter = jitter                      # Extra random delay, uniform in [0, jitter]
+        self.throttle = throttle                  # Bytes/s per connection, 0 = unthrottled
+        self.error_rate = error_rate              # Fraction of requests answered with a 503
+        self.rate_limit_rate = rate_limit_rate    # Fraction of requests answered with a 429
+        self.segment_duration = segment_duration
+        self.window = window
+        self.vod_segments = vod_segments
+        self.bitrates = bitrates                  # kbps
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.latency, args.jitter, args.throttle, args.error_rate, args.rate_limit_rate,
+                   args.segment_duration, args.window, args.vod_segments,
+                   tuple(int(b) for b in args.bitrates.split(',')))
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random delay, seconds')
+    parser.add_argument('--throttle', type=int, default=0, help='bytes/s per connection (0 = none)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of 503 responses')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of 429 responses')
+    parser.add_argument('--segment-duration', type=float, default=2.0)
+    parser.add_argument('--window', type=int, default=6, help='segments in a live playlist')
+    parser.add_argument('--vod-segments', type=int, default=60)
+    parser.add_argument('--bitrates', default='800,2500,5000', help='variant bitrates, kbps')
+
+
+def ts_packets(count, counter=0, random_access=True):
+    """count TS packets on VIDEO_PID; the first carries a random access point."""
+    packets = bytearray(TS_PACKET * count)
+    for i in range(count):
+        offset = i * TS_PACKET
+        packets[offset:offset + 4] = struct.pack('>BHB', 0x47, (0x4000 if i == 0 else 0) | VIDEO_PID,
+                                                 0x30 | ((counter + i) & 0x0f))
+        packets[offset + 4] = 1  # One-byte adaptation field: just the flags
+        packets[offset + 5] = 0x40 if random_access and i == 0 else 0
+    return packets
+
+
+def segment_bytes(kbps, duration):
+    packets = max(1, int(kbps * 1000 / 8 * duration) // TS_PACKET)
+    return bytes(ts_packets(packets))
+
+
+def make_handler(config):
+    segments = {}
+    mp4_block = bytes(bytearray(random.getrandbits(8) for _ in range(65536)))
+
+    def segment(kbps):
+        if kbps not in segments:
+            segments[kbps] = segment_bytes(kbps, config.segment_duration)
+        return segments[kbps]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body=b'', content_type='text/plain', headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.write(body)
+
+        def write(self, data):
+            """Write data, pacing it to config.throttle."""
+            view = memoryview(data)
+            step = 16384 if config.throttle else len(view) or 1
+            started = time.time()
+            for offset in range(0, len(view), step):
+                self.wfile.write(view[offset:offset + step])
+                if config.throttle:
+                    ahead = (offset + step) / float(config.throttle) - (time.time() - started)
+                    if ahead > 0:
+                        time.sleep(ahead)
+
+        def do_GET(self):
+            time.sleep(config.latency + random.uniform(0, config.jitter))
+            roll = random.random()
+            if roll < config.error_rate:
+                return self.reply(503, b'injected error')
+            if roll < config.error_rate + config.rate_limit_rate:
+                return self.reply(429, b'injected rate limit', headers={'Retry-After': '1'})
+            parsed = urlparse(self.path)
+            path = parsed.path
+            try:
+                match = re.match(r'^/(live|vod)/([^/]+)/master\.m3u8$', path)
+                if match:
+                    return self.master(match.group(1))
+                match = re.match(r'^/(live|vod)/([^/]+)/(\d+)/index\.m3u8$', path)
+                if match:
+                    return self.media_playlist(match.group(1) == 'live')
+                match = re.match(r'^/(live|vod)/([^/]+)/(\d+)/(\d+)\.ts$', path)
+                if match:
+                    return self.reply(200, segment(int(match.group(3))), 'video/mp2t')
+                match = re.match(r'^/stream/([^/]+)/(\d+)\.ts$', path)
+                if match:
+                    return self.endless(int(match.group(2)))
+                if re.match(r'^/media/[^/]+\.mp4$', path):
+                    return self.mp4(int(parse_qs(parsed.query).get('mb', ['64'])[0]) * 1024 * 1024)
+                self.reply(404, b'not found')
+            except socket.error:
+                pass
+
+        def master(self, kind):
+            lines = ['#EXTM3U']
+            for kbps in config.bitrates:
+                lines.append('#EXT-X-STREAM-INF:BANDWIDTH=%d' % (kbps * 1000))
+                lines.append('%d/index.m3u8' % kbps)
+            self.reply(200, ('\n'.join(lines) + '\n').encode('ascii'), 'application/vnd.apple.mpegurl')
+
+        def media_playlist(self, live):
+            duration = config.segment_duration
+            if live:
+                first = int(time.time() / duration) - config.window + 1
+                count = config.window
+            else:
+                first, count = 0, config.vod_segments
+            lines = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:%d' % int(duration + 0.999),
+                     '#EXT-X-MEDIA-SEQUENCE:%d' % first]
+            for n in range(first, first + count):
+                lines.append('#EXTINF:%.3f,' % duration)
+                lines.append('%d.ts' % n)
+            if not live:
+                lines.append('#EXT-X-ENDLIST')
+            self.reply(200, ('\n'.join(lines) + '\n').encode('ascii'), 'application/vnd.apple.mpegurl')
+
+        def endless(self, kbps):
+            self.send_response(200)
+            self.send_header('Content-Type', 'video/mp2t')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.close_connection = True
+            per_tick = max(1, int(kbps * 1000 / 8 / 10) // TS_PACKET)  # Ten writes per second
+            counter = 0
+            started = time.time()
+            tick = 0
+            while True:
+                self.wfile.write(bytes(ts_packets(per_tick, counter, tick % 10 == 0)))
+                counter += per_tick
+                tick += 1
+                ahead = tick / 10.0 - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+        def mp4(self, size):
+            start, end = 0, size - 1
+            match = re.match(r'bytes=(\d*)-(\d*)', self.headers.get('Range', ''))
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start >= size:
+                    return self.reply(416, b'', headers={'Content-Range': 'bytes */%d' % size})
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'video/mp4')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            position = start
+            while position <= end:
+                offset = position % len(mp4_block)
+                n = min(len(mp4_block) - offset, end - position + 1)
+                self.write(mp4_block[offset:offset + n])
+                position += n
+
+    return Handler
+
+
+def serve(port, config):
+    ThreadingHTTPServer(('127.0.0.1', port), make_handler(config)).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=18700)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print('Synthetic origin on http://127.0.0.1:%d/' % args.port)
+    serve(args.port, OriginConfig.from_args(args))
+
+
+if __name__ == '__main__':
+    main()